@@ -0,0 +1,54 @@
+"""
+Script to backfill the prediction rollup index of a project from existing predictions in Elasticsearch.
+Only run this for tweets created before the es-predict task started updating the rollup index (see --until), otherwise predictions are counted twice.
+"""
+
+from utils import get_es_client, parse_date, ArgParseDefault
+from app.connections.elastic import add_to_rollup
+from elasticsearch import helpers
+import logging
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-5.5s] [%(name)-12.12s]: %(message)s')
+logger = logging.getLogger(__name__)
+
+def main(args):
+    es_client = get_es_client(env=args.env)
+    # make sure the rollup index is created with the rollup mapping
+    es_client.ensure_rollup_template()
+    query = {'query': {'bool': {'must': [
+        {'range': {'created_at': {'lt': parse_date(args.until)}}},
+        {'exists': {'field': 'is_retweet'}},
+        {'exists': {'field': f'meta.{args.question_tag}'}}
+        ]}}}
+    query['_source'] = ['created_at', 'is_retweet', f'meta.{args.question_tag}']
+    rollup_docs = {}
+    num_docs = 0
+    for doc in helpers.scan(es_client.es, index=args.index, query=query, size=1000, request_timeout=60):
+        doc = doc['_source']
+        pred = doc['meta'][args.question_tag]
+        if 'primary_label' in pred:
+            add_to_rollup(rollup_docs, doc['created_at'], doc['is_retweet'], args.question_tag, '', pred['primary_label'], label_val=pred.get('primary_label_val'))
+        for run_name, endpoint_pred in pred.get('endpoints', {}).items():
+            add_to_rollup(rollup_docs, doc['created_at'], doc['is_retweet'], args.question_tag, run_name, endpoint_pred['label'], label_val=endpoint_pred.get('label_val'))
+        num_docs += 1
+        if len(rollup_docs) >= args.batch_size:
+            es_client.update_rollup(args.index, rollup_docs)
+            rollup_docs = {}
+            logger.info(f'Processed {num_docs:,} documents...')
+    if len(rollup_docs) > 0:
+        es_client.update_rollup(args.index, rollup_docs)
+    logger.info(f'Added predictions of {num_docs:,} documents to index {es_client.rollup_index_name(args.index)}')
+
+def parse_args():
+    parser = ArgParseDefault(description='Backfill prediction rollup index')
+    parser.add_argument('--env', default='dev', choices=['dev', 'stg', 'prd'], help='Environment')
+    parser.add_argument('-i', '--index', required=True, type=str, help='Name of project index')
+    parser.add_argument('-q', '--question-tag', dest='question_tag', default='sentiment', type=str, help='Question tag')
+    parser.add_argument('-u', '--until', required=True, type=str, help='Only include tweets created before this date (Format: YYYY-mm-dd HH:MM:SS)')
+    parser.add_argument('--batch-size', dest='batch_size', default=10000, type=int, help='Number of rollup documents per update')
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,80 @@
+import sys
+sys.path.append('../web/')
+from utils import get_es_client, ArgParseDefault
+from elasticsearch import helpers as es_helpers
+from datetime import datetime, timedelta
+import logging
+import random
+import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-5.5s] [%(name)-12.12s]: %(message)s')
+logger = logging.getLogger(__name__)
+
+ANSWER_TAGS = ['positive', 'negative', 'neutral', 'undecided', 'irrelevant']
+
+def generate_docs(index_name, num_docs, question_tag):
+    start = datetime.utcnow() - timedelta(days=365)
+    for i in range(num_docs):
+        created_at = start + timedelta(seconds=random.randint(0, 365*24*3600))
+        yield {'_index': index_name, '_type': 'tweet', '_id': str(i), '_source': {
+            'created_at': created_at.strftime('%a %b %d %H:%M:%S +0000 %Y'),
+            'is_retweet': random.random() < 0.5,
+            'meta': {question_tag: {'primary_label': random.choice(ANSWER_TAGS)}}}}
+
+def get_predictions_sequential(es_client, index_name, question_tag, answer_tags, interval='month'):
+    """Previous implementation: one date histogram query per answer"""
+    field = f'meta.{question_tag}.primary_label'
+    predictions = {}
+    for answer_tag in answer_tags:
+        query_conditions = [{'range': {'created_at': {'gte': 'now-20y', 'lte': 'now'}}}, {'exists': {'field': 'is_retweet'}},
+                {'match_phrase': {field: answer_tag}}]
+        body = {'size': 0, 'aggs': {'prediction_agg': {'date_histogram': {'field': 'created_at', 'interval': interval, 'format': 'yyyy-MM-dd HH:mm:ss'}}},
+                'query': {'bool': {'must': query_conditions}}}
+        res = es_client.es.search(index=index_name, body=body, filter_path=['aggregations.prediction_agg'], request_timeout=60)
+        predictions[answer_tag] = res.get('aggregations', {}).get('prediction_agg', {}).get('buckets', [])
+    return predictions
+
+def timeit(f, num_runs):
+    durations = []
+    for _ in range(num_runs):
+        t_start = time.time()
+        res = f()
+        durations.append(time.time() - t_start)
+    return res, 1000*sum(durations)/num_runs
+
+def main(args):
+    es_client = get_es_client(env=args.env)
+    index_name = args.index
+    if es_client.es.indices.exists(index_name):
+        es_client.es.indices.delete(index_name)
+    es_client.es.indices.create(index_name, body={'mappings': {'tweet': {'properties': {'created_at': {'type': 'date', 'format': 'EEE MMM dd HH:mm:ss Z yyyy'}, 'is_retweet': {'type': 'boolean'}}}}})
+    logger.info(f'Indexing {args.num_docs:,} documents to index {index_name}...')
+    es_helpers.bulk(es_client.es, generate_docs(index_name, args.num_docs, args.question_tag))
+    es_client.es.indices.refresh(index_name)
+    answer_tags = ANSWER_TAGS[:args.num_answers]
+    try:
+        res_seq, t_seq = timeit(lambda: get_predictions_sequential(es_client, index_name, args.question_tag, answer_tags, interval=args.interval), args.num_runs)
+        res_single, t_single = timeit(lambda: es_client.get_predictions(index_name, args.question_tag, answer_tags, interval=args.interval), args.num_runs)
+        if res_seq != res_single:
+            logger.error('Results of both implementations differ!')
+        logger.info(f'{len(answer_tags)} answers, interval {args.interval}:')
+        logger.info(f'- one query per answer: {t_seq:.1f} ms')
+        logger.info(f'- single query: {t_single:.1f} ms ({t_seq/t_single:.1f}x)')
+    finally:
+        es_client.es.indices.delete(index_name)
+
+def parse_args():
+    parser = ArgParseDefault(description='Benchmark Elastic.get_predictions (single query) against one query per answer')
+    parser.add_argument('--env', default='dev', choices=['dev', 'stg', 'prd'], help='Environment (use a local Elasticsearch instance for dev)')
+    parser.add_argument('--index', default='benchmark_predictions', type=str, help='Name of temporary index')
+    parser.add_argument('--question-tag', dest='question_tag', default='sentiment', type=str, help='Question tag')
+    parser.add_argument('--num-docs', dest='num_docs', default=200000, type=int, help='Number of documents')
+    parser.add_argument('--num-answers', dest='num_answers', default=5, type=int, help='Number of answers')
+    parser.add_argument('--num-runs', dest='num_runs', default=10, type=int, help='Number of runs to average over')
+    parser.add_argument('--interval', default='day', type=str, help='Histogram interval')
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,58 @@
+import sys
+sys.path.append('../web/')
+from app.utils.priority_queue import RedisSet, RedisBitmapSet
+from utils import ArgParseDefault
+import logging
+import random
+import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-5.5s] [%(name)-12.12s]: %(message)s')
+logger = logging.getLogger(__name__)
+
+def used_memory(rset):
+    return rset._r.info('memory')['used_memory']
+
+def fill(rset, num_tweets, num_users, labels_per_tweet):
+    """Simulate annotators labelling tweets. Returns duration of the pipelined writes."""
+    users = [str(random.randint(1, 10**6)) for _ in range(num_users)]
+    offsets = {}
+    if rset.backend == 'bitmap':
+        # create offsets upfront (one script call per user) so that only pipelined commands are timed
+        offsets = {user_id: rset.offset(user_id, create=True) for user_id in users}
+    t_start = time.time()
+    pipe = rset._r.pipeline()
+    for i in range(num_tweets):
+        tweet_id = str(1250000000000000000 + i)
+        for user_id in random.sample(users, min(labels_per_tweet, num_users)):
+            if rset.backend == 'bitmap':
+                pipe.setbit(rset.key(tweet_id), offsets[user_id], 1)
+            else:
+                pipe.sadd(rset.key(tweet_id), user_id)
+        if i % 1000 == 0:
+            pipe.execute()
+    pipe.execute()
+    return time.time() - t_start
+
+def main(args):
+    backends = {'set': RedisSet, 'bitmap': RedisBitmapSet}
+    for backend, rset_class in backends.items():
+        rset = rset_class(args.project, namespace='benchmark')
+        rset.self_remove_all()
+        mem_before = used_memory(rset)
+        duration = fill(rset, args.num_tweets, args.num_users, args.labels_per_tweet)
+        mem_used = used_memory(rset) - mem_before
+        logger.info(f'{backend}: {mem_used/1024**2:.2f} MB ({mem_used/args.num_tweets:.1f} bytes per tweet), filled in {duration:.2f}s')
+        rset.self_remove_all()
+
+def parse_args():
+    parser = ArgParseDefault(description='Compare Redis memory of RedisSet and RedisBitmapSet (make sure REDIS_HOST points to a test instance)')
+    parser.add_argument('--project', default='benchmark_project', type=str, help='Project name used for keys')
+    parser.add_argument('--num-tweets', dest='num_tweets', default=50000, type=int, help='Number of tweets')
+    parser.add_argument('--num-users', dest='num_users', default=200, type=int, help='Number of annotators')
+    parser.add_argument('--labels-per-tweet', dest='labels_per_tweet', default=3, type=int, help='Number of users per tweet')
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
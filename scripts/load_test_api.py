@@ -0,0 +1,90 @@
+from utils import ArgParseDefault
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import requests
+import numpy as np
+import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)-5.5s] [%(name)-12.12s]: %(message)s')
+logger = logging.getLogger(__name__)
+
+def annotator_client(url, args, stop, latencies, errors):
+    """Requests new tweets like an annotator (measured)"""
+    session = requests.Session()
+    session.auth = args.auth
+    while not stop.is_set():
+        t_start = time.time()
+        try:
+            resp = session.get(f'{url}/tweet/new/{args.project}', params={'user_id': threading.get_ident()}, timeout=60)
+            resp.raise_for_status()
+        except requests.RequestException:
+            errors.append(1)
+        else:
+            latencies.append(time.time() - t_start)
+
+def dashboard_client(url, args, stop, counts):
+    """Requests aggregations like the dashboard (bypassing the result cache so each request hits Elasticsearch)"""
+    session = requests.Session()
+    session.auth = args.auth
+    session.headers.update({'X-Cache-Bypass': '1'})
+    requests_args = [
+            ('GET', f'{url}/data/all/{args.index}', {'json': {'interval': 'day', 'start_date': 'now-1y'}}),
+            ('POST', f'{url}/data/average_label_val/{args.index}', {'json': {'question_tag': args.question_tag, 'interval': 'hour', 'start_date': 'now-1y'}}),
+            ('GET', f'{url}/sentiment/geo', {'params': {'mode': 'grid', 'zoom': 3}})
+            ]
+    i = 0
+    while not stop.is_set():
+        method, endpoint, kwargs = requests_args[i % len(requests_args)]
+        try:
+            session.request(method, endpoint, timeout=120, **kwargs)
+        except requests.RequestException:
+            pass
+        counts.append(1)
+        i += 1
+
+def run(args, dashboard_concurrency):
+    url = args.url.rstrip('/')
+    stop = threading.Event()
+    latencies = []
+    errors = []
+    dashboard_counts = []
+    with ThreadPoolExecutor(max_workers=args.concurrency + dashboard_concurrency) as executor:
+        for _ in range(dashboard_concurrency):
+            executor.submit(dashboard_client, url, args, stop, dashboard_counts)
+        for _ in range(args.concurrency):
+            executor.submit(annotator_client, url, args, stop, latencies, errors)
+        time.sleep(args.duration)
+        stop.set()
+    latencies = 1000*np.array(latencies)
+    if len(latencies) == 0:
+        logger.error('No successful requests.')
+        return
+    logger.info(f'Dashboard load: {dashboard_concurrency} clients ({len(dashboard_counts):,} requests)')
+    logger.info(f'- /tweet/new: {len(latencies)/args.duration:.1f} requests/s, p50 {np.percentile(latencies, 50):.0f} ms, '
+            f'p99 {np.percentile(latencies, 99):.0f} ms, {len(errors):,} errors')
+
+def main(args):
+    logger.info(f'Load testing {args.url} with {args.concurrency} annotator clients for {args.duration}s...')
+    for dashboard_concurrency in sorted(set([0, args.dashboard_concurrency])):
+        run(args, dashboard_concurrency)
+
+def parse_args():
+    parser = ArgParseDefault(description='Load test /tweet/new with and without concurrent dashboard requests. Run once against each '
+            'gunicorn worker class (GUNICORN_WORKER_CLASS=sync/gevent) to compare them.')
+    parser.add_argument('--url', default='http://localhost:8000', type=str, help='API base URL')
+    parser.add_argument('--username', default=None, type=str, help='Basic auth username')
+    parser.add_argument('--password', default=None, type=str, help='Basic auth password')
+    parser.add_argument('--project', default='vaccine-sentiment-tracking', type=str, help='Project to request tweets for')
+    parser.add_argument('--index', default='project_vaccine_sentiment', type=str, help='Index to run dashboard aggregations on')
+    parser.add_argument('--question-tag', dest='question_tag', default='sentiment', type=str, help='Question tag')
+    parser.add_argument('--concurrency', default=10, type=int, help='Number of concurrent annotator clients')
+    parser.add_argument('--dashboard-concurrency', dest='dashboard_concurrency', default=4, type=int, help='Number of concurrent dashboard clients')
+    parser.add_argument('--duration', default=30, type=int, help='Duration of each run in seconds')
+    args = parser.parse_args()
+    args.auth = (args.username, args.password) if args.username is not None else None
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -5,6 +5,7 @@ from app.connections.elastic import Elastic
 import argparse
 import logging
 import json
+from datetime import datetime, timezone
 
 logger = logging.getLogger(__name__)
 
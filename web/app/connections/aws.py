@@ -0,0 +1,40 @@
+import boto3
+import botocore.config
+from boto3.s3.transfer import TransferConfig
+import logging
+import os
+import threading
+from app.settings import Config
+
+logger = logging.getLogger(__name__)
+
+CLIENTS = {}
+LOCK = threading.Lock()
+
+def get_client(service_name):
+    """Process-wide cached boto3 client (clients are thread-safe, but should not be shared across forked processes).
+    Clients are therefore cached by process id, so that each Celery prefork child creates its own client on first use."""
+    key = (os.getpid(), service_name)
+    client = CLIENTS.get(key)
+    if client is None:
+        with LOCK:
+            client = CLIENTS.get(key)
+            if client is None:
+                client = _create_client(service_name)
+                CLIENTS[key] = client
+    return client
+
+def get_transfer_config():
+    config = Config()
+    return TransferConfig(multipart_threshold=config.S3_MULTIPART_THRESHOLD, max_concurrency=config.S3_MAX_CONCURRENCY)
+
+def _create_client(service_name):
+    config = Config()
+    retries = {'max_attempts': config.AWS_MAX_ATTEMPTS}
+    if config.AWS_RETRY_MODE != '':
+        retries['mode'] = config.AWS_RETRY_MODE
+    client_config = botocore.config.Config(max_pool_connections=config.AWS_MAX_POOL_CONNECTIONS, retries=retries)
+    # boto3 sessions are not thread-safe, use a separate session for each client
+    session = boto3.session.Session(region_name=config.AWS_REGION)
+    logger.debug(f'Creating new {service_name} client in process {os.getpid()}')
+    return session.client(service_name, config=client_config)
@@ -3,22 +3,54 @@ from elasticsearch import helpers as es_helpers
 import json
 import os
 import logging
-from datetime import datetime, timezone
+import threading
+import requests
+import re
+import time
+import itertools
+import calendar
+from datetime import datetime, timezone, timedelta
 from flask import current_app
-from flask import _app_ctx_stack as stack
 import glob
 from aws_requests_auth.aws_auth import AWSRequestsAuth
+from app.settings import Config
 from helpers import report_error
+from app.utils.metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+ROLLUP_INTERVALS = ['hour', 'day', 'week', 'month', 'quarter', 'year']
+ROLLUP_TEMPLATE = 'rollup'
+ROLLUP_UPDATE_SCRIPT = 'ctx._source.count += params.count; ctx._source.label_val_sum += params.label_val_sum; ctx._source.label_val_count += params.label_val_count'
+
+# Monthly partitions of project indices are named {index_name}_{YYYY_MM}
+PARTITION_FORMAT = '%Y_%m'
+PARTITION_SUFFIX_REGEX = r'_(\d{4})_(\d{2})$'
+PARTITION_GRACE_MONTHS = 2  # partitions are only made read-only once they are this many months old (late predictions/updates)
+CUTOVER_META_KEY = 'partitioned_since'  # mapping meta field of the legacy index holding the time partitioning was enabled
+INDICES_CACHE_TTL = 60  # seconds
+TEMPLATE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..' ,'config', 'es_templates'))
+
+# Clients are shared by all Elastic instances of a process (keyed by pid, host and port)
+CLIENTS = {}
+LOCK = threading.Lock()
+INDICES_CACHE = {}
+
+class PooledRequestsHttpConnection(elasticsearch.RequestsHttpConnection):
+    """RequestsHttpConnection (used for signed requests) with a configurable connection pool size"""
+
+    def __init__(self, *args, maxsize=10, **kwargs):
+        super().__init__(*args, **kwargs)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
 class Elastic():
     """Interaction with Elasticsearch
     """
 
     def __init__(self, app=None, logger=None, local_config=None):
         self.app = app
-        self.connection = None # only used outside of application context
         self.config = {}
         self.local_config = local_config
         self.default_template_name = 'project' # default template name when creating new index
@@ -26,32 +58,27 @@ class Elastic():
             self.init_app(app)
 
     def init_app(self, app):
-        if hasattr(app, 'teardown_appcontext'):
-            app.teardown_appcontext(self.teardown)
-        else:
-            app.teardown_request(self.teardown)
-
-    def teardown(self, exception):
-        ctx = stack.top
-        if hasattr(ctx, 'elasticsearch'):
-            ctx.elasticsearch = None
+        """Called from application factory"""
+        pass
 
     @property
     def es(self):
-        ctx = stack.top
-        if ctx is not None:
-            if not hasattr(ctx, 'elasticsearch'):
-                ctx.elasticsearch = self._connect()
-            return ctx.elasticsearch
-        else:
-            # Running outside of application context (e.g. by using a script)
-            if self.connection is None:
-                self.connection = self._connect()
-            return self.connection
-
-    def _connect(self):
+        """Process-wide client (thread-safe), reused across requests, tasks and scripts"""
+        if len(self.config) == 0:
+            self._load_config()
+        key = (os.getpid(), self.config['ELASTICSEARCH_HOST'], str(self.config['ELASTICSEARCH_PORT']))
+        client = CLIENTS.get(key)
+        if client is None:
+            with LOCK:
+                client = CLIENTS.get(key)
+                if client is None:
+                    client = self._connect()
+                    CLIENTS[key] = client
+        return client
+
+    def _load_config(self):
         try:
-            self.config = current_app.config
+            _config = current_app.config
         except RuntimeError:
             logger.debug('No app context found!')
             if self.local_config is not None:
@@ -59,19 +86,30 @@ class Elastic():
                 _config = self.local_config
             else:
                 _config = os.environ
-            self.config['ELASTICSEARCH_HOST'] = _config.get('ELASTICSEARCH_HOST', 'localhost')
-            self.config['ELASTICSEARCH_PORT'] = _config.get('ELASTICSEARCH_PORT', 9200)
-            if  self.config['ELASTICSEARCH_HOST'] in ['localhost', 'elasticsearch']:
-                # Access Elasticsearch locally
-                return elasticsearch.Elasticsearch(["{}:{}".format(self.config['ELASTICSEARCH_HOST'], self.config['ELASTICSEARCH_PORT'])])
-            self.config['AWS_ACCESS_KEY_ID'] = _config.get('AWS_ACCESS_KEY_ID')
-            self.config['AWS_SECRET_ACCESS_KEY'] = _config.get('AWS_SECRET_ACCESS_KEY')
-            self.config['AWS_REGION'] = _config.get('AWS_REGION')
+        config = {}
+        config['ELASTICSEARCH_HOST'] = _config.get('ELASTICSEARCH_HOST') or 'localhost'
+        config['ELASTICSEARCH_PORT'] = _config.get('ELASTICSEARCH_PORT') or 9200
+        config['AWS_ACCESS_KEY_ID'] = _config.get('AWS_ACCESS_KEY_ID')
+        config['AWS_SECRET_ACCESS_KEY'] = _config.get('AWS_SECRET_ACCESS_KEY')
+        config['AWS_REGION'] = _config.get('AWS_REGION')
+        self.config = config
+
+    def _connect(self):
+        settings = Config()
+        kwargs = {'maxsize': settings.ELASTICSEARCH_MAXSIZE, 'timeout': settings.ELASTICSEARCH_TIMEOUT,
+                'retry_on_timeout': False, 'max_retries': settings.ELASTICSEARCH_MAX_RETRIES}
+        if settings.ELASTICSEARCH_SNIFF == '1':
+            # Note: Sniffing is not supported by the AWS Elasticsearch service
+            kwargs.update({'sniff_on_start': True, 'sniff_on_connection_fail': True, 'sniffer_timeout': 60})
+        logger.info('Creating new Elasticsearch client for host {} in process {}'.format(self.config['ELASTICSEARCH_HOST'], os.getpid()))
+        if self.config['ELASTICSEARCH_HOST'] in ['localhost', 'elasticsearch']:
+            # Access Elasticsearch locally
+            return elasticsearch.Elasticsearch(["{}:{}".format(self.config['ELASTICSEARCH_HOST'], self.config['ELASTICSEARCH_PORT'])], **kwargs)
         auth = AWSRequestsAuth(aws_access_key=self.config['AWS_ACCESS_KEY_ID'], aws_secret_access_key=self.config['AWS_SECRET_ACCESS_KEY'],
                 aws_host=self.config['ELASTICSEARCH_HOST'], aws_region=self.config['AWS_REGION'], aws_service='es')
         return elasticsearch.Elasticsearch(host=self.config['ELASTICSEARCH_HOST'], port=int(self.config['ELASTICSEARCH_PORT']),
-                connection_class=elasticsearch.RequestsHttpConnection,
-                http_auth=auth)
+                connection_class=PooledRequestsHttpConnection,
+                http_auth=auth, **kwargs)
 
     def test_connection(self):
         """test_connection"""
@@ -91,7 +129,7 @@ class Elastic():
         :tweet: tweet to index
         """
         try:
-            self.es.index(index=index_name, id=tweet['id'], doc_type='tweet', body=tweet, op_type='create')
+            self.es.index(index=self.write_index(index_name, created_at=tweet.get('created_at')), id=tweet['id'], doc_type='tweet', body=tweet, op_type='create')
         except elasticsearch.ConflictError as e:
             # This usually happens when a document with the same ID already exists.
             logger.warning('Conflict Error')
@@ -100,24 +138,36 @@ class Elastic():
         else:
             logger.debug('Tweet with id {} sent to index {}'.format(tweet['id'], index_name))
 
-    def bulk_actions_in_batches(self, actions, batch_size=1000):
+    def bulk_actions_in_batches(self, actions, batch_size=1000, not_applied=None):
+        """Process actions in batches (one bulk request each). Returns False if a batch failed, in which case actions which were
+        certainly not applied (failed items of the batch and all following batches) are appended to the list not_applied (if given).
+        Note that if a request fails as a whole (e.g. times out) it is unknown whether its actions were applied."""
         num_actions = len(actions)
         logger.info(f'Processing {num_actions:,} bulk actions...')
         for i in range(0, num_actions, batch_size):
-            num_actions_in_batch = len(actions[i:(i+batch_size)])
+            batch = actions[i:(i+batch_size)]
             try:
-                self.bulk_action(actions[i:(i+batch_size)])
-            except:
-                logger.error(f'Elasticsearch failed to process batch of {num_actions_in_batch:,} actions')
+                with metrics.timer('es_bulk_batch_duration_seconds'):
+                    self.bulk_action(batch, chunk_size=len(batch))
+            except Exception as e:
+                logger.error(f'Elasticsearch failed to process batch of {len(batch):,} actions')
                 report_error(logger, exception=True)
+                if not_applied is not None:
+                    if isinstance(e, es_helpers.BulkIndexError):
+                        failed = set()
+                        for error in e.errors:
+                            for item in error.values():
+                                failed.add((item.get('_index'), item.get('_id')))
+                        not_applied.extend([a for a in batch if (a.get('_index'), a.get('_id')) in failed])
+                    not_applied.extend(actions[(i+batch_size):])
                 return False
             else:
-                logger.info(f'Successfully processed batch of {num_actions_in_batch:,} actions')
+                logger.info(f'Successfully processed batch of {len(batch):,} actions')
         return True
 
-    def bulk_action(self, actions):
+    def bulk_action(self, actions, chunk_size=500):
         logger.info('Bulk operation...')
-        es_helpers.bulk(self.es, actions, timeout='60s')
+        es_helpers.bulk(self.es, actions, chunk_size=chunk_size, timeout='60s')
 
     def put_template(self, template_path, template_name):
         """Put template to ES
@@ -165,14 +215,15 @@ class Elastic():
     def update_es_indices(self, indices):
         current_indices = self.list_indices()
         for idx in indices:
-            if idx not in current_indices:
+            if self.partitioned:
+                self.manage_partitions(idx, optimize=False)
+            elif idx not in current_indices:
                 self.create_index(idx)
 
     def add_all_templates(self):
         """Add missing templates from es_templates folder"""
         # add templates
-        template_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..' ,'config', 'es_templates'))
-        template_files = glob.glob(os.path.join(template_dir, '*.json'))
+        template_files = glob.glob(os.path.join(TEMPLATE_DIR, '*.json'))
         for template_file in template_files:
             template_name = os.path.basename(template_file).split('.json')[0]
             res = self.put_template(template_file, template_name)
@@ -204,12 +255,31 @@ class Elastic():
         """Refreshes all indices, making new documents visible to search"""
         self.es.indices.refresh()
 
+    def search(self, **kwargs):
+        """Search which is retried on timeouts. The client itself doesn't retry timeouts, since a timed out write (e.g. a bulk
+        request incrementing rollups) may still have been applied, searches however are idempotent."""
+        return self._retry_on_timeout(self.es.search, **kwargs)
+
+    def count(self, **kwargs):
+        """Count which is retried on timeouts"""
+        return self._retry_on_timeout(self.es.count, **kwargs)
+
+    def _retry_on_timeout(self, func, **kwargs):
+        settings = Config()
+        for attempt in range(settings.ELASTICSEARCH_MAX_RETRIES + 1):
+            try:
+                return func(**kwargs)
+            except elasticsearch.exceptions.ConnectionTimeout:
+                if attempt == settings.ELASTICSEARCH_MAX_RETRIES:
+                    raise
+                logger.warning(f'Elasticsearch request timed out, retrying ({attempt + 1}/{settings.ELASTICSEARCH_MAX_RETRIES})...')
+
      #################################################################
      # Trending tweets/topics
     def get_matching_ids_for_query(self, index_name, query, ids, size=10):
         body =  {'query': {'bool': {'must': [{'match_phrase': {'text': query}}, {'ids': {'values': ids}}]}}}
         body['_source'] = False
-        res = self.es.search(index=index_name, body=body, size=size)
+        res = self.search(index=self.read_indices(index_name), body=body, size=size)
         res = [hit['_id'] for hit in res['hits']['hits']]
         return res
 
@@ -225,7 +295,7 @@ class Elastic():
         query = {'range': {'bucket_time': {'gte': s_date, 'lte': e_date}}}
         full_query['query'] = query
         # run query
-        res = self.es.search(index=index_name, body=full_query, filter_path=['aggregations'])
+        res = self.search(index=index_name, body=full_query, filter_path=['aggregations'])
         try:
             res = res['aggregations']['by_term']['buckets']
         except KeyError:
@@ -255,13 +325,50 @@ class Elastic():
     #################################################################
     # Sentiment data
     def get_geo_sentiment(self, index_name, **options):
+        start_date = options.get('start_date', 'now-20y')
+        end_date = options.get('end_date', 'now')
+        body = self._geo_sentiment_query(**options)
+        body['size'] = options.get('limit', 10000)
+        res = self.search(index=self.read_indices(index_name, start_date, end_date), body=body, filter_path=['hits.hits._source'])
+        if keys_exist(res, 'hits', 'hits'):
+            return res['hits']['hits']
+        else:
+            return []
+
+    def iter_geo_sentiment(self, index_name, batch_size=1000, **options):
+        """Same as get_geo_sentiment but yields hits as they are scrolled through (instead of loading all hits into memory)"""
+        start_date = options.get('start_date', 'now-20y')
+        end_date = options.get('end_date', 'now')
+        body = self._geo_sentiment_query(**options)
+        hits = es_helpers.scan(self.es, index=self.read_indices(index_name, start_date, end_date), query=body, size=batch_size,
+                preserve_order=False)
+        for hit in itertools.islice(hits, options.get('limit', 10000)):
+            yield {'_source': hit['_source']}
+
+    def _geo_sentiment_query(self, **options):
+        s_date, e_date = self.parse_dates(options.get('start_date', 'now-20y'), options.get('end_date', 'now'))
+        field = 'meta.sentiment.{}.label_val'.format(options.get('model', 'fasttext_v1'))
+        return {
+                '_source': ['place.average_location', field],
+                'query': {
+                    'bool': {
+                        'must': [
+                            {'exists': {'field': 'place.average_location'}},
+                            {'exists': {'field': field}},
+                            {'range': {'created_at': {'gte': s_date, 'lte': e_date}}}
+                            ]
+                        }
+                    }
+                }
+
+    def get_geo_sentiment_grid(self, index_name, precision=3, **options):
+        """Aggregate geo sentiment on a geohash grid of given precision (1-12). Returns count, mean label value and centroid per cell."""
         start_date = options.get('start_date', 'now-20y')
         end_date = options.get('end_date', 'now')
         s_date, e_date = self.parse_dates(start_date, end_date)
         field = 'meta.sentiment.{}.label_val'.format(options.get('model', 'fasttext_v1'))
         body = {
-                'size': options.get('limit', 10000),
-                '_source': ['place.average_location', field],
+                'size': 0,
                 'query': {
                     'bool': {
                         'must': [
@@ -270,17 +377,36 @@ class Elastic():
                             {'range': {'created_at': {'gte': s_date, 'lte': e_date}}}
                             ]
                         }
+                    },
+                'aggs': {
+                    'grid': {
+                        'geohash_grid': {
+                            'field': 'place.average_location',
+                            'precision': precision,
+                            'size': options.get('limit', 10000)
+                            },
+                        'aggs': {
+                            'mean_label_val': {'avg': {'field': field}},
+                            'centroid': {'geo_centroid': {'field': 'place.average_location'}}
+                            }
+                        }
                     }
                 }
-        res = self.es.search(index=index_name, body=body, filter_path=['hits.hits._source'])
-        if keys_exist(res, 'hits', 'hits'):
-            return res['hits']['hits']
-        else:
+        res = self.search(index=self.read_indices(index_name, start_date, end_date), body=body, filter_path=['aggregations.grid.buckets'], request_timeout=60)
+        if not keys_exist(res, 'aggregations', 'grid', 'buckets'):
             return []
+        cells = []
+        for bucket in res['aggregations']['grid']['buckets']:
+            location = bucket['centroid']['location']
+            cells.append({'geohash': bucket['key'], 'count': bucket['doc_count'], 'mean_label_val': bucket['mean_label_val']['value'],
+                'location': [location['lon'], location['lat']]})
+        return cells
 
     #################################################################
     # Data
     def get_predictions(self, index_name, question_tag, answer_tags, **options):
+        if self.use_rollup(index_name, **options):
+            return self.get_predictions_from_rollup(index_name, question_tag, answer_tags, **options)
         start_date = options.get('start_date', 'now-20y')
         end_date = options.get('end_date', 'now')
         run_name = options.get('run_name', '')
@@ -292,38 +418,48 @@ class Elastic():
         query_conditions.append({'exists': {'field': 'is_retweet'}})
         # Include retweets condition
         if not include_retweets:
-            query_conditions.append({'field': {'is_retweet': False}})
-        predictions = {}
+            query_conditions.append({'term': {'is_retweet': False}})
         if run_name == '':
             # if run_name is not provided, fall back to primary label
             field = f'meta.{question_tag}.primary_label'
         else:
             field = f'meta.{question_tag}.endpoints.{run_name}.label'
-        query_conditions.append({'match_phrase': {field: ''}})
-        for answer_tag in answer_tags:
-            query_conditions[-1]['match_phrase'][field] = answer_tag
-            # full query
-            body = {
-                    'size': 0,
-                    'aggs': {
-                        'prediction_agg': {
-                            'date_histogram': {
-                                'field': 'created_at',
-                                'interval': options.get('interval', 'month'),
-                                'format': 'yyyy-MM-dd HH:mm:ss'
+        # count all answers in a single query (one filter sub-aggregation per answer under the date histogram)
+        answer_filters = {answer_tag: {'match_phrase': {field: answer_tag}} for answer_tag in answer_tags}
+        query_conditions.append({'bool': {'should': list(answer_filters.values()), 'minimum_should_match': 1}})
+        body = {
+                'size': 0,
+                'aggs': {
+                    'prediction_agg': {
+                        'date_histogram': {
+                            'field': 'created_at',
+                            'interval': options.get('interval', 'month'),
+                            'format': 'yyyy-MM-dd HH:mm:ss'
+                            },
+                        'aggs': {
+                            'answers': {
+                                'filters': {'filters': answer_filters}
                                 }
                             }
-                        },
-                    'query': {'bool': {'must': query_conditions}}
-                    }
-            res = self.es.search(index=index_name, body=body, filter_path=['aggregations.prediction_agg'], request_timeout=60)
-            if keys_exist(res, 'aggregations', 'prediction_agg', 'buckets'):
-                predictions[answer_tag] = res['aggregations']['prediction_agg']['buckets']
-            else:
-                predictions[answer_tag] = []
+                        }
+                    },
+                'query': {'bool': {'must': query_conditions}}
+                }
+        res = self.search(index=self.read_indices(index_name, start_date, end_date), body=body, filter_path=['aggregations.prediction_agg'], request_timeout=60)
+        predictions = {answer_tag: [] for answer_tag in answer_tags}
+        if keys_exist(res, 'aggregations', 'prediction_agg', 'buckets'):
+            for bucket in res['aggregations']['prediction_agg']['buckets']:
+                for answer_tag in answer_tags:
+                    doc_count = bucket['answers']['buckets'][answer_tag]['doc_count']
+                    predictions[answer_tag].append({'key_as_string': bucket['key_as_string'], 'key': bucket['key'], 'doc_count': doc_count})
+        # histogram of each answer only spans the range of its own documents
+        for answer_tag, buckets in predictions.items():
+            predictions[answer_tag] = trim_empty_buckets(buckets)
         return predictions
 
     def get_avg_label_val(self, index_name, question_tag, with_moving_average=True, **options):
+        if self.use_rollup(index_name, **options):
+            return self.get_avg_label_val_from_rollup(index_name, question_tag, with_moving_average=with_moving_average, **options)
         start_date = options.get('start_date', 'now-20y')
         end_date = options.get('end_date', 'now')
         run_name = options.get('run_name', '')
@@ -337,7 +473,7 @@ class Elastic():
         query_conditions.append({'exists': {'field': 'is_retweet'}})
         # Include retweets condition
         if not include_retweets:
-            query_conditions.append({'field': {'is_retweet': False}})
+            query_conditions.append({'term': {'is_retweet': False}})
         predictions = {}
         if run_name == '':
             # if run_name is not provided, fall back to primary label
@@ -372,7 +508,7 @@ class Elastic():
                         'window': moving_average_window_size
                         }
                     }
-        res = self.es.search(index=index_name, body=body, filter_path=['aggregations.hist_agg.buckets'], request_timeout=60)
+        res = self.search(index=self.read_indices(index_name, start_date, end_date), body=body, filter_path=['aggregations.hist_agg.buckets'], request_timeout=60)
         if keys_exist(res, 'aggregations', 'hist_agg', 'buckets'):
             return res['aggregations']['hist_agg']['buckets']
         return []
@@ -403,18 +539,293 @@ class Elastic():
                     },
                 'query': query
                 }
-        res = self.es.search(index=index_name, body=body, filter_path=['aggregations.sentiment'], request_timeout=60)
+        res = self.search(index=self.read_indices(index_name, start_date, end_date), body=body, filter_path=['aggregations.sentiment'], request_timeout=60)
         if keys_exist(res, 'aggregations', 'sentiment', 'buckets'):
             return res['aggregations']['sentiment']['buckets']
         else:
             return []
 
 
+    #################################################################
+    # Prediction rollup
+    def rollup_index_name(self, index_name):
+        return f'rollup_{index_name}'
+
+    def use_rollup(self, index_name, **options):
+        """Queries with an interval of an hour or more can be answered from the rollup index (if enabled and present)"""
+        use_rollup = options.get('use_rollup', Config().ELASTICSEARCH_USE_ROLLUP == '1')
+        if not use_rollup or options.get('interval', 'month') not in ROLLUP_INTERVALS:
+            return False
+        return self._index_exists_cached(self.rollup_index_name(index_name))
+
+    def ensure_rollup_template(self):
+        """Install rollup template if missing (checked once per process). Rollup indices are created by the first update, without
+        the template they would get a dynamic mapping (in which e.g. hour is not a date)."""
+        key = ('rollup_template', os.getpid())
+        if key not in INDICES_CACHE:
+            if not self.es.indices.exists_template(ROLLUP_TEMPLATE):
+                self.put_template(os.path.join(TEMPLATE_DIR, f'{ROLLUP_TEMPLATE}.json'), ROLLUP_TEMPLATE)
+            INDICES_CACHE[key] = True
+
+    def update_rollup(self, index_name, rollup_docs, not_applied=None):
+        """Increment counts of rollup documents (dict of document id -> document, see add_to_rollup). On failure, ids of documents
+        which were certainly not updated are appended to the list not_applied (if given)."""
+        self.ensure_rollup_template()
+        actions = []
+        for _id, doc in rollup_docs.items():
+            actions.append({
+                '_id': _id,
+                '_type': '_doc',
+                '_op_type': 'update',
+                '_index': self.rollup_index_name(index_name),
+                '_source': {
+                    'script': {
+                        'source': ROLLUP_UPDATE_SCRIPT,
+                        'lang': 'painless',
+                        'params': {k: doc[k] for k in ['count', 'label_val_sum', 'label_val_count']}
+                        },
+                    'upsert': doc
+                    }
+                })
+        failed_actions = []
+        success = self.bulk_actions_in_batches(actions, not_applied=failed_actions)
+        if not_applied is not None:
+            not_applied.extend([action['_id'] for action in failed_actions])
+        return success
+
+    def get_predictions_from_rollup(self, index_name, question_tag, answer_tags, **options):
+        """Same as get_predictions (at hourly resolution of start/end dates) but based on the rollup index"""
+        query = self._rollup_query(question_tag, labels=answer_tags, **options)
+        body = {
+                'size': 0,
+                'aggs': {
+                    'prediction_agg': {
+                        'date_histogram': {
+                            'field': 'hour',
+                            'interval': options.get('interval', 'month'),
+                            'format': 'yyyy-MM-dd HH:mm:ss'
+                            },
+                        'aggs': {
+                            'answers': {
+                                'terms': {'field': 'label', 'size': len(answer_tags)},
+                                'aggs': {'count': {'sum': {'field': 'count'}}}
+                                }
+                            }
+                        }
+                    },
+                'query': query
+                }
+        res = self.search(index=self.rollup_index_name(index_name), body=body, filter_path=['aggregations.prediction_agg'], request_timeout=60)
+        predictions = {answer_tag: [] for answer_tag in answer_tags}
+        if keys_exist(res, 'aggregations', 'prediction_agg', 'buckets'):
+            for bucket in res['aggregations']['prediction_agg']['buckets']:
+                counts = {b['key']: int(b['count']['value']) for b in bucket['answers']['buckets']}
+                for answer_tag in answer_tags:
+                    predictions[answer_tag].append({'key_as_string': bucket['key_as_string'], 'key': bucket['key'], 'doc_count': counts.get(answer_tag, 0)})
+        for answer_tag, buckets in predictions.items():
+            predictions[answer_tag] = trim_empty_buckets(buckets)
+        return predictions
+
+    def get_avg_label_val_from_rollup(self, index_name, question_tag, with_moving_average=True, **options):
+        """Same as get_avg_label_val (at hourly resolution of start/end dates) but based on the rollup index"""
+        query = self._rollup_query(question_tag, **options)
+        body = {
+                'size': 0,
+                'aggs': {
+                    'hist_agg': {
+                        'date_histogram': {
+                            'field': 'hour',
+                            'interval': options.get('interval', 'month'),
+                            'format': 'yyyy-MM-dd HH:mm:ss'
+                            },
+                        'aggs': {
+                            'count': {'sum': {'field': 'count'}},
+                            'label_val_sum': {'sum': {'field': 'label_val_sum'}},
+                            'label_val_count': {'sum': {'field': 'label_val_count'}},
+                            'mean_label_val': {
+                                'bucket_script': {
+                                    'buckets_path': {'label_val_sum': 'label_val_sum', 'label_val_count': 'label_val_count'},
+                                    'script': 'params.label_val_count > 0 ? params.label_val_sum / params.label_val_count : null'
+                                    }
+                                }
+                            }
+                        }
+                    },
+                'query': query
+                }
+        if with_moving_average:
+            body['aggs']['hist_agg']['aggs']['mean_label_val_moving_average'] = {
+                    'moving_avg': {
+                        'buckets_path': 'mean_label_val',
+                        'window': options.get('moving_average_window_size', 10)
+                        }
+                    }
+        res = self.search(index=self.rollup_index_name(index_name), body=body, filter_path=['aggregations.hist_agg.buckets'], request_timeout=60)
+        if not keys_exist(res, 'aggregations', 'hist_agg', 'buckets'):
+            return []
+        buckets = res['aggregations']['hist_agg']['buckets']
+        for bucket in buckets:
+            # same fields as raw aggregation
+            bucket['doc_count'] = int(bucket.pop('count')['value'])
+            bucket.pop('label_val_sum')
+            bucket.pop('label_val_count')
+            if 'mean_label_val' not in bucket:
+                bucket['mean_label_val'] = {'value': None}
+        return buckets
+
+    def _rollup_query(self, question_tag, labels=None, **options):
+        start_date = options.get('start_date', 'now-20y')
+        end_date = options.get('end_date', 'now')
+        conditions = [
+                {'range': {'hour': {'gte': start_date, 'lte': end_date}}},
+                {'term': {'question_tag': question_tag}},
+                {'term': {'run_name': options.get('run_name', '')}}
+                ]
+        if not options.get('include_retweets', True):
+            conditions.append({'term': {'is_retweet': False}})
+        if labels is not None:
+            conditions.append({'terms': {'label': labels}})
+        return {'bool': {'filter': conditions}}
+
+    #################################################################
+    # Partitions
+    @property
+    def partitioned(self):
+        return Config().ELASTICSEARCH_PARTITIONED == '1'
+
+    def partition_name(self, index_name, date):
+        return '{}_{}'.format(index_name, date.strftime(PARTITION_FORMAT))
+
+    def read_alias(self, index_name):
+        return f'{index_name}_read'
+
+    def list_partitions(self, index_name, use_cache=False):
+        regex = re.compile(re.escape(index_name) + PARTITION_SUFFIX_REGEX)
+        indices = self._list_indices_cached() if use_cache else self.list_indices()
+        return sorted([i for i in indices if regex.match(i)])
+
+    def write_index(self, index_name, created_at=None):
+        """Index to write a document to. If partitioning is enabled this is the monthly partition of created_at (Twitter date format),
+        which is created if missing."""
+        if not self.partitioned:
+            return index_name
+        if created_at is None:
+            date = datetime.utcnow()
+        else:
+            date = datetime.strptime(created_at, '%a %b %d %H:%M:%S %z %Y').astimezone(timezone.utc)
+        partition = self.partition_name(index_name, date)
+        if partition not in self._list_indices_cached():
+            self.create_partition(index_name, partition)
+        return partition
+
+    def read_indices(self, index_name, start_date=None, end_date=None):
+        """Indices to search for documents created between start_date and end_date ('now-*' or '%Y-%m-%d %H:%M:%S', None for unbounded).
+        If partitioning is enabled only overlapping partitions (and the unpartitioned legacy index for dates before partitioning was enabled) are returned."""
+        if not self.partitioned:
+            return index_name
+        partitions = self.list_partitions(index_name, use_cache=True)
+        if len(partitions) == 0:
+            return index_name
+        start_date = resolve_date(start_date)
+        end_date = resolve_date(end_date)
+        indices = []
+        for partition in partitions:
+            if start_date is not None and is_partition_before(partition, start_date):
+                continue
+            if end_date is not None and partition > self.partition_name(index_name, end_date):
+                continue
+            indices.append(partition)
+        if index_name in self._list_indices_cached():
+            # legacy index holds all data written before partitioning was enabled (which may include dates of the first partitions)
+            cutover = self.partitioning_cutover(index_name)
+            if start_date is None or cutover is None or start_date < cutover:
+                indices.append(index_name)
+        if len(indices) == 0:
+            # searching an empty list of indices would search all indices
+            return partitions[-1]
+        return indices
+
+    def create_partition(self, index_name, partition):
+        """Create partition (if missing). When the first partition of an existing legacy index is created, the cutover time is recorded."""
+        existing_indices = self.list_indices()
+        if partition in existing_indices:
+            INDICES_CACHE.pop(('indices', os.getpid()), None)
+            return
+        if index_name in existing_indices and self.partitioning_cutover(index_name, use_cache=False) is None:
+            self.set_partitioning_cutover(index_name, datetime.utcnow())
+        try:
+            self.create_index(partition)
+        except elasticsearch.exceptions.RequestError as e:
+            # partition was created concurrently
+            if e.error != 'resource_already_exists_exception':
+                raise
+        INDICES_CACHE.pop(('indices', os.getpid()), None)
+
+    def partitioning_cutover(self, index_name, use_cache=True):
+        """Time (UTC) partitioning was enabled for a legacy index (None if not recorded)"""
+        key = ('cutover', os.getpid(), index_name)
+        if not use_cache or key not in INDICES_CACHE or time.time() - INDICES_CACHE[key][0] > INDICES_CACHE_TTL:
+            cutover = None
+            mappings = self.es.indices.get_mapping(index=index_name, ignore=404).get(index_name, {}).get('mappings', {})
+            for mapping in mappings.values():
+                if CUTOVER_META_KEY in mapping.get('_meta', {}):
+                    cutover = datetime.strptime(mapping['_meta'][CUTOVER_META_KEY], '%Y-%m-%d %H:%M:%S')
+            INDICES_CACHE[key] = (time.time(), cutover)
+        return INDICES_CACHE[key][1]
+
+    def set_partitioning_cutover(self, index_name, date):
+        self.es.indices.put_mapping(index=index_name, doc_type='tweet', body={'_meta': {CUTOVER_META_KEY: date.strftime('%Y-%m-%d %H:%M:%S')}})
+        INDICES_CACHE[('cutover', os.getpid(), index_name)] = (time.time(), date)
+        logger.info(f'Recorded partitioning cutover of index {index_name} at {date}')
+
+    def manage_partitions(self, index_name, optimize=True):
+        """Create partitions for the current and next month and point the read alias to all partitions (including the legacy index).
+        Partitions older than PARTITION_GRACE_MONTHS months are force-merged and made read-only."""
+        now = datetime.utcnow()
+        current_partition = self.partition_name(index_name, now)
+        next_partition = self.partition_name(index_name, add_months(now, 1))
+        for partition in [current_partition, next_partition]:
+            self.create_partition(index_name, partition)
+        partitions = self.list_partitions(index_name)
+        # update alias
+        read_alias = self.read_alias(index_name)
+        actions = [{'add': {'index': partition, 'alias': read_alias}} for partition in partitions]
+        if index_name in self.list_indices():
+            actions.append({'add': {'index': index_name, 'alias': read_alias}})
+        self.es.indices.update_aliases(body={'actions': actions})
+        logger.info(f'Updated alias {read_alias} ({len(partitions)} partitions)')
+        if optimize:
+            last_optimized_partition = self.partition_name(index_name, add_months(now, -PARTITION_GRACE_MONTHS))
+            for partition in partitions:
+                if partition <= last_optimized_partition:
+                    self.optimize_partition(partition)
+
+    def optimize_partition(self, partition):
+        """Force-merge partition into a single segment and make it read-only (only once)"""
+        settings = self.es.indices.get_settings(index=partition, name='index.blocks.write', flat_settings=True)
+        if settings.get(partition, {}).get('settings', {}).get('index.blocks.write') == 'true':
+            return
+        logger.info(f'Force-merging partition {partition}...')
+        self.es.indices.forcemerge(index=partition, max_num_segments=1, request_timeout=3600)
+        self.es.indices.put_settings(index=partition, body={'index.blocks.write': True})
+
+    def _list_indices_cached(self):
+        key = ('indices', os.getpid())
+        if key not in INDICES_CACHE or time.time() - INDICES_CACHE[key][0] > INDICES_CACHE_TTL:
+            INDICES_CACHE[key] = (time.time(), self.list_indices())
+        return INDICES_CACHE[key][1]
+
+    def _index_exists_cached(self, index_name):
+        key = ('exists', os.getpid(), index_name)
+        if key not in INDICES_CACHE or time.time() - INDICES_CACHE[key][0] > INDICES_CACHE_TTL:
+            INDICES_CACHE[key] = (time.time(), self.es.indices.exists(index_name))
+        return INDICES_CACHE[key][1]
+
     #################################################################
     # Misc
     def get_random_document(self, index_name, doc_type='tweet'):
         body = {'query': {'function_score': {'functions': [{'random_score': {}}]}}}
-        res =  self.es.search(index=index_name, doc_type=doc_type, body=body, size=1, filter_path=['hits.hits'])
+        res =  self.search(index=self.read_indices(index_name), doc_type=doc_type, body=body, size=1, filter_path=['hits.hits'])
         hits = res['hits']['hits']
         if len(hits) == 0:
             report_error(logger, msg='Could not find a random document in index {}'.format(index_name))
@@ -440,12 +851,83 @@ class Elastic():
         return res
 
     def count_recent_documents(self, since='now-10m'):
-        indices = self.list_indices()
+        since_date = resolve_date(since)
+        indices = [i for i in self.list_indices() if not is_partition_before(i, since_date)]
         body = {'query': {'range': {'created_at': {'gte': since, 'lte': 'now'}}}}
-        resp = self.es.count(index=indices, doc_type='tweet', body=body)
+        resp = self.count(index=indices, doc_type='tweet', body=body)
         return resp.get('count', 0)
 
 # Helper functions
+def add_to_rollup(rollup_docs, created_at, is_retweet, question_tag, run_name, label, label_val=None):
+    """Count prediction in rollup documents (keyed by question_tag, run_name, label, hour and is_retweet). Use run_name '' for primary labels."""
+    hour = rollup_hour(created_at)
+    _id = rollup_doc_id(created_at, is_retweet, question_tag, run_name, label)
+    if _id not in rollup_docs:
+        rollup_docs[_id] = {'hour': hour, 'question_tag': question_tag, 'run_name': run_name, 'label': label, 'is_retweet': is_retweet,
+                'count': 0, 'label_val_sum': 0, 'label_val_count': 0}
+    rollup_docs[_id]['count'] += 1
+    if label_val is not None:
+        rollup_docs[_id]['label_val_sum'] += label_val
+        rollup_docs[_id]['label_val_count'] += 1
+
+def rollup_doc_id(created_at, is_retweet, question_tag, run_name, label):
+    return '|'.join([question_tag, run_name, label, rollup_hour(created_at), str(int(is_retweet))])
+
+def rollup_hour(created_at):
+    """Hour (UTC) of a tweet's created_at"""
+    return datetime.strptime(created_at, '%a %b %d %H:%M:%S %z %Y').astimezone(timezone.utc).strftime('%Y-%m-%d %H:00:00')
+
+def resolve_date(date):
+    """Resolve date given as 'now[-<n><unit>][/<unit>]' (Elasticsearch date math, with calendar months and years) or
+    '%Y-%m-%d %H:%M:%S' to a datetime (UTC). Returns None if date can't be resolved."""
+    if isinstance(date, datetime) or date is None:
+        return date
+    m = re.match(r'^now(?:-(\d+)([smhdwMy]))?(?:/([hdwMy]))?$', date)
+    if m is not None:
+        date = datetime.utcnow()
+        if m.group(1) is not None:
+            num, unit = int(m.group(1)), m.group(2)
+            if unit in ['M', 'y']:
+                date = add_months(date, -num*(12 if unit == 'y' else 1))
+            else:
+                units = {'s': 1, 'm': 60, 'h': 3600, 'd': 24*3600, 'w': 7*24*3600}
+                date = date - timedelta(seconds=num*units[unit])
+        if m.group(3) is not None:
+            # round down to start of unit
+            date = date.replace(minute=0, second=0, microsecond=0)
+            if m.group(3) != 'h':
+                date = date.replace(hour=0)
+            if m.group(3) == 'w':
+                date = date - timedelta(days=date.weekday())
+            elif m.group(3) in ['M', 'y']:
+                date = date.replace(day=1, month=1 if m.group(3) == 'y' else date.month)
+        return date
+    try:
+        return datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+
+def add_months(date, months):
+    """Shift date by calendar months (the day is clipped to the length of the resulting month)"""
+    month = date.month - 1 + months
+    year = date.year + month // 12
+    month = month % 12 + 1
+    return date.replace(year=year, month=month, day=min(date.day, calendar.monthrange(year, month)[1]))
+
+def partition_start(index_name):
+    """Start of month of a partition (None if index is not a partition)"""
+    m = re.search(PARTITION_SUFFIX_REGEX, index_name)
+    if m is None:
+        return None
+    return datetime(int(m.group(1)), int(m.group(2)), 1)
+
+def is_partition_before(index_name, date):
+    """True if index is a partition of a month before the month of date"""
+    start = partition_start(index_name)
+    if start is None or date is None:
+        return False
+    return start < datetime(date.year, date.month, 1)
+
 def keys_exist(element, *keys):
     """ Check if *keys (nested) exists in `element` (dict). """
     _element = element
@@ -456,3 +938,9 @@ def keys_exist(element, *keys):
             return False
     return True
 
+def trim_empty_buckets(buckets):
+    """Remove leading and trailing histogram buckets without documents"""
+    non_empty = [i for i, bucket in enumerate(buckets) if bucket['doc_count'] > 0]
+    if len(non_empty) == 0:
+        return []
+    return buckets[non_empty[0]:(non_empty[-1] + 1)]
@@ -8,12 +8,19 @@ from app.stream.tasks import handle_tweet
 from app.stream.trending_tweets import TrendingTweets
 from app.stream.trending_topics import TrendingTopics
 import time
-from statsmodels.nonparametric.smoothers_lowess import lowess
-import numpy as np
+import math
 import os
 from helpers import report_error, success_response, error_response
 from app.utils.mailer import StreamStatusMailer, Mailer
 from app.utils.priority_queue import TweetIdQueue
+from app.utils.sample_pool import SamplePool
+from app.utils.result_cache import ResultCache
+from app.utils.smoothed_series import SmoothedSeries
+from app.utils.json_response import json_response
+from app.utils.metrics import metrics
+from app.utils.predict_queue import PredictQueue
+from app.stream.es_queue import ESQueue
+from app.stream.redis_s3_queue import RedisS3Queue
 from app.utils.project_config import ProjectConfig
 import pandas as pd
 import pickle
@@ -22,6 +29,8 @@ from datetime import datetime
 
 blueprint = Blueprint('main', __name__)
 logger = logging.getLogger('Main')
+MAX_BATCH_SIZE = 100  # maximum number of tweets retrieved in a single batch request
+CACHE_BYPASS_HEADER = 'X-Cache-Bypass'  # set to '1' to bypass the result cache of data endpoints
 
 
 @blueprint.before_request
@@ -175,22 +184,30 @@ def get_new_tweet(project):
     tid = TweetIdQueue(project)
     tweet = tid.get_tweet(user_id=user_id)
     if tweet is None:
-        msg = 'Could not get tweet id from priority queue. Getting random tweet from ES instead.'
-        report_error(logger, msg=msg)
-        # get a random tweet instead
-        tweet = es.get_random_document(project)
+        tweet = get_random_tweet(project)
         if tweet is None:
-            msg = 'Could not get random tweet from elasticsearch.'
-            report_error(logger, msg=msg)
-            return jsonify({'error': msg}), 400
-    tweet = {k: tweet.get(k) for k in fields}
-    if 'id' in tweet:
-        # rename fields
-        tweet['tweet_id'] = str(tweet.pop('id'))
-        tweet['tweet_text'] = tweet.pop('text')
+            return jsonify({'error': 'Could not get random tweet.'}), 400
+    tweet = format_tweet(tweet, fields)
     logger.info(f"Retrieving tweet {tweet['tweet_id']} for user {user_id}")
     return jsonify(tweet)
 
+@blueprint.route('tweet/new_batch/<project>', methods=['GET'])
+def get_new_tweets(project):
+    """Get multiple new tweets from priority queue (e.g. for prefetching)"""
+    user_id = request.args.get('user_id', None)
+    num_tweets = min(request.args.get('num_tweets', default=10, type=int), MAX_BATCH_SIZE)
+    fields = request.args.get('fields', ['id', 'text'])
+    logger.info(f"Getting {num_tweets} tweets for project {project} for user {user_id}")
+    tid = TweetIdQueue(project)
+    tweets = tid.get_tweets(num_tweets, user_id=user_id)
+    if len(tweets) == 0:
+        tweet = get_random_tweet(project)
+        if tweet is None:
+            return jsonify({'error': 'Could not get random tweet.'}), 400
+        tweets = [tweet]
+    tweets = [format_tweet(tweet, fields) for tweet in tweets]
+    return jsonify(tweets)
+
 @blueprint.route('tweet/update/<project>', methods=['POST'])
 def add_to_pq(project):
     """Update priority score in queue and remember that a user has already classified a tweet"""
@@ -205,6 +222,23 @@ def add_to_pq(project):
     return Response('Update successful.', status=200, mimetype='text/plain')
 
 
+@blueprint.route('tweet/update_batch/<project>', methods=['POST'])
+def add_batch_to_pq(project):
+    """Same as tweet/update but for a list of updates of the form {'tweet_id': ..., 'user_id': ...}"""
+    data = request.get_json()
+    logger.debug('Incoming request with data {}'.format(data))
+    if data is None or not isinstance(data.get('updates'), list):
+        report_error(logger, msg='No updates were passed when updating')
+        return Response(None, status=400, mimetype='text/plain')
+    if not all('user_id' in d and 'tweet_id' in d for d in data['updates']):
+        report_error(logger, msg='No user_id or tweet_id was passed when updating')
+        return Response(None, status=400, mimetype='text/plain')
+    logger.info(f"Applying {len(data['updates'])} updates to project {project}")
+    tid = TweetIdQueue(project)
+    tid.multi_update([(d['tweet_id'], d['user_id']) for d in data['updates']])
+    return Response('Update successful.', status=200, mimetype='text/plain')
+
+
 @blueprint.route('tweet/remove/<project>', methods=['POST'])
 def remove_from_pq(project):
     """Remove a tweet which is now private"""
@@ -232,38 +266,112 @@ def email_status():
 @blueprint.route('data/all/<index_name>', methods=['GET'])
 def get_all_data(index_name):
     options = request.get_json()
-    res = es.get_all_agg(index_name, **options)
-    return jsonify(res)
+    return cached_response('all', index_name, options, lambda: es.get_all_agg(index_name, **options))
 
 @blueprint.route('data/predictions/<index_name>', methods=['POST'])
 def get_predictions(index_name):
     body = request.get_json()
-    question_tag = body.pop('question_tag')
-    answer_tags = body.pop('answer_tags')
-    res = es.get_predictions(index_name, question_tag, answer_tags, **body)
-    return jsonify(res)
+    def compute():
+        options = dict(body)
+        question_tag = options.pop('question_tag')
+        answer_tags = options.pop('answer_tags')
+        return es.get_predictions(index_name, question_tag, answer_tags, **options)
+    return cached_response('predictions', index_name, body, compute)
 
 @blueprint.route('data/average_label_val/<index_name>', methods=['POST'])
 def get_average_label_val(index_name):
     body = request.get_json()
-    question_tag = body.pop('question_tag')
-    res = es.get_avg_label_val(index_name, question_tag, **body)
-    return jsonify(res)
+    def compute():
+        options = dict(body)
+        question_tag = options.pop('question_tag')
+        return es.get_avg_label_val(index_name, question_tag, **options)
+    return cached_response('average_label_val', index_name, body, compute)
+
+#################################################################
+# METRICS
+@blueprint.route('metrics', methods=['GET'])
+def get_metrics():
+    """Pipeline metrics of all processes in Prometheus text format"""
+    metrics.flush()
+    return Response(metrics.render(gauges=get_queue_depths()), mimetype='text/plain; version=0.0.4')
 
 #################################################################
 # Sentiment data
 @blueprint.route('sentiment/average', methods=['GET'])
 def get_average_sentiment():
+    """Smoothed average sentiment (computed by the sentiment-series-update beat task)"""
     options = get_params(request.args)
-    res = es.get_av_sentiment('project_vaccine_sentiment', **options)
-    res_lowess = compute_loess(res)
-    return json.dumps(res_lowess)
+    if options['interval'] not in SmoothedSeries.INTERVALS:
+        return error_response(400, f"Interval must be one of {', '.join(SmoothedSeries.INTERVALS)}")
+    series = SmoothedSeries('project_vaccine_sentiment', interval=options['interval'], include_retweets=options['include_retweets'])
+    buckets = series.get(start_date=options['start_date'], end_date=options['end_date'])
+    if buckets is None:
+        report_error(logger, msg=f'Smoothed series {series.key} has not been computed yet.', level='warning')
+        buckets = []
+    return json_response(buckets)
 
 @blueprint.route('sentiment/geo', methods=['GET'])
 def get_geo_sentiment():
     options = get_params(request.args)
-    res = es.get_geo_sentiment('project_vaccine_sentiment', **options)
-    return json.dumps(res)
+    if request.args.get('mode', 'raw') == 'grid':
+        # per-cell aggregates at a map zoom dependent precision (or given geohash precision)
+        options['model'] = request.args.get('model', 'fasttext_v1')
+        options['precision'] = request.args.get('precision', geohash_precision(request.args.get('zoom', 2, type=int)), type=int)
+        options.pop('interval')
+        index_name = 'project_vaccine_sentiment'
+        return cached_response('geo_sentiment_grid', index_name, options, lambda: es.get_geo_sentiment_grid(index_name, **options))
+    return json_response(es.iter_geo_sentiment('project_vaccine_sentiment', **options))
+
+def get_random_tweet(project):
+    """Fallback for an empty priority queue: Random tweet from the sample pool or (if empty) from ES"""
+    msg = 'Could not get tweet id from priority queue. Getting random tweet from sample pool instead.'
+    report_error(logger, msg=msg)
+    sample_pool = SamplePool(project)
+    tweet = sample_pool.get()
+    if tweet is not None:
+        return tweet
+    report_error(logger, msg='Sample pool is empty. Getting random tweet from ES instead.')
+    tweet = es.get_random_document(project)
+    if tweet is None:
+        report_error(logger, msg='Could not get random tweet from elasticsearch.')
+    return tweet
+
+def cached_response(name, index_name, options, compute):
+    """Serve result from the result cache. Sending the header `X-Cache-Bypass: 1` forces a recomputation (and cache refresh)."""
+    result_cache = ResultCache()
+    res = None
+    if request.headers.get(CACHE_BYPASS_HEADER) != '1':
+        # cached results are served as is (without deserializing)
+        res = result_cache.get(name, index_name, options, raw=True)
+    cache_status = 'HIT'
+    if res is None:
+        cache_status = 'MISS'
+        res = compute()
+        result_cache.set(name, index_name, options, res)
+    return json_response(res, headers={'X-Cache': cache_status})
+
+def get_queue_depths():
+    gauges = []
+    for queue_name, queue in [('es', ESQueue()), ('s3', RedisS3Queue())]:
+        for key in queue.find_projects_in_queue():
+            gauges.append(('queue_depth', {'queue': queue_name, 'project': key.decode().split(':')[-1]}, queue.num_elements_in_queue(key)))
+    for project_config in ProjectConfig().read():
+        if len(project_config['model_endpoints']) > 0:
+            predict_queue = PredictQueue(project_config['slug'])
+            gauges.append(('queue_depth', {'queue': 'predict', 'project': project_config['slug']}, len(predict_queue)))
+    return gauges
+
+def geohash_precision(zoom):
+    """Geohash precision with cells a few times smaller than a map tile at given zoom level"""
+    return min(max(math.ceil(2*(zoom + 3)/5), 1), 12)
+
+def format_tweet(tweet, fields):
+    tweet = {k: tweet.get(k) for k in fields}
+    if 'id' in tweet:
+        # rename fields
+        tweet['tweet_id'] = str(tweet.pop('id'))
+        tweet['tweet_text'] = tweet.pop('text')
+    return tweet
 
 def get_params(args):
     options = {}
@@ -275,17 +383,3 @@ def get_params(args):
     if isinstance(options['include_retweets'], str):
         options['include_retweets'] = True if options['include_retweets'] == 'true' else False
     return options
-
-def compute_loess(data):
-    y = np.array([d['avg_sentiment']['value'] for d in data])
-    x = np.array([d['key'] for d in data])
-    lowess_fit = lowess(y, x, frac=0.1, is_sorted=True, return_sorted=False)
-    data_new = []
-    for i, d in enumerate(data):
-        if np.isnan(lowess_fit[i]):
-            # needed for Ruby to be able to parse NaN values
-            d['avg_sentiment']['value_smoothed'] = 'null'
-        else:
-            d['avg_sentiment']['value_smoothed'] = lowess_fit[i]
-        data_new.append(d)
-    return data_new
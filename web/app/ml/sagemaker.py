@@ -1,6 +1,6 @@
 import redis
 from app.settings import Config
-import boto3
+from app.connections.aws import get_client
 import logging
 from helpers import report_error
 from botocore.exceptions import ClientError
@@ -95,8 +95,8 @@ class Sagemaker():
 
     @property
     def _client(self):
-        return boto3.Session(region_name=self.config.AWS_REGION).client('sagemaker')
+        return get_client('sagemaker')
 
     @property
     def _runtime_client(self):
-        return boto3.Session(region_name=self.config.AWS_REGION).client('runtime.sagemaker')
+        return get_client('runtime.sagemaker')
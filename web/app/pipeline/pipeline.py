@@ -13,6 +13,7 @@ from app.extensions import es
 from datetime import datetime, timedelta
 from app.stream.redis_s3_queue import RedisS3Queue
 from helpers import error_response, success_response
+from app.utils.json_response import json_response
 
 blueprint = Blueprint('pipeline', __name__)
 
@@ -87,12 +88,9 @@ def stream_activity():
     s = e - timedelta(hours=redis_counts_threshold_hours)
     redis_s3_queue = RedisS3Queue()
     stream_config_reader = ProjectConfig()
-    dates = list(redis_s3_queue.daterange(s, e, hourly=True))
-    redis_count = 0
-    for stream in stream_config_reader.read():
-        for d in dates:
-            d, h = d.split(':')
-            redis_count += redis_s3_queue.get_counts(stream['slug'], d, h)
+    projects = [stream['slug'] for stream in stream_config_reader.read()]
+    counts = redis_s3_queue.get_counts_bulk(projects, s, e, hourly=True)
+    redis_count = sum(sum(counts_by_date.values()) for project in projects for counts_by_date in counts[project].values())
     return jsonify({'redis_count': redis_count, 'es_count': es_count})
 
 @blueprint.route('/status/<container_name>')
@@ -115,7 +113,7 @@ def manage_config():
     if request.method == 'GET':
         # read streaming config
         config = pc.read()
-        return jsonify(config), 200
+        return json_response(config)
     else:
         # write streaming config
         # make sure new configuration is valid
@@ -19,14 +19,25 @@ class Config(object):
     ELASTICSEARCH_PORT = os.environ.get('ELASTICSEARCH_PORT')
     ELASTICSEARCH_USERNAME= os.environ.get('ELASTICSEARCH_USERNAME', None)
     ELASTICSEARCH_PASSWORD = os.environ.get('ELASTICSEARCH_PASSWORD', None)
+    ELASTICSEARCH_MAXSIZE = int(os.environ.get('ELASTICSEARCH_MAXSIZE', 25))  # connection pool size per host
+    ELASTICSEARCH_TIMEOUT = int(os.environ.get('ELASTICSEARCH_TIMEOUT', 30))  # seconds
+    ELASTICSEARCH_MAX_RETRIES = int(os.environ.get('ELASTICSEARCH_MAX_RETRIES', 3))
+    ELASTICSEARCH_SNIFF = os.environ.get('ELASTICSEARCH_SNIFF', '0')  # only for self-hosted clusters
+    ELASTICSEARCH_PARTITIONED = os.environ.get('ELASTICSEARCH_PARTITIONED', '0')  # write project data to monthly partitions
+    ELASTICSEARCH_USE_ROLLUP = os.environ.get('ELASTICSEARCH_USE_ROLLUP', '0')  # answer prediction queries from rollup indices (enable after backfilling)
+    ROLLUP_IDS_TTL = int(os.environ.get('ROLLUP_IDS_TTL', 7*24*3600))  # seconds predictions are remembered as counted in the rollup index
 
     # Redis
     REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
     REDIS_PORT = os.environ.get('REDIS_PORT', 6379)
     REDIS_DB = os.environ.get('REDIS_DB', 0)
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))  # connection pool size per process
+    REDIS_POOL_TIMEOUT = int(os.environ.get('REDIS_POOL_TIMEOUT', 20))  # seconds to wait for a free connection
     REDIS_NAMESPACE = os.environ.get('REDIS_NAMESPACE', 'cb')
     REDIS_STREAM_QUEUE_KEY = os.environ.get('REDIS_STREAM_QUEUE_KEY', 'stream')
     ES_QUEUE_KEY = os.environ.get('ES_QUEUE_KEY', 'es_queue')
+    REDIS_RSET_BACKEND = os.environ.get('REDIS_RSET_BACKEND', 'set')  # storage of users who labelled a tweet ('set' or 'bitmap')
+    REDIS_DATA_DUMP_IDS_ENCODING = os.environ.get('REDIS_DATA_DUMP_IDS_ENCODING', 'list')  # storage of data dump ids ('list' or 'packed')
 
     # stream config
     STREAM_CONFIG_FILE_PATH = os.path.join('stream', 'twitter_stream.json')
@@ -46,6 +57,25 @@ class Config(object):
     S3_BUCKET = os.environ.get('S3_BUCKET', '')
     S3_BUCKET_SAGEMAKER = os.environ.get('S3_BUCKET_SAGEMAKER', 'crowdbreaks-sagemaker')
     S3_BUCKET_PUBLIC = os.environ.get('S3_BUCKET_PUBLIC', 'crowdbreaks-public')
+    AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 20))  # HTTP connections per boto3 client
+    AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', 5))
+    AWS_RETRY_MODE = os.environ.get('AWS_RETRY_MODE', '')  # 'legacy', 'standard' or 'adaptive' (requires botocore>=1.15), empty for botocore default
+    S3_MULTIPART_THRESHOLD = int(os.environ.get('S3_MULTIPART_THRESHOLD', 8*1024**2))  # bytes
+    S3_MAX_CONCURRENCY = int(os.environ.get('S3_MAX_CONCURRENCY', 10))  # threads per multipart transfer
+
+    # Media
+    MEDIA_DOWNLOAD_CONCURRENCY = int(os.environ.get('MEDIA_DOWNLOAD_CONCURRENCY', 8))  # concurrent downloads per task
+    MEDIA_DOWNLOAD_TIMEOUT = float(os.environ.get('MEDIA_DOWNLOAD_TIMEOUT', 10))  # seconds
+    MEDIA_DOWNLOAD_RETRIES = int(os.environ.get('MEDIA_DOWNLOAD_RETRIES', 3))
+    MEDIA_MAX_BUFFER_SIZE = int(os.environ.get('MEDIA_MAX_BUFFER_SIZE', 8*1024**2))  # bytes of media kept in memory, larger media is buffered in app/tmp
+    MEDIA_CACHE_TTL = int(os.environ.get('MEDIA_CACHE_TTL', 7*24*3600))  # seconds after which stored media is forgotten by the dedup cache
+
+    # Sentiment
+    SENTIMENT_LOESS_SPAN = int(os.environ.get('SENTIMENT_LOESS_SPAN', 15))  # number of buckets in LOESS smoothing window
+    SENTIMENT_SMOOTHER = os.environ.get('SENTIMENT_SMOOTHER', 'statsmodels')  # 'statsmodels' or 'numpy' (vectorized, faster for long series)
+
+    # Metrics
+    METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', 5))  # seconds between flushes of buffered metrics to Redis
 
     # Email
     SEND_EMAILS = os.environ.get('SEND_EMAILS', '0')
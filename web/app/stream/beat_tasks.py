@@ -3,6 +3,7 @@ from celery.utils.log import get_task_logger
 from app.settings import Config
 from app.utils.project_config import ProjectConfig
 from app.utils.predict_queue import PredictQueue
+from app.utils.rollup_ids import RollupIds
 from app.utils.priority_queue import TweetStore
 from app.utils.data_dump_ids import DataDumpIds
 from app.utils.predict import Predict
@@ -11,6 +12,9 @@ from app.stream.redis_s3_queue import RedisS3Queue
 from app.stream.es_queue import ESQueue
 from app.utils.mailer import StreamStatusMailer
 from app.extensions import es
+from app.connections.elastic import add_to_rollup, rollup_doc_id
+from app.utils.metrics import metrics
+from app.utils.smoothed_series import SmoothedSeries
 from app.stream.trending_tweets import TrendingTweets
 from app.stream.trending_topics import TrendingTopics
 from helpers import report_error, compress
@@ -19,6 +23,7 @@ import os
 import json
 import datetime
 import uuid
+import time
 
 config = Config()
 
@@ -51,11 +56,14 @@ def send_to_s3(debug=False):
         os.remove(tmp_file_path)
         # upload to S3
         s3_key = 'tweets/{}/{}/{}'.format(stream_config['es_index_name'], now.strftime("%Y-%m-%d"), f_name_gz)
-        if s3_handler.upload_file(tmp_file_path_gz, s3_key):
+        with metrics.timer('s3_upload_duration_seconds', project=project):
+            upload_successful = s3_handler.upload_file(tmp_file_path_gz, s3_key)
+        if upload_successful:
             logging.info(f'Successfully uploaded file {s3_key} to S3')
             os.remove(tmp_file_path_gz)
         else:
             logging.error(f'ERROR: Upload of file {s3_key} to S3 not successful')
+    metrics.flush()
 
 
 @celery.task(name='es-bulk-index-task', ignore_result=True)
@@ -68,6 +76,7 @@ def es_bulk_index(debug=True):
         logger.info('No work available. Goodbye!')
         return
     predictions_by_project = {}
+    timestamps_by_project = {}
     es_actions = []
     for key in project_keys:
         es_queue_objs = es_queue.pop_all(key)
@@ -82,18 +91,26 @@ def es_bulk_index(debug=True):
             {'_id': t['id'],
             '_type': 'tweet',
             '_source': t['processed_tweet'],
-            '_index': stream_config['es_index_name']
+            '_index': es.write_index(stream_config['es_index_name'], created_at=t['processed_tweet'].get('created_at'))
             } for t in es_queue_objs]
         es_actions.extend(actions)
         # compile predictions to be added to prediction queue after indexing
         predictions_by_project[project] = [t['text_for_prediction'] for t in es_queue_objs if 'text_for_prediction' in t]
+        timestamps_by_project[project] = [int(t['processed_tweet']['timestamp_ms']) for t in es_queue_objs if t['processed_tweet'].get('timestamp_ms')]
     # bulk index
     if len(es_actions) > 0:
         success = es.bulk_actions_in_batches(es_actions, batch_size=1000)
         if not success:
             # dump data to disk
             es_queue.dump_to_disk(es_actions, 'es_bulk_indexing_errors')
+            metrics.flush()
             return
+        # record lag between tweet creation and indexing
+        now = time.time()
+        for project, timestamps in timestamps_by_project.items():
+            for timestamp_ms in timestamps:
+                metrics.observe('tweet_index_lag_seconds', now - timestamp_ms/1000, project=project)
+        metrics.flush()
         # Queue up for prediction
         for project, objs_to_predict in predictions_by_project.items():
             predict_queue = PredictQueue(project)
@@ -104,6 +121,8 @@ def es_predict(debug=True):
     logger = get_logger(debug)
     project_config = ProjectConfig()
     predictions = {}
+    rollups = {}
+    doc_indices = {}
     for project_config in project_config.read():
         if len(project_config['model_endpoints']) > 0:
             project = project_config['slug']
@@ -114,15 +133,19 @@ def es_predict(debug=True):
             texts = [t['text'] for t in predict_objs]
             ids = [t['id'] for t in predict_objs]
             es_index_name = project_config['es_index_name']
+            rollup_predictions = rollups.setdefault(es_index_name, [])
             for question_tag, endpoints_obj in project_config['model_endpoints'].items():
                 for endpoint_name, endpoint_info in  endpoints_obj['active'].items():
                     model_type = endpoint_info['model_type']
                     run_name = endpoint_info['run_name']
                     predictor = Predict(endpoint_name, model_type)
                     preds = predictor.predict(texts)
-                    for _id, _pred in zip(ids, preds):
+                    for predict_obj, _id, _pred in zip(predict_objs, ids, preds):
                         if es_index_name not in predictions:
                             predictions[es_index_name] = {}
+                        if (es_index_name, _id) not in doc_indices:
+                            # partition the document was written to
+                            doc_indices[(es_index_name, _id)] = es.write_index(es_index_name, created_at=predict_obj.get('created_at'))
                         if _id not in predictions[es_index_name]:
                             predictions[es_index_name][_id] = {}
                         if question_tag not in predictions[es_index_name][_id]:
@@ -140,6 +163,13 @@ def es_predict(debug=True):
                             predictions[es_index_name][_id][question_tag]['primary_label'] = _pred['labels'][0]
                             if 'label_vals' in _pred:
                                 predictions[es_index_name][_id][question_tag]['primary_label_val'] = _pred['label_vals'][0]
+                        if 'created_at' in predict_obj:
+                            # update counts in rollup index (primary labels are counted under run_name '')
+                            label_val = _pred['label_vals'][0] if 'label_vals' in _pred else None
+                            rollup_run_names = [run_name, ''] if endpoints_obj['primary'] == endpoint_name else [run_name]
+                            for rollup_run_name in rollup_run_names:
+                                rollup_predictions.append((_id, predict_obj['created_at'], predict_obj['is_retweet'], question_tag, rollup_run_name,
+                                        _pred['labels'][0], label_val))
     if len(predictions) > 0:
         actions = []
         for es_index_name, pred_es_index in predictions.items():
@@ -148,7 +178,7 @@ def es_predict(debug=True):
                     '_id': _id,
                     '_type': 'tweet',
                     '_op_type': 'update',
-                    '_index': es_index_name,
+                    '_index': doc_indices.get((es_index_name, _id), es_index_name),
                     '_source': {
                         'doc': {
                             'meta': pred_obj
@@ -157,24 +187,38 @@ def es_predict(debug=True):
                     })
         success = es.bulk_actions_in_batches(actions)
         if not success:
-            # dump data to disk
+            # dump data to disk (rollups are only updated for stored predictions)
             es_queue = ESQueue()
             es_queue.dump_to_disk(actions, 'es_bulk_update_errors')
+            return
+    for es_index_name, rollup_predictions in rollups.items():
+        # only count predictions which haven't been counted before
+        rollup_ids = RollupIds(es_index_name)
+        new_predictions = rollup_ids.claim(rollup_predictions)
+        rollup_docs = {}
+        for prediction in new_predictions:
+            add_to_rollup(rollup_docs, *prediction[1:])
+        if len(rollup_docs) > 0:
+            logger.info(f'Updating {len(rollup_docs):,} rollup documents for index {es_index_name}')
+            not_applied = []
+            if not es.update_rollup(es_index_name, rollup_docs, not_applied=not_applied):
+                # only predictions of documents which were certainly not updated can be counted again later (others are
+                # left to the backfill script, to avoid counting them twice)
+                not_applied = set(not_applied)
+                rollup_ids.release([p for p in new_predictions if rollup_doc_id(*p[1:6]) in not_applied])
 
 @celery.task(name='cleanup', ignore_result=True)
 def cleanup(debug=False):
     logger = get_logger(debug)
     # Cleanup (remove old trending tweets from redis)
     project_config = ProjectConfig()
-    projects = []
     for project_config in project_config.read():
-        projects.append(project_config['slug'])
         if project_config['compile_trending_tweets']:
             tt = TrendingTweets(project_config['slug'])
             tt.cleanup()
-    # cleanup tweet store
-    ts = TweetStore()
-    ts.cleanup(projects)
+        # cleanup tweet store (tweet ID queues are named by their index name)
+        ts = TweetStore(project_config['es_index_name'])
+        ts.cleanup()
 
 @celery.task(name='trending-topics-update', ignore_result=True)
 def trending_topics_velocity(debug=False):
@@ -186,6 +230,28 @@ def trending_topics_velocity(debug=False):
             tt = TrendingTopics(project_config['slug'])
             tt.update()
 
+@celery.task(name='es-partitions', ignore_result=True)
+def es_partitions(debug=False):
+    logger = get_logger(debug)
+    if config.ELASTICSEARCH_PARTITIONED != '1':
+        logger.info('Partitioning of indices is disabled.')
+        return
+    project_config = ProjectConfig()
+    for project_config in project_config.read():
+        es.manage_partitions(project_config['es_index_name'])
+
+@celery.task(name='sentiment-series-update', ignore_result=True)
+def sentiment_series_update(debug=False):
+    logger = get_logger(debug)
+    project_config = ProjectConfig()
+    for project_config in project_config.read():
+        if 'sentiment' not in project_config['model_endpoints']:
+            continue
+        for interval in SmoothedSeries.INTERVALS:
+            for include_retweets in [True, False]:
+                series = SmoothedSeries(project_config['es_index_name'], interval=interval, include_retweets=include_retweets)
+                series.update(es)
+
 # ------------------------------------------
 # EMAIL TASKS
 @celery.task(name='stream-status-daily', ignore_result=True)
@@ -231,6 +297,19 @@ def public_data_dump_ids(debug=False):
                 data_dump_ids = DataDumpIds(project_config['slug'], mode=mode)
                 data_dump_ids.sync()
 
+@celery.task(name='public-data-dump-ids-compaction', ignore_result=True)
+def public_data_dump_ids_compaction(debug=False):
+    logger = get_logger(debug)
+    if config.ENV != 'prd':
+        logger.info(f'Data dumps are only collected in production environments.')
+        return
+    project_config = ProjectConfig()
+    for project_config in project_config.read():
+        if project_config['compile_data_dump_ids']:
+            for mode in [None, 'has_place', 'has_coordinates']:
+                data_dump_ids = DataDumpIds(project_config['slug'], mode=mode)
+                data_dump_ids.compact()
+
 # ------------------------------------------
 # Helper functions
 def get_logger(debug=False):
@@ -10,12 +10,14 @@ class RedisS3Queue(Redis):
     Handles a queue of tweets for each project to be uploaded to S3 by a celery beat task.
     Additionally it keeps track of daily and hourly counts for stats.
     """
+    MGET_BATCH_SIZE = 5000  # number of keys per MGET call
+
     def __init__(self, **args):
         super().__init__(**args)
         self.config = Config()
         self.namespace = self.config.REDIS_NAMESPACE
         self.counts_namespace = 'counts'
-        self.media_name_spaces = ['photo', 'video', 'animated_gif']
+        self.media_name_spaces = ['photo', 'video', 'animated_gif', 'media_deduplicated', 'media_bytes_saved']
 
     def queue_key(self, project):
         return "{}:{}:{}".format(self.namespace, self.config.REDIS_STREAM_QUEUE_KEY, project)
@@ -82,6 +84,33 @@ class RedisS3Queue(Redis):
                 counts += int(c.decode())
         return counts
 
+    def get_counts_bulk(self, projects, start, end, media_types=None, hourly=False):
+        """Counts of all projects and media types between the datetimes start and end, read in batched MGET calls.
+        Returns a dict {project: {media_type: {date: count}}} with dates of format %Y-%m-%d:%H (hourly) or %Y-%m-%d (daily)."""
+        if media_types is None:
+            media_types = ['tweets']
+        dates = list(self.daterange(start, end, hourly=hourly))
+        if hourly:
+            day_hours = [tuple(d.split(':')) for d in dates]
+        else:
+            day_hours = [(d, h) for d in dates for h in self.full_day_hour_range()]
+        counts = {project: {media_type: {d: 0 for d in dates} for media_type in media_types} for project in projects}
+        keys = []
+        targets = []
+        for project in projects:
+            for media_type in media_types:
+                for d, h in day_hours:
+                    keys.append(self.count_key(project, d, h, media_type))
+                    targets.append((project, media_type, f'{d}:{h}' if hourly else d))
+        pipe = self._r.pipeline(transaction=False)
+        for i in range(0, len(keys), self.MGET_BATCH_SIZE):
+            pipe.mget(keys[i:(i+self.MGET_BATCH_SIZE)])
+        values = [v for batch in pipe.execute() for v in batch]
+        for (project, media_type, date), value in zip(targets, values):
+            if value is not None:
+                counts[project][media_type][date] += int(value)
+        return counts
+
     def update_counts(self, project, day=None, hour=None, incr=1, media_type=None):
         if media_type is None:
             media_type = 'tweets'
@@ -1,6 +1,6 @@
 import redis
 from app.settings import Config
-import boto3
+from app.connections.aws import get_client, get_transfer_config
 import logging
 from helpers import report_error
 import botocore.exceptions
@@ -10,6 +10,9 @@ logger = logging.getLogger(__name__)
 class S3Handler():
     """Handles queuing in Redis and pushing tweets to S3"""
 
+    MIN_PART_SIZE = 5*1024**2  # minimum size of all but the last part in a multipart upload
+    COPY_PART_SIZE = 1024**3  # size of server-side copy parts (S3 limit is 5GB, leaves room to merge a small remainder)
+
     def __init__(self, bucket=None):
         self.config = Config()
         if bucket is None:
@@ -35,16 +38,52 @@ class S3Handler():
         if make_public:
             extra_args = {'ACL': 'public-read'}
         try:
-            self._s3_client.upload_file(local_path, self.bucket, key, ExtraArgs=extra_args)
+            self._s3_client.upload_file(local_path, self.bucket, key, ExtraArgs=extra_args, Config=get_transfer_config())
+        except Exception as e:
+            report_error(logger, exception=True)
+            return False
+        else:
+            return True
+
+    def append_to_file(self, local_path, key, make_public=False):
+        """Append content of local file to an existing object on S3 without downloading it (server-side copy in a multipart upload).
+        Note that S3 requires the existing object to have a size of at least 5MB (MIN_PART_SIZE)."""
+        extra_args = {}
+        if make_public:
+            extra_args = {'ACL': 'public-read'}
+        upload_id = None
+        try:
+            size = self._s3_client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+            upload_id = self._s3_client.create_multipart_upload(Bucket=self.bucket, Key=key, **extra_args)['UploadId']
+            parts = []
+            for part_number, (first_byte, last_byte) in enumerate(self.copy_ranges(size), start=1):
+                copy_part = self._s3_client.upload_part_copy(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=part_number,
+                        CopySource={'Bucket': self.bucket, 'Key': key}, CopySourceRange=f'bytes={first_byte}-{last_byte}')
+                parts.append({'ETag': copy_part['CopyPartResult']['ETag'], 'PartNumber': part_number})
+            with open(local_path, 'rb') as f:
+                new_part = self._s3_client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=len(parts) + 1, Body=f)
+            parts.append({'ETag': new_part['ETag'], 'PartNumber': len(parts) + 1})
+            self._s3_client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
         except Exception as e:
             report_error(logger, exception=True)
+            if upload_id is not None:
+                self._s3_client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
             return False
         else:
             return True
 
+    def copy_ranges(self, size):
+        """Byte ranges (inclusive) of copy parts for an object of given size. A remainder smaller than MIN_PART_SIZE is merged
+        into the previous part, since all but the last part of a multipart upload need to be at least MIN_PART_SIZE."""
+        starts = list(range(0, size, self.COPY_PART_SIZE))
+        if len(starts) > 1 and size - starts[-1] < self.MIN_PART_SIZE:
+            starts.pop()
+        ends = starts[1:] + [size]
+        return [(start, end - 1) for start, end in zip(starts, ends)]
+
     def download_file(self, local_path, key):
         try:
-            self._s3_client.download_file(self.bucket, key, local_path)
+            self._s3_client.download_file(self.bucket, key, local_path, Config=get_transfer_config())
         except Exception as e:
             report_error(logger, exception=True)
             return False
@@ -63,11 +102,25 @@ class S3Handler():
         else:
             return True
 
+    def file_size(self, key):
+        """Size of object in bytes (None if object does not exist)"""
+        try:
+            resp = self._s3_client.head_object(Bucket=self.bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != "404":
+                report_error(logger, exception=True)
+            return None
+        else:
+            return resp['ContentLength']
+
     def list_buckets(self):
         return self._s3_client.list_buckets()
 
     def iter_items(self, prefix=''):
-        return self._s3_client.list_objects(Bucket=self.bucket, Prefix=prefix)['Contents']
+        """Iterate over all objects under prefix (paginated)"""
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            yield from page.get('Contents', [])
 
     def rename(self, old_key, new_key):
         copy_source = {'Bucket': self.bucket, 'Key': old_key}
@@ -88,4 +141,4 @@ class S3Handler():
 
     @property
     def _s3_client(self):
-        return boto3.client('s3')
+        return get_client('s3')
@@ -1,5 +1,6 @@
 from app.stream.errors import ERROR_CODES
 from app.stream.tasks import handle_tweet
+from app.utils.metrics import metrics
 from tweepy import StreamListener
 import logging
 import json
@@ -18,6 +19,7 @@ class Listener(StreamListener):
     def on_status(self, status):
         tweet = status._json
         handle_tweet.delay(tweet)
+        metrics.inc('tweets_received_total')
         return True
 
     def on_error(self, status_code):
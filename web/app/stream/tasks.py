@@ -3,8 +3,9 @@ from app.worker.celery_init import celery
 from celery.utils.log import get_task_logger
 from app.utils.reverse_tweet_matcher import ReverseTweetMatcher
 from app.utils.process_tweet import ProcessTweet
-from app.utils.process_media import ProcessMedia
+from app.utils.process_media import ProcessMedia, MediaDownloader
 from app.utils.priority_queue import TweetIdQueue
+from app.utils.sample_pool import SamplePool
 from app.utils.project_config import ProjectConfig
 from app.utils.redis import Redis
 from app.utils.data_dump_ids import DataDumpIds
@@ -13,6 +14,7 @@ from app.stream.trending_tweets import TrendingTweets
 from app.stream.trending_topics import TrendingTopics
 from app.stream.es_queue import ESQueue
 from app.extensions import es
+from app.utils.metrics import metrics
 import logging
 import os
 import json
@@ -24,9 +26,11 @@ def handle_tweet(tweet, send_to_es=True, use_pq=True, debug=False, store_unmatch
     logger = get_task_logger(__name__)
     if debug:
         logger.setLevel(logging.DEBUG)
+    stages = metrics.stage_timer('handle_tweet_stage_duration_seconds')
     # reverse match to find project
     rtm = ReverseTweetMatcher(tweet=tweet)
     candidates = rtm.get_candidates()
+    stages.lap('match')
     tweet_id = tweet['id_str']
     # open Redis connection only once
     # redis = Redis()
@@ -35,6 +39,7 @@ def handle_tweet(tweet, send_to_es=True, use_pq=True, debug=False, store_unmatch
     if len(candidates) == 0:
         # Could not match keywords. This might occur quite frequently e.g. when tweets are collected accross different languages/keywords
         logger.info(f'Tweet {tweet_id} could not be matched against any existing projects.')
+        metrics.inc('tweets_unmatched_total')
         if store_unmatched_tweets:
             # store to separate file for later analysis
             with open(os.path.join(config.PROJECT_ROOT, 'logs', 'reverse_match_errors', f'{tweet_id}.json'), 'w') as f:
@@ -46,6 +51,7 @@ def handle_tweet(tweet, send_to_es=True, use_pq=True, debug=False, store_unmatch
     es_queue = ESQueue(connection=connection)
     stream_config_reader = ProjectConfig()
     for project in candidates:
+        metrics.inc('tweets_matched_total', project=project)
         stream_config = stream_config_reader.get_config_by_slug(project)
         if stream_config['storage_mode'] == 'test_mode':
             logger.debug('Running in test mode. Not sending to S3 or ES.')
@@ -55,17 +61,21 @@ def handle_tweet(tweet, send_to_es=True, use_pq=True, debug=False, store_unmatch
         tweet['_tracking_info']['matching_keywords'] = rtm.matching_keywords[project]
         # Queue up on Redis for subsequent upload
         redis_queue.push(json.dumps(tweet).encode(), project)
+        stages.lap('s3_queue')
         # preprocess tweet
         pt = ProcessTweet(tweet, project_locales=stream_config['locales'])
         pt.process()
+        stages.lap('process')
         # Possibly add tweet to trending tweets
         if stream_config['compile_trending_tweets']:
             trending_tweets = TrendingTweets(project, project_locales=stream_config['locales'], connection=connection)
             trending_tweets.process(tweet)
+            stages.lap('trending_tweets')
         # Extract trending topics
         if stream_config['compile_trending_topics']:
             trending_topics = TrendingTopics(project, project_locales=stream_config['locales'], project_keywords=stream_config['keywords'], connection=connection)
             trending_topics.process(tweet)
+            stages.lap('trending_topics')
         if stream_config['compile_data_dump_ids'] and config.ENV == 'prd':
             data_dump_ids = DataDumpIds(project, connection=connection)
             data_dump_ids.add(tweet_id)
@@ -75,6 +85,7 @@ def handle_tweet(tweet, send_to_es=True, use_pq=True, debug=False, store_unmatch
             if pt.has_coordinates:
                 data_dump_ids = DataDumpIds(project, mode='has_coordinates', connection=connection)
                 data_dump_ids.add(tweet_id)
+            stages.lap('data_dump_ids')
         if use_pq and pt.should_be_annotated():
             # add to Tweet ID queue for crowd labelling
             logger.info(f'Add tweet {tweet_id} to priority queue...')
@@ -82,9 +93,17 @@ def handle_tweet(tweet, send_to_es=True, use_pq=True, debug=False, store_unmatch
             tid = TweetIdQueue(stream_config['es_index_name'], priority_threshold=3, connection=connection)
             processed_tweet['text'] = pt.get_text(anonymize=True)
             tid.add_tweet(tweet_id, processed_tweet, priority=0)
+            # keep a random sample as a fallback for an empty queue
+            sample_pool = SamplePool(stream_config['es_index_name'], connection=connection)
+            sample_pool.add({'id': tweet_id, 'text': processed_tweet['text']})
+            stages.lap('priority_queue')
         if stream_config['image_storage_mode'] != 'inactive':
             pm = ProcessMedia(tweet, project, image_storage_mode=stream_config['image_storage_mode'])
-            pm.process()
+            media = pm.process()
+            if len(media) > 0:
+                # download on separate media queue
+                handle_media.delay(media)
+            stages.lap('media')
         if send_to_es and stream_config['storage_mode'] in ['s3-es', 's3-es-no-retweets']:
             if rtm.is_retweet and stream_config['storage_mode'] == 's3-es-no-retweets':
                 # Do not store retweets on ES
@@ -95,5 +114,14 @@ def handle_tweet(tweet, send_to_es=True, use_pq=True, debug=False, store_unmatch
             es_tweet_obj = {'processed_tweet': processed_tweet, 'id': tweet_id}
             if len(stream_config['model_endpoints']) > 0:
                 # prepare for prediction
-                es_tweet_obj['text_for_prediction'] = {'text': pt.get_text(anonymize=True), 'id': tweet_id}
+                es_tweet_obj['text_for_prediction'] = {'text': pt.get_text(anonymize=True), 'id': tweet_id,
+                        'created_at': processed_tweet['created_at'], 'is_retweet': processed_tweet['is_retweet']}
             es_queue.push(json.dumps(es_tweet_obj).encode(), project)
+            stages.lap('es_queue')
+
+@celery.task(ignore_result=True)
+def handle_media(media):
+    logger = get_task_logger(__name__)
+    media_downloader = MediaDownloader()
+    num_stored = media_downloader.download(media)
+    logger.info(f'Stored {num_stored}/{len(media)} media on S3')
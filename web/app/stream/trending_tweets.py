@@ -2,7 +2,9 @@ from app.settings import Config
 from app.utils.redis import Redis
 from app.connections.elastic import Elastic
 from app.utils.priority_queue import PriorityQueue
+from app.utils.process_tweet import ProcessTweet
 import logging
+import re
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +16,8 @@ class TrendingTweets(Redis):
     For this we maintain two data structures:
     1) A Redis based priority queue: keys are tweet ids and values are the number of retweets
     2) Eeach tweet id has a key which expires after a certain time. A cleanup crontab will then delete all keys from the priority queue which have been expired (see cleanup method).
+    3) A small inverted index (token -> set of tweet ids) which allows to filter trending tweets by a query without hitting Elasticsearch.
+       For each tweet id we additionally store its set of tokens, so that the index can be pruned once the tweet leaves the queue.
 
     All tweets get processed by the process method.
     """
@@ -43,15 +47,62 @@ class TrendingTweets(Redis):
     def expiry_key(self, tweet_id):
         return "{}:{}:{}:{}:{}".format(self.namespace, self.key_namespace, self.project, 'expiry-key', tweet_id)
 
+    def token_key(self, token):
+        return "{}:{}:{}:{}:{}".format(self.namespace, self.key_namespace, self.project, 'token', token)
+
+    def tweet_tokens_key(self, tweet_id):
+        return "{}:{}:{}:{}:{}".format(self.namespace, self.key_namespace, self.project, 'tweet-tokens', tweet_id)
+
     def get_trending_tweets(self, num_tweets, query='', sample_from=0, min_score=0):
-        if query == '' or self.es_index_name is None:
-            items = self.pq.multi_pop(num_tweets, sample_from=sample_from, min_score=min_score)
-        else:
-            # Get large enough sample of IDs to search in
-            items = self.pq.multi_pop(self.max_queue_length, min_score=min_score)
-            # Match retrieved documents for specific query
-            items = self.es.get_matching_ids_for_query(self.es_index_name, query, items, size=num_tweets)
-        return items
+        query_tokens = self.tokenize(query)
+        if len(query_tokens) == 0:
+            return self.pq.multi_pop(num_tweets, sample_from=sample_from, min_score=min_score)
+        # Find candidates which contain all query tokens in local index
+        items = self.query_index(query_tokens, min_score=min_score)
+        if len(query_tokens) > 1 and self.es_index_name is not None and len(items) > 0:
+            # Phrase check for multi-token queries (only on the small set of candidates)
+            matching_ids = set(self.es.get_matching_ids_for_query(self.es_index_name, query, items, size=len(items)))
+            items = [item for item in items if item in matching_ids]
+        return items[:num_tweets]
+
+    def query_index(self, query_tokens, min_score=0):
+        """Returns ids of tweets containing all query tokens, sorted by priority"""
+        keys = [self.token_key(token) for token in set(query_tokens)]
+        candidates = [tweet_id.decode() for tweet_id in self._r.sinter(keys)]
+        if len(candidates) == 0:
+            return []
+        pipe = self._r.pipeline()
+        for tweet_id in candidates:
+            pipe.zscore(self.pq.key, tweet_id)
+        scores = pipe.execute()
+        items = [(tweet_id, score) for tweet_id, score in zip(candidates, scores) if score is not None and score >= min_score]
+        items = sorted(items, key=lambda item: item[1], reverse=True)
+        return [tweet_id for tweet_id, _ in items]
+
+    def add_to_index(self, tweet_id, tweet):
+        pt = ProcessTweet(tweet)
+        tokens = set(self.tokenize(pt.get_text(with_retweet_prefix=False)))
+        if len(tokens) == 0:
+            return
+        pipe = self._r.pipeline()
+        for token in tokens:
+            pipe.sadd(self.token_key(token), tweet_id)
+        pipe.sadd(self.tweet_tokens_key(tweet_id), *tokens)
+        pipe.execute()
+
+    def remove_from_index(self, tweet_id):
+        tokens = self._r.smembers(self.tweet_tokens_key(tweet_id))
+        pipe = self._r.pipeline()
+        for token in tokens:
+            pipe.srem(self.token_key(token.decode()), tweet_id)
+        pipe.delete(self.tweet_tokens_key(tweet_id))
+        pipe.execute()
+
+    def tokenize(self, text):
+        """Lower-cased word tokens (roughly corresponds to the standard analyzer in Elasticsearch)"""
+        if not isinstance(text, str):
+            return []
+        return re.findall(r'\w+', text.lower())
 
     def process(self, tweet):
         if not self.should_be_processed(tweet):
@@ -60,9 +111,12 @@ class TrendingTweets(Redis):
         if self.pq.exists(retweeted_id):
             self.pq.increment_priority(retweeted_id, incr=1)
         else:
-            self.pq.add(retweeted_id, priority=1)
+            removed_items = self.pq.add(retweeted_id, priority=1)
+            for item in removed_items:
+                self.remove_from_index(item[0].decode())
             # set an expiry key
             self._r.psetex(self.expiry_key(retweeted_id), self.expiry_time_ms, 1)
+            self.add_to_index(retweeted_id, tweet)
 
     def should_be_processed(self, tweet):
         if not 'retweeted_status' in tweet:
@@ -82,11 +136,13 @@ class TrendingTweets(Redis):
             key_dec = key.decode()
             if not self._r.exists(self.expiry_key(key_dec)):
                 self.pq.remove(key_dec)
+                self.remove_from_index(key_dec)
                 num_deleted +=  1
         logger.info(f'Deleted {num_deleted:,} expired keys from priority queue')
 
     def self_remove(self):
         self.pq.self_remove()
         assert len(self.pq) == 0
-        for k in self._r.scan_iter(self.expiry_key('*')):
-            self._r.delete(k)
+        for pattern in [self.expiry_key('*'), self.token_key('*'), self.tweet_tokens_key('*')]:
+            for k in self._r.scan_iter(pattern):
+                self._r.delete(k)
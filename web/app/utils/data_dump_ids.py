@@ -6,18 +6,80 @@ import time
 import os
 import uuid
 import shutil
+import heapq
+import hashlib
+import struct
+import redis
+import numpy as np
+from datetime import datetime, timedelta
 from helpers import report_error, compress, decompress
 
 logger = logging.getLogger(__name__)
 config = Config()
 
 class DataDumpIds(Redis):
-    def __init__(self, project, mode=None, namespace='cb', key_namespace='data-dump-ids', **args):
+    """
+    Collects tweet ids of a project in Redis which are regularly synced to a public data dump on S3.
+
+    Ids are deduplicated on ingestion using a daily rotated Bloom filter (ids seen on the current or previous day are dropped).
+    With the default of 2**26 bits (8MB) and 7 hashes the false positive rate at ~2M ids per day is ~0.001% per filter
+    (~0.002% combined, since both the current and the previous filter are checked). Each false positive drops an id from the dump.
+    Remaining duplicates (e.g. older than the filter window) are removed when compacting the data dump.
+
+    Ids are stored either as a Redis list of decimal strings (encoding 'list') or packed as 8-byte integers
+    into a single append-only Redis string (encoding 'packed'), which uses several times less memory. Ids are always read
+    from both keys, so ids queued before a change of encoding are still synced.
+    """
+
+    # Packed ids are stored as unsigned 64-bit little-endian integers
+    ID_FORMAT = '<Q'
+    ID_DTYPE = '<u8'
+    ID_SIZE = 8
+
+    # KEYS[1]: ids, KEYS[2]: current filter, KEYS[3]: previous filter, KEYS[4]: duplicates counter
+    # ARGV[1]: encoded id, ARGV[2]: encoding ('list' or 'packed'), ARGV[3]: expiry of filter (seconds), ARGV[4:]: filter bit offsets
+    # Returns 1 if id was added and 0 if it was a duplicate
+    ADD_SCRIPT = """
+    local in_current = true
+    local in_previous = true
+    for i = 4, #ARGV do
+        if in_current and redis.call('GETBIT', KEYS[2], ARGV[i]) == 0 then
+            in_current = false
+        end
+        if in_previous and redis.call('GETBIT', KEYS[3], ARGV[i]) == 0 then
+            in_previous = false
+        end
+    end
+    if in_current or in_previous then
+        redis.call('INCR', KEYS[4])
+        return 0
+    end
+    for i = 4, #ARGV do
+        redis.call('SETBIT', KEYS[2], ARGV[i], 1)
+    end
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+    if ARGV[2] == 'packed' then
+        redis.call('APPEND', KEYS[1], ARGV[1])
+    else
+        redis.call('RPUSH', KEYS[1], ARGV[1])
+    end
+    return 1
+    """
+
+    def __init__(self, project, mode=None, namespace='cb', key_namespace='data-dump-ids', dedup_num_bits=2**26, dedup_num_hashes=7, encoding=None, **args):
         super().__init__(self, **args)
         self.project = project
         self.mode = mode
         self.namespace = namespace
         self.key_namespace = key_namespace
+        self.dedup_num_bits = dedup_num_bits
+        self.dedup_num_hashes = dedup_num_hashes
+        if encoding is None:
+            encoding = config.REDIS_DATA_DUMP_IDS_ENCODING
+        if encoding not in ['list', 'packed']:
+            raise ValueError(f'Invalid encoding {encoding}')
+        self.encoding = encoding
+        self._add_script = None
         self.tmp_path = os.path.join(config.APP_DIR, 'tmp')
         if self.mode is None:
             self.data_dump_f_name = f'data_dump_ids_{self.project}'
@@ -34,42 +96,81 @@ class DataDumpIds(Redis):
 
     @property
     def key(self):
-        if self.mode is None:
-            return "{}:{}:{}".format(self.namespace, self.key_namespace, self.project)
-        else:
-            return "{}:{}:{}:{}".format(self.namespace, self.key_namespace, self.project, self.mode)
+        if self.encoding == 'packed':
+            return self.packed_key
+        return self.list_key
+
+    @property
+    def list_key(self):
+        return self._key(self.key_namespace)
+
+    @property
+    def packed_key(self):
+        return self._key(self.key_namespace + '-packed')
+
+    @property
+    def draining_key(self):
+        return "{}:{}".format(self.packed_key, 'draining')
+
+    def filter_key(self, day):
+        return "{}:{}:{}".format(self._key(self.key_namespace + '-filter'), 'day', day)
+
+    @property
+    def duplicates_key(self):
+        return self._key(self.key_namespace + '-duplicates')
 
     def add(self, value):
-        self._r.rpush(self.key, value)
+        """Add id unless it was already seen recently. Returns True if id was added."""
+        if self._add_script is None:
+            self._add_script = self._r.register_script(self.ADD_SCRIPT)
+        today = datetime.utcnow()
+        yesterday = today - timedelta(days=1)
+        keys = [self.key, self.filter_key(today.strftime('%Y-%m-%d')), self.filter_key(yesterday.strftime('%Y-%m-%d')), self.duplicates_key]
+        args = [self._encode(value), self.encoding, 2*24*3600, *self.filter_offsets(value)]
+        return self._add_script(keys=keys, args=args) == 1
+
+    def filter_offsets(self, value):
+        """Bloom filter bit offsets of value (double hashing on a single SHA1 digest)"""
+        digest = hashlib.sha1(str(value).encode()).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big')
+        return [(h1 + i*h2) % self.dedup_num_bits for i in range(self.dedup_num_hashes)]
+
+    def pop_num_duplicates(self):
+        """Number of duplicates dropped since last call"""
+        num_duplicates = self._r.getset(self.duplicates_key, 0)
+        if num_duplicates is None:
+            return 0
+        return int(num_duplicates)
 
     def __len__(self):
-        return self._r.llen(self.key)
+        # includes ids of both encodings and ids left over from an interrupted drain
+        num_list, *sizes = self._r.pipeline().llen(self.list_key).strlen(self.draining_key).strlen(self.packed_key).execute()
+        return num_list + sum(sizes) // self.ID_SIZE
 
     def self_remove(self):
-        self._r.delete(self.key)
+        self._r.delete(self.list_key, self.packed_key, self.draining_key, self.duplicates_key)
+        for k in self._r.scan_iter(self.filter_key('*')):
+            self._r.delete(k)
 
     def pop_all(self):
         pipe = self._r.pipeline()
-        res = pipe.lrange(self.key, 0, -1).delete(self.key).execute()
-        return [r.decode() for r in res[0]]
+        pipe.lrange(self.list_key, 0, -1).get(self.draining_key).get(self.packed_key)
+        res = pipe.delete(self.list_key, self.draining_key, self.packed_key).execute()
+        return [r.decode() for r in res[0]] + self._decode(res[1]) + self._decode(res[2])
 
     def pop_all_iter(self, chunk_size=1000):
-        num_chunks = int(len(self)/chunk_size)
-        while num_chunks > 0:
-            pipe = self._r.pipeline()
-            res = pipe.lrange(self.key, 0, chunk_size-1).ltrim(self.key, chunk_size, -1).execute()
-            yield [r.decode() for r in res[0]]
-            num_chunks -= 1
-        if len(self) > 0:
-            # yield rest of data
-            yield self.pop_all()
-
-    def download_existing_data_dump(self):
-        logger.info(f'Downloading existing data dump with key {self.data_dump_key} to {self.local_file_compr}...')
-        success = self.s3_handler.download_file(self.local_file_compr, self.data_dump_key)
+        yield from self._pop_all_iter_list(chunk_size)
+        yield from self._pop_all_iter_packed(chunk_size)
+
+    def download_existing_data_dump(self, local_path):
+        logger.info(f'Downloading existing data dump with key {self.data_dump_key} to {local_path}...')
+        success = self.s3_handler.download_file(local_path, self.data_dump_key)
         return success
 
     def sync(self):
+        """Upload new ids to S3. New data is compressed separately and appended as a new gzip member to the existing file
+        (concatenated gzip members form a valid gzip file). Cost therefore only depends on the amount of new data."""
         num_new_data = len(self)
         if num_new_data == 0:
             logger.info(f'No new data was collected. Aborting.')
@@ -80,30 +181,134 @@ class DataDumpIds(Redis):
                 chunk = list(set(chunk))
                 if len(chunk) > 0:
                     f.write('\n'.join(chunk) + '\n')
-        logger.info(f'Collected {num_new_data:,} ids')
-        if self.s3_handler.file_exists(self.data_dump_key):
-            success = self.download_existing_data_dump()
+        num_duplicates = self.pop_num_duplicates()
+        dedup_rate = num_duplicates / (num_new_data + num_duplicates)
+        logger.info(f'Collected {num_new_data:,} ids (dropped {num_duplicates:,} duplicates on ingestion, dedup rate {100*dedup_rate:.2f}%)')
+        # compress new data
+        compress(self.local_file_tmp, self.local_file_compr)
+        os.remove(self.local_file_tmp)
+        existing_size = self.s3_handler.file_size(self.data_dump_key)
+        if existing_size is None:
+            # There is no existing data, simply upload file
+            logger.info(f'Uploading file to S3 under key {self.data_dump_key}')
+            success = self.s3_handler.upload_file(self.local_file_compr, self.data_dump_key, make_public=True)
+        elif existing_size >= self.s3_handler.MIN_PART_SIZE:
+            # Append on S3 without downloading existing data
+            logger.info(f'Appending new data to file {self.data_dump_key} on S3')
+            success = self.s3_handler.append_to_file(self.local_file_compr, self.data_dump_key, make_public=True)
+        else:
+            # Existing file is too small for a server-side append, append locally
+            success = self.download_existing_data_dump(self.local_file)
             if not success:
                 logger.error(f'Something went wrong when trying to download the existing data. Aborting.')
                 return
-            # decompress data
-            decompress(self.local_file_compr, self.local_file)
-            os.remove(self.local_file_compr)
-            # concatenating new data
-            with open(self.local_file, 'a') as f:
-                shutil.copyfileobj(open(self.local_file_tmp, 'r'), f)
-        else:
-            # There is no existing data, simply rename file
-            os.rename(self.local_file_tmp, self.local_file)
-        # reuploading file
-        logger.info(f'Compressing file...')
-        compress(self.local_file, self.local_file_compr)
-        logger.info(f'Uploading file to S3 under key {self.data_dump_key}')
-        success = self.s3_handler.upload_file(self.local_file_compr, self.data_dump_key, make_public=True)
+            with open(self.local_file, 'ab') as f:
+                shutil.copyfileobj(open(self.local_file_compr, 'rb'), f)
+            logger.info(f'Uploading file to S3 under key {self.data_dump_key}')
+            success = self.s3_handler.upload_file(self.local_file, self.data_dump_key, make_public=True)
         if not success:
             report_error(logger, msg='Uploading data dump Ids file to S3 unsuccessful.')
-        # cleanup
+        self.cleanup()
+
+    def compact(self):
+        """Remove all duplicates and recompress the data dump into a single gzip member (which compresses better than many small members).
+        Ids are sorted in the process (which, for tweet ids, corresponds to chronological order)."""
+        if not self.s3_handler.file_exists(self.data_dump_key):
+            logger.info(f'No data dump found under key {self.data_dump_key}. Aborting.')
+            return
+        success = self.download_existing_data_dump(self.local_file_compr)
+        if not success:
+            logger.error(f'Something went wrong when trying to download the existing data. Aborting.')
+            return
+        logger.info(f'Compacting file {self.data_dump_key}...')
+        decompress(self.local_file_compr, self.local_file)
+        num_ids, num_unique = self.sort_unique(self.local_file, self.local_file_tmp)
+        if num_ids > 0:
+            logger.info(f'Removed {num_ids - num_unique:,} duplicates from {num_ids:,} ids (dedup rate {100*(num_ids - num_unique)/num_ids:.2f}%)')
+        compress(self.local_file_tmp, self.local_file_compr)
+        success = self.s3_handler.upload_file(self.local_file_compr, self.data_dump_key, make_public=True)
+        if not success:
+            report_error(logger, msg='Uploading compacted data dump Ids file to S3 unsuccessful.')
+        self.cleanup()
+
+    def sort_unique(self, input_file, output_file, chunk_size=1000000):
+        """External merge sort of ids in input_file which removes duplicates. Only chunk_size ids are kept in memory at a time.
+        Returns number of ids read and number of unique ids written."""
+        sort_key = lambda _id: (len(_id), _id)  # numeric order for strings of digits
+        chunk_files = []
+        num_ids = 0
+        with open(input_file, 'r') as f:
+            while True:
+                chunk = [line.strip() for _, line in zip(range(chunk_size), f)]
+                chunk = [_id for _id in chunk if _id != '']
+                if len(chunk) == 0:
+                    break
+                num_ids += len(chunk)
+                chunk_file = f'{output_file}.chunk{len(chunk_files)}'
+                with open(chunk_file, 'w') as f_chunk:
+                    f_chunk.write('\n'.join(sorted(set(chunk), key=sort_key)) + '\n')
+                chunk_files.append(chunk_file)
+        num_unique = 0
+        chunks = [open(chunk_file, 'r') for chunk_file in chunk_files]
+        try:
+            with open(output_file, 'w') as f_out:
+                last_id = None
+                for _id in heapq.merge(*[(line.strip() for line in chunk) for chunk in chunks], key=sort_key):
+                    if _id != last_id:
+                        f_out.write(_id + '\n')
+                        num_unique += 1
+                        last_id = _id
+        finally:
+            for chunk, chunk_file in zip(chunks, chunk_files):
+                chunk.close()
+                os.remove(chunk_file)
+        return num_ids, num_unique
+
+    def cleanup(self):
         logger.info('Cleaning up temporary files...')
         for f in [self.local_file, self.local_file_tmp, self.local_file_compr]:
             if os.path.isfile(f):
                 os.remove(f)
+
+    # private methods
+
+    def _encode(self, value):
+        if self.encoding == 'packed':
+            return struct.pack(self.ID_FORMAT, int(value))
+        return value
+
+    def _decode(self, data):
+        if data is None:
+            return []
+        return np.frombuffer(data, dtype=self.ID_DTYPE).astype(str).tolist()
+
+    def _pop_all_iter_list(self, chunk_size):
+        """Drain list of ids in chunks (ids added in the meantime are left for the next drain)"""
+        num_chunks = -(-self._r.llen(self.list_key) // chunk_size)
+        for _ in range(num_chunks):
+            res = self._r.pipeline().lrange(self.list_key, 0, chunk_size-1).ltrim(self.list_key, chunk_size, -1).execute()
+            if len(res[0]) > 0:
+                yield [r.decode() for r in res[0]]
+
+    def _pop_all_iter_packed(self, chunk_size):
+        """Drain packed ids in chunks. The id string is first renamed so that ids added in the meantime go to a new string.
+        A draining key left over from an interrupted drain is consumed first (followed by the ids collected since)."""
+        num_drains = 2 if self._r.exists(self.draining_key) else 1
+        for _ in range(num_drains):
+            if not self._r.exists(self.draining_key):
+                try:
+                    self._r.rename(self.packed_key, self.draining_key)
+                except redis.exceptions.ResponseError:
+                    # no data
+                    return
+            size = self._r.strlen(self.draining_key)
+            chunk_bytes = chunk_size * self.ID_SIZE
+            for start in range(0, size, chunk_bytes):
+                yield self._decode(self._r.getrange(self.draining_key, start, start + chunk_bytes - 1))
+            self._r.delete(self.draining_key)
+
+    def _key(self, key_namespace):
+        if self.mode is None:
+            return "{}:{}:{}".format(self.namespace, key_namespace, self.project)
+        else:
+            return "{}:{}:{}:{}".format(self.namespace, key_namespace, self.project, self.mode)
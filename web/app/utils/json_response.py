@@ -0,0 +1,94 @@
+from flask import Response, request, stream_with_context
+from types import GeneratorType
+import numpy as np
+import orjson
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# numpy arrays/scalars and datetime objects are serialized natively (datetimes without tzinfo are assumed to be UTC)
+OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+CHUNK_SIZE = 64*1024  # size of streamed chunks (before compression)
+STREAM_DEPTH = 2  # top-level objects/arrays (and their values) are streamed element by element
+GZIP_LEVEL = 6
+
+
+def dumps(obj):
+    """Fast JSON serialization (returns bytes)"""
+    return orjson.dumps(obj, default=_default, option=OPTIONS)
+
+def loads(s):
+    return orjson.loads(s)
+
+def json_response(obj, status=200, headers=None):
+    """Streamed JSON response. Lists and generators (e.g. of Elasticsearch hits) are serialized element by element as they are
+    produced, already serialized JSON can be passed as bytes. The response is gzip-compressed if the client accepts it."""
+    if isinstance(obj, bytes):
+        chunks = (obj[i:i+CHUNK_SIZE] for i in range(0, len(obj), CHUNK_SIZE))
+    else:
+        chunks = buffer_chunks(iter_json(obj))
+    resp_headers = {'Vary': 'Accept-Encoding'}
+    if accepts_gzip():
+        chunks = gzip_chunks(chunks)
+        resp_headers['Content-Encoding'] = 'gzip'
+    resp = Response(stream_with_context(chunks), status=status, mimetype='application/json', headers=resp_headers)
+    if headers is not None:
+        resp.headers.extend(headers)
+    return resp
+
+def accepts_gzip():
+    return request.accept_encodings['gzip'] > 0
+
+def iter_json(obj, depth=0):
+    """Yields serialized parts of obj"""
+    if depth >= STREAM_DEPTH:
+        yield dumps(obj)
+    elif isinstance(obj, dict):
+        yield b'{'
+        for i, (key, value) in enumerate(obj.items()):
+            yield (b',' if i > 0 else b'') + dumps(str(key)) + b':'
+            yield from iter_json(value, depth=depth+1)
+        yield b'}'
+    elif isinstance(obj, (list, tuple, GeneratorType, map, filter)):
+        yield b'['
+        for i, item in enumerate(obj):
+            if i > 0:
+                yield b','
+            yield from iter_json(item, depth=depth+1)
+        yield b']'
+    else:
+        yield dumps(obj)
+
+def buffer_chunks(parts, chunk_size=CHUNK_SIZE):
+    """Merge small parts into chunks of at least chunk_size bytes"""
+    buffer = []
+    size = 0
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if size > 0:
+        yield b''.join(buffer)
+
+def gzip_chunks(chunks, level=GZIP_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if len(compressed) > 0:
+            yield compressed
+    yield compressor.flush()
+
+# private methods
+
+def _default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, bytes):
+        return obj.decode()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
@@ -70,25 +70,27 @@ class StreamStatusMailer(Mailer):
         now_utc = pytz.utc.localize(end_day)
         timezone_hour_delta = get_tz_difference()
         total = defaultdict(lambda: 0)
-        for stream in project_config.read():
+        streams = project_config.read()
+        media_types = ['tweets', 'photo', 'animated_gif', 'media_deduplicated', 'media_bytes_saved']
+        counts = redis_s3_queue.get_counts_bulk([stream['slug'] for stream in streams], start_day, end_day, media_types=media_types, hourly=hourly)
+        for stream in streams:
             total_by_project = defaultdict(lambda: 0)
             project = stream['es_index_name']
             project_slug = stream['slug']
             stats += "<h3>{}</h3>".format(project)
             count_types = ['tweets']
             if stream['image_storage_mode'] != 'inactive':
-                count_types += ['photo', 'animated_gif']
+                count_types += ['photo', 'animated_gif', 'media_deduplicated', 'media_bytes_saved']
             for count_type in count_types:
                 stats += '<h4>{}</h4>'.format(count_type)
-                for d in dates:
+                for date in dates:
+                    count = counts[project_slug][count_type][date]
                     if hourly:
-                        d, h = d.split(':')
-                        count = redis_s3_queue.get_counts(project_slug, d, h, media_type=count_type)
+                        d, h = date.split(':')
                         corrected_hour = (datetime.strptime(h, '%H') - timezone_hour_delta).strftime('%H')
                         stats += '{0} ({1}:00 - {1}:59): {2:,}<br>'.format(d, corrected_hour, count)
                     else:
-                        count = redis_s3_queue.get_counts(project_slug, d, media_type=count_type)
-                        stats += '{}: {:,}<br>'.format(d, count)
+                        stats += '{}: {:,}<br>'.format(date, count)
                     total[count_type] += count
                     total_by_project[count_type] += count
                 stats += 'Total: {:,}<br><br>'.format(total_by_project[count_type])
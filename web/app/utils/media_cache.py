@@ -0,0 +1,49 @@
+from app.settings import Config
+from app.utils.redis import Redis
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MediaCache(Redis):
+    """
+    Index of media already stored on S3, keyed by project index and media URL. The same media is often attached to many tweets
+    (or quoted tweets), repeated media is therefore recorded as a reference to the existing S3 key instead of being downloaded again.
+    Media is only deduplicated within a project (so that each project's S3 prefix stays self-contained).
+    Media is only registered once it was successfully stored, entries expire after `ttl` seconds without being seen.
+    """
+
+    def __init__(self, ttl=None, **args):
+        super().__init__(**args)
+        self.config = Config()
+        self.namespace = self.config.REDIS_NAMESPACE
+        self.key_namespace = 'media-cache'
+        if ttl is None:
+            ttl = self.config.MEDIA_CACHE_TTL
+        self.ttl = ttl
+
+    def key(self, es_index_name, media_url):
+        return "{}:{}:{}:{}".format(self.namespace, self.key_namespace, es_index_name, media_url)
+
+    def lookup(self, es_index_name, media_url):
+        """Returns a tuple (s3_key, num_bytes) if media was already stored, else None"""
+        key = self.key(es_index_name, media_url)
+        existing_s3_key, num_bytes = self._r.hmget(key, 's3_key', 'bytes')
+        if existing_s3_key is None:
+            return None
+        self._r.pipeline().hincrby(key, 'num_references', 1).expire(key, self.ttl).execute()
+        num_bytes = 0 if num_bytes is None else int(num_bytes)
+        return existing_s3_key.decode(), num_bytes
+
+    def store(self, es_index_name, media_url, s3_key, num_bytes):
+        """Register media after it was successfully stored under s3_key (an existing entry is kept)"""
+        key = self.key(es_index_name, media_url)
+        # size is set before the key, since lookups only consider entries with a key
+        self._r.pipeline().hsetnx(key, 'bytes', num_bytes).hsetnx(key, 's3_key', s3_key).expire(key, self.ttl).execute()
+
+    def get(self, es_index_name, media_url):
+        return {k.decode(): v.decode() for k, v in self._r.hgetall(self.key(es_index_name, media_url)).items()}
+
+    def self_remove(self):
+        for key in self._r.scan_iter(self.key('*', '*')):
+            self._r.delete(key)
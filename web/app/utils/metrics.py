@@ -0,0 +1,197 @@
+from app.settings import Config
+from app.utils.redis import Redis
+from helpers import report_error
+from collections import defaultdict
+import bisect
+import threading
+import atexit
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = [.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60]
+
+# name: (type, description, histogram buckets)
+METRICS = {
+        'tweets_received_total': ('counter', 'Tweets received by the stream listener', None),
+        'tweets_matched_total': ('counter', 'Tweets matched to a project', None),
+        'tweets_unmatched_total': ('counter', 'Tweets which could not be matched to any project', None),
+        'handle_tweet_stage_duration_seconds': ('histogram', 'Duration of handle_tweet stages', DEFAULT_BUCKETS),
+        'es_bulk_batch_duration_seconds': ('histogram', 'Duration of Elasticsearch bulk batches', DEFAULT_BUCKETS),
+        's3_upload_duration_seconds': ('histogram', 'Duration of S3 uploads of stream data', DEFAULT_BUCKETS),
+        'tweet_index_lag_seconds': ('histogram', 'Time between tweet creation (timestamp_ms) and indexing in Elasticsearch',
+            [1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]),
+        'queue_depth': ('gauge', 'Number of items waiting in queue', None)
+        }
+
+
+class Metrics(Redis):
+    """
+    Counters and histograms shared by all processes. Observations are buffered in memory and flushed to Redis (in a
+    single pipeline) at most every `flush_interval` seconds, so recording a metric on the hot path doesn't cost a round trip.
+    """
+
+    def __init__(self, flush_interval=None, **args):
+        super().__init__(**args)
+        self.config = Config()
+        self.namespace = self.config.REDIS_NAMESPACE
+        self.key_namespace = 'metrics'
+        if flush_interval is None:
+            flush_interval = self.config.METRICS_FLUSH_INTERVAL
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self._reset_buffer()
+
+    @property
+    def counters_key(self):
+        return "{}:{}:{}".format(self.namespace, self.key_namespace, 'counters')
+
+    @property
+    def histograms_key(self):
+        return "{}:{}:{}".format(self.namespace, self.key_namespace, 'histograms')
+
+    def inc(self, name, value=1, **labels):
+        field = self._field(name, labels)
+        with self.lock:
+            self._check_pid()
+            self.counters[field] += value
+        self.maybe_flush()
+
+    def observe(self, name, value, **labels):
+        field = self._field(name, labels)
+        buckets = METRICS[name][2]
+        bucket = bisect.bisect_left(buckets, value)
+        le = buckets[bucket] if bucket < len(buckets) else '+Inf'
+        with self.lock:
+            self._check_pid()
+            self.histograms[f'{field}|{le}'] += 1
+            self.histograms[f'{field}|sum'] += value
+            self.histograms[f'{field}|count'] += 1
+        self.maybe_flush()
+
+    def timer(self, name, **labels):
+        return Timer(self, name, **labels)
+
+    def stage_timer(self, name):
+        """Records the time between consecutive `lap(stage)` calls under label `stage`"""
+        return StageTimer(self, name)
+
+    def maybe_flush(self):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            self._check_pid()
+            counters, histograms = self.counters, self.histograms
+            self.counters, self.histograms = defaultdict(float), defaultdict(float)
+            self.last_flush = time.time()
+        if len(counters) == 0 and len(histograms) == 0:
+            return
+        pipe = self._r.pipeline(transaction=False)
+        for field, value in counters.items():
+            pipe.hincrbyfloat(self.counters_key, field, value)
+        for field, value in histograms.items():
+            pipe.hincrbyfloat(self.histograms_key, field, value)
+        try:
+            pipe.execute()
+        except:
+            report_error(logger, msg='Failed to flush metrics to Redis', exception=True)
+
+    def render(self, gauges=None):
+        """Render all metrics in Prometheus text exposition format. Gauges can be passed as a list of (name, labels, value) tuples."""
+        pipe = self._r.pipeline()
+        counters, histograms = pipe.hgetall(self.counters_key).hgetall(self.histograms_key).execute()
+        samples = defaultdict(list)
+        for field, value in counters.items():
+            name, labels = field.decode().split('|')
+            samples[name].append((name, labels, float(value)))
+        by_series = defaultdict(dict)
+        for field, value in histograms.items():
+            name, labels, suffix = field.decode().split('|')
+            by_series[(name, labels)][suffix] = float(value)
+        for (name, labels), values in sorted(by_series.items()):
+            cumulative_count = 0
+            for le in METRICS[name][2]:
+                cumulative_count += values.get(str(le), 0)
+                samples[name].append((name + '_bucket', self._join_labels(labels, f'le="{le}"'), cumulative_count))
+            samples[name].append((name + '_bucket', self._join_labels(labels, 'le="+Inf"'), values.get('count', 0)))
+            samples[name].append((name + '_sum', labels, values.get('sum', 0)))
+            samples[name].append((name + '_count', labels, values.get('count', 0)))
+        for name, labels, value in (gauges or []):
+            samples[name].append((name, self._label_str(labels), value))
+        lines = []
+        for name in sorted(samples):
+            metric_type, description, _ = METRICS.get(name, ('untyped', '', None))
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for sample_name, labels, value in samples[name]:
+                labels = '{' + labels + '}' if labels != '' else ''
+                lines.append(f'{sample_name}{labels} {self._format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def self_remove(self):
+        self._r.delete(self.counters_key, self.histograms_key)
+        self._reset_buffer()
+
+    # private methods
+
+    def _reset_buffer(self):
+        self.pid = os.getpid()
+        self.counters = defaultdict(float)
+        self.histograms = defaultdict(float)
+        self.last_flush = time.time()
+
+    def _check_pid(self):
+        # buffered values of a parent process are flushed by the parent
+        if self.pid != os.getpid():
+            self._reset_buffer()
+
+    def _field(self, name, labels):
+        if name not in METRICS:
+            raise ValueError(f'Unknown metric {name}')
+        return f'{name}|{self._label_str(labels)}'
+
+    def _label_str(self, labels):
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('|', '_')
+        return ','.join([f'{k}="{escape(v)}"' for k, v in sorted(labels.items())])
+
+    def _format_value(self, value):
+        value = float(value)
+        return str(int(value)) if value.is_integer() else repr(value)
+
+    def _join_labels(self, *labels):
+        return ','.join([l for l in labels if l != ''])
+
+
+class Timer():
+    def __init__(self, metrics, name, **labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.t_start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.name, time.time() - self.t_start, **self.labels)
+
+
+class StageTimer():
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.t_last = time.time()
+
+    def lap(self, stage, **labels):
+        now = time.time()
+        self.metrics.observe(self.name, now - self.t_last, stage=stage, **labels)
+        self.t_last = now
+
+
+# Process-wide instance (flushes its remaining buffer when the process exits)
+metrics = Metrics()
+atexit.register(metrics.flush)
@@ -3,6 +3,7 @@ import os
 import random
 import logging
 from app.utils.redis import Redis
+from app.settings import Config
 from helpers import report_error
 import json
 import collections
@@ -15,6 +16,32 @@ class PriorityQueue(Redis):
 
     MAX_ELEMENT_PRINT = 100  # maximum number of items to print when printing an instance of this class
     MAX_QUEUE_LENGTH = 1000
+    # Atomically push value to queue. If the value is new and the queue is full, first remove random lowest priority elements.
+    # Removed elements are also deleted from the hashes KEYS[2..n] (optional).
+    # Returns flat list of removed elements and their scores.
+    ADD_CAPPED_SCRIPT = """
+    local key = KEYS[1]
+    local value = ARGV[1]
+    local max_length = tonumber(ARGV[3])
+    math.randomseed(tonumber(ARGV[4]))
+    local removed = {}
+    if not redis.call('ZSCORE', key, value) then
+        while redis.call('ZCARD', key) >= max_length do
+            local lowest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+            local num_elements = redis.call('ZCOUNT', key, lowest[2], lowest[2])
+            local rand_index = math.random(num_elements) - 1
+            local item = redis.call('ZRANGE', key, rand_index, rand_index, 'WITHSCORES')
+            redis.call('ZREMRANGEBYRANK', key, rand_index, rand_index)
+            for i = 2, #KEYS do
+                redis.call('HDEL', KEYS[i], item[1])
+            end
+            removed[#removed + 1] = item[1]
+            removed[#removed + 1] = item[2]
+        end
+    end
+    redis.call('ZADD', key, ARGV[2], value)
+    return removed
+    """
 
     def __init__(self, project, namespace='cb', key_namespace='pq', max_queue_length=1000, **args):
         super().__init__(self, **args)
@@ -24,6 +51,7 @@ class PriorityQueue(Redis):
         self.namespace = namespace
         self.key_namespace = key_namespace
         self.MAX_QUEUE_LENGTH = max_queue_length
+        self._add_capped = None
 
     def __len__(self):
         return self._r.zcard(self.key)
@@ -49,15 +77,18 @@ class PriorityQueue(Redis):
     def key(self):
         return "{}:{}:{}".format(self.namespace, self.key_namespace, self.project)
 
-    def add(self, value, priority=0):
-        """Push value with given priority to queue. Enforce max length of queue by removing low-priority elements."""
-        removed = []
-        while len(self) >= self.MAX_QUEUE_LENGTH:
-            item = self.remove_lowest_priority()
-            if item is not None:
-                removed.extend(item)
-        self._r.zadd(self.key, {value: priority})
-        return removed
+    def add(self, value, priority=0, linked_hash_keys=None):
+        """Push value with given priority to queue. Enforce max length of queue by removing random low-priority elements.
+        This happens atomically in a single Lua script. Removed elements are also deleted from the hashes `linked_hash_keys`.
+
+        Returns list of removed (element, priority) tuples.
+        """
+        keys = [self.key]
+        if linked_hash_keys is not None:
+            keys.extend(linked_hash_keys)
+        args = [value, priority, self.MAX_QUEUE_LENGTH, random.randint(0, 2**31)]
+        res = self._add_capped_script(keys=keys, args=args)
+        return [(res[i], float(res[i+1])) for i in range(0, len(res), 2)]
 
     def pop(self, remove=False):
         """Get key with highest priority, optionally also remove that key from queue"""
@@ -184,68 +215,145 @@ class PriorityQueue(Redis):
         else:
             return True
 
+    # private methods
+
+    @property
+    def _add_capped_script(self):
+        if self._add_capped is None:
+            self._add_capped = self._r.register_script(self.ADD_CAPPED_SCRIPT)
+        return self._add_capped
+
 class TweetStore(Redis):
-    """Stores tweets with the tweet ID as the key and the tweet as a hash"""
+    """Stores tweets of a project in a single Redis hash (tweet ID -> tweet)"""
 
-    def __init__(self, namespace='cb', key_namespace='tweet_store', **kwargs):
+    def __init__(self, project, namespace='cb', key_namespace='tweet_store', **kwargs):
         super().__init__(self, **kwargs)
+        self.project = project
         self.namespace = namespace
         self.key_namespace = key_namespace
 
     def __repr__(self):
         s = ''
-        for i, k in enumerate(self._r.scan_iter(self.key('*'))):
-            tid = k.decode().split(':')[-1]
-            s += '{:02d}) {}\n'.format(i+1, tid)
+        for i, (tid, _) in enumerate(self._r.hscan_iter(self.key)):
+            s += '{:02d}) {}\n'.format(i+1, tid.decode())
         return s
 
     def __len__(self):
-        return len(self._r.keys(self.key('*')))
+        return self._r.hlen(self.key)
 
-    def key(self, tweet_id):
-        return "{}:{}:{}".format(self.namespace, self.key_namespace, tweet_id)
+    @property
+    def key(self):
+        return "{}:{}:{}".format(self.namespace, self.key_namespace, self.project)
 
     def add(self, tweet_id, tweet):
-        self._r.set(self.key(tweet_id), json.dumps(tweet).encode())
+        self._r.hset(self.key, tweet_id, json.dumps(tweet, separators=(',', ':')).encode())
 
     def get(self, tweet_id):
-        tweet = self._r.get(self.key(tweet_id))
+        tweet = self._r.hget(self.key, tweet_id)
         if tweet is None:
             return
         return json.loads(tweet.decode())
 
-    def cleanup(self, projects):
-        """This cleanup task is run occasionally to make sure there are no leftover keys in Redis"""
-        tweet_ids_keep = set()
-        for project in projects:
-            pq = PriorityQueue(project, namespace=self.namespace)
-            for item in pq:
-                tweet_ids_keep.add(item[0].decode())
-        logger.info(f'Cleanup tweet store: Found {len(tweet_ids_keep):,} items in priority queues')
-        num_removed = 0
-        for k in self._r.scan_iter(self.key('*')):
-            tweet_id = k.decode().split(':')[-1]
-            if tweet_id not in tweet_ids_keep:
-                self.remove(tweet_id)
-                num_removed += 1
-        logger.info(f'Cleanup tweet store: Successfully removed {num_removed:,} stale items')
+    def multi_get(self, tweet_ids):
+        if len(tweet_ids) == 0:
+            return []
+        return [json.loads(tweet.decode()) if tweet is not None else None for tweet in self._r.hmget(self.key, tweet_ids)]
+
+    def cleanup(self):
+        """This cleanup task is run occasionally to make sure there are no leftover tweets which are not in the priority queue anymore"""
+        pq = PriorityQueue(self.project, namespace=self.namespace)
+        tweet_ids = [tweet_id for tweet_id, _ in self._r.hscan_iter(self.key)]
+        if len(tweet_ids) == 0:
+            return
+        pipe = self._r.pipeline()
+        for tweet_id in tweet_ids:
+            pipe.zscore(pq.key, tweet_id)
+        scores = pipe.execute()
+        stale_tweet_ids = [tweet_id for tweet_id, score in zip(tweet_ids, scores) if score is None]
+        if len(stale_tweet_ids) > 0:
+            self._r.hdel(self.key, *stale_tweet_ids)
+        logger.info(f'Cleanup tweet store {self.project}: Successfully removed {len(stale_tweet_ids):,} stale items')
 
     def remove(self, tweet_id):
-        self._r.delete(self.key(tweet_id))
+        self._r.hdel(self.key, tweet_id)
 
     def remove_all(self):
-        for k in self._r.scan_iter(self.key('*')):
-            self._r.delete(k)
+        self._r.delete(self.key)
 
 class TweetIdQueue:
     """Handles Tweet IDs in a priority queue and keeps a record of which user classified what tweet as a set in Redis."""
 
-    def __init__(self, project, namespace='cb', logger=None, priority_threshold=3, **kwargs):
+    # Find the ARGV[4] highest priority tweet IDs (KEYS[1]) which have not yet been classified by a user. ARGV[1..3] describe the
+    # per-tweet user sets: backend ('set', 'bitmap' or 'none' for a user who has not classified anything), key prefix and the user's member.
+    # If KEYS[2] (TweetStore hash) is given, each tweet ID is followed by the stored tweet in the returned list.
+    RETRIEVE_FOR_USER_SCRIPT = """
+    local function is_member(tweet_id)
+        if ARGV[1] == 'set' then
+            return redis.call('SISMEMBER', ARGV[2] .. tweet_id, ARGV[3]) == 1
+        elseif ARGV[1] == 'bitmap' then
+            return redis.call('GETBIT', ARGV[2] .. tweet_id, ARGV[3]) == 1
+        end
+        return false
+    end
+    local num = tonumber(ARGV[4])
+    local batch_size = 100
+    local start = 0
+    local found = 0
+    local res = {}
+    while found < num do
+        local items = redis.call('ZREVRANGE', KEYS[1], start, start + batch_size - 1)
+        if #items == 0 then
+            break
+        end
+        for _, tweet_id in ipairs(items) do
+            if not is_member(tweet_id) then
+                res[#res + 1] = tweet_id
+                if KEYS[2] then
+                    res[#res + 1] = redis.call('HGET', KEYS[2], tweet_id)
+                end
+                found = found + 1
+                if found >= num then
+                    break
+                end
+            end
+        end
+        start = start + batch_size
+    end
+    return res
+    """
+    # Apply updates (pairs of tweet ID and user member in ARGV[4..n]). See TweetIdQueue.update for details.
+    # KEYS[1]: priority queue, KEYS[2]: TweetStore hash, ARGV[1]: priority threshold, ARGV[2]: backend of the per-tweet user sets
+    # ('set' or 'bitmap'), ARGV[3]: key prefix of the per-tweet user sets. Returns the number of applied updates.
+    MULTI_UPDATE_SCRIPT = """
+    local threshold = tonumber(ARGV[1])
+    local num_updated = 0
+    for i = 4, #ARGV, 2 do
+        local tweet_id = ARGV[i]
+        if redis.call('ZSCORE', KEYS[1], tweet_id) then
+            local score = tonumber(redis.call('ZINCRBY', KEYS[1], 1, tweet_id))
+            if score >= threshold then
+                redis.call('ZREM', KEYS[1], tweet_id)
+                redis.call('DEL', ARGV[3] .. tweet_id)
+                redis.call('HDEL', KEYS[2], tweet_id)
+            elseif ARGV[2] == 'bitmap' then
+                redis.call('SETBIT', ARGV[3] .. tweet_id, ARGV[i + 1], 1)
+            else
+                redis.call('SADD', ARGV[3] .. tweet_id, ARGV[i + 1])
+            end
+            num_updated = num_updated + 1
+        end
+    end
+    return num_updated
+    """
+
+    def __init__(self, project, namespace='cb', logger=None, priority_threshold=3, rset_backend=None, **kwargs):
         """
         :param project: Unique project name (used to name queue)
         :param namespace: Redis key namespace
         :param logger: Logger instance
         :param priority_threshold: Number of times tweet should be labelled before being removed from queue
+        :param rset_backend: Storage of users who classified a tweet, either 'set' (RedisSet) or 'bitmap' (RedisBitmapSet).
+            Defaults to config REDIS_RSET_BACKEND.
         """
         # logging
         if logger is None:
@@ -254,9 +362,18 @@ class TweetIdQueue:
             self.logger = logger
         self.project = project
         self.pq = PriorityQueue(project, namespace=namespace, max_queue_length=kwargs.get('max_queue_length', 1000))
-        self.rset = RedisSet(project, namespace=namespace, **kwargs)
-        self.tweet_store = TweetStore(namespace=namespace, **kwargs)
+        if rset_backend is None:
+            rset_backend = Config().REDIS_RSET_BACKEND
+        if rset_backend == 'set':
+            self.rset = RedisSet(project, namespace=namespace, **kwargs)
+        elif rset_backend == 'bitmap':
+            self.rset = RedisBitmapSet(project, namespace=namespace, **kwargs)
+        else:
+            raise ValueError(f'Unknown rset backend {rset_backend}')
+        self.tweet_store = TweetStore(project, namespace=namespace, **kwargs)
         self.priority_threshold = priority_threshold
+        self._retrieve_for_user = None
+        self._multi_update = None
 
     def add(self, tweet_id, priority=0):
         """Simply adds a new tweet_id to its priority queue"""
@@ -264,9 +381,8 @@ class TweetIdQueue:
 
     def add_tweet(self, tweet_id, tweet, priority=0):
         """Adds a new tweet to its priority queue and stores it in the TweetStore"""
-        removed_items = self.pq.add(tweet_id, priority=priority)
-        for item in removed_items:
-            self.tweet_store.remove(item[0].decode())
+        # evicted items are removed from the TweetStore within the same script
+        self.pq.add(tweet_id, priority=priority, linked_hash_keys=[self.tweet_store.key])
         self.tweet_store.add(tweet_id, tweet)
 
     def get(self, user_id=None):
@@ -288,24 +404,50 @@ class TweetIdQueue:
 
     def get_tweet(self, user_id=None):
         """Get tweet to classify for user ID """
-        # If no user is defined, simply pop the queue
-        tweet_id = self.get(user_id=user_id)
-        if tweet_id is None:
-            return None
-        tweet = self.tweet_store.get(tweet_id)
+        if user_id is None:
+            # If no user is defined, simply pop the queue
+            tweet_id = self.get()
+            if tweet_id is None:
+                return None
+            tweet = self.tweet_store.get(tweet_id)
+        else:
+            tweet_id, tweet = self.retrieve_tweet_for_user(user_id)
+            if tweet_id is None:
+                report_error(self.logger, msg='No new tweet could be found for user_id {}'.format(user_id))
+                return None
         if tweet is None:
             tweet = {}
         tweet['id'] = tweet_id
         return tweet
 
+    def get_tweets(self, num, user_id=None):
+        """Get up to `num` tweets to classify for user ID"""
+        if user_id is None:
+            tweet_ids = self.pq.multi_pop(num)
+            items = zip(tweet_ids, self.tweet_store.multi_get(tweet_ids))
+        else:
+            items = self._retrieve(user_id, num=num, with_tweet=True)
+        tweets = []
+        for tweet_id, tweet in items:
+            if tweet is None:
+                tweet = {}
+            tweet['id'] = tweet_id
+            tweets.append(tweet)
+        return tweets
+
     def retrieve_for_user(self, user_id):
-        num = 3
-        starts = [num*i for i in range(1 + (len(self.pq)//num))]
-        for s in starts:
-            item_range = self.pq._r.zrevrangebyscore(self.pq.key, '+inf', '-inf', start=s, num=num, withscores=True)
-            for tweet_id, score in item_range:
-                if not self.rset.is_member(tweet_id.decode(), user_id):
-                    return tweet_id.decode()
+        """Get highest priority tweet ID which has not been classified by user ID yet"""
+        items = self._retrieve(user_id)
+        if len(items) == 0:
+            return None
+        return items[0][0]
+
+    def retrieve_tweet_for_user(self, user_id):
+        """Same as retrieve_for_user but additionally returns the tweet from the TweetStore (None if not stored)"""
+        items = self._retrieve(user_id, with_tweet=True)
+        if len(items) == 0:
+            return None, None
+        return items[0]
 
     def update(self, tweet_id, user_id):
         """Track the fact that user user_id classified tweet_id.
@@ -331,6 +473,22 @@ class TweetIdQueue:
         # add user to set of tweet_id
         self.rset.add(tweet_id, user_id)
 
+    def multi_update(self, updates):
+        """Apply a list of (tweet_id, user_id) updates in a single round trip. Returns number of applied updates."""
+        if len(updates) == 0:
+            return 0
+        if self._multi_update is None:
+            self._multi_update = self.pq._r.register_script(self.MULTI_UPDATE_SCRIPT)
+        args = [self.priority_threshold, self.rset.backend, self.rset.key('')]
+        members = {user_id: self.rset.script_member(user_id, create=True) for user_id in set(user_id for _, user_id in updates)}
+        for tweet_id, user_id in updates:
+            args.extend([tweet_id, members[user_id]])
+        num_updated = self._multi_update(keys=[self.pq.key, self.tweet_store.key], args=args)
+        if num_updated < len(updates):
+            report_error(self.logger, msg='{} of {} updates could not be applied because keys do not exist anymore.'.format(
+                len(updates) - num_updated, len(updates)), level='warning')
+        return num_updated
+
     def remove(self, tweet_id):
         """Remove a tweet from Redis set, PQueue and TweetStore"""
         if self.pq.exists(tweet_id):
@@ -347,8 +505,33 @@ class TweetIdQueue:
         self.rset.self_remove_all()
         self.tweet_store.remove_all()
 
+    # private methods
+
+    def _retrieve(self, user_id, num=1, with_tweet=False):
+        """Runs retrieve script in a single round trip. Returns list of (tweet_id, tweet) tuples."""
+        if self._retrieve_for_user is None:
+            self._retrieve_for_user = self.pq._r.register_script(self.RETRIEVE_FOR_USER_SCRIPT)
+        keys = [self.pq.key]
+        if with_tweet:
+            keys.append(self.tweet_store.key)
+        member = self.rset.script_member(user_id)
+        backend = self.rset.backend if member is not None else 'none'
+        res = self._retrieve_for_user(keys=keys, args=[backend, self.rset.key(''), member if member is not None else '', num])
+        if not with_tweet:
+            return [(tweet_id.decode(), None) for tweet_id in res]
+        items = []
+        for tweet_id, tweet in zip(res[::2], res[1::2]):
+            if tweet is not None:
+                tweet = json.loads(tweet.decode())
+            items.append((tweet_id.decode(), tweet))
+        return items
+
 
 class RedisSet(Redis):
+    """Keeps a Redis set of users for each tweet ID (e.g. to remember which users have classified a tweet)"""
+
+    backend = 'set'
+
     def __init__(self, project, namespace='cb', key_namespace='tweet_id', **args):
         super().__init__(self)
         # logging
@@ -366,6 +549,10 @@ class RedisSet(Redis):
     def is_member(self, set_key, value):
         return self._r.sismember(self.key(set_key), value)
 
+    def script_member(self, value, create=False):
+        """Representation of value in Lua scripts operating on the sets"""
+        return value
+
     def remove(self, set_key):
         self._r.delete(self.key(set_key))
 
@@ -387,3 +574,85 @@ class RedisSet(Redis):
     def self_remove_all(self):
         for k in self._r.scan_iter(self.key('*')):
             self._r.delete(k)
+
+
+class RedisBitmapSet(Redis):
+    """Same interface as RedisSet, but members of each set are stored as bits in a bitmap.
+    Values (users) are mapped to small integers (bit offsets) which are kept in a single hash per project.
+    """
+
+    backend = 'bitmap'
+
+    # Get offset of value ARGV[1] in hash KEYS[1], assign the next free offset if value is new
+    GET_OR_CREATE_OFFSET_SCRIPT = """
+    local offset = redis.call('HGET', KEYS[1], ARGV[1])
+    if offset then
+        return tonumber(offset)
+    end
+    offset = redis.call('HLEN', KEYS[1])
+    redis.call('HSET', KEYS[1], ARGV[1], offset)
+    return offset
+    """
+
+    def __init__(self, project, namespace='cb', key_namespace='tweet_id_bitmap', **args):
+        super().__init__(self)
+        self.logger = logging.getLogger('RedisBitmapSet')
+        self.project = project
+        self.namespace = namespace
+        self.key_namespace = key_namespace
+        self._get_or_create_offset = None
+
+    def key(self, set_key):
+        return "{}:{}:{}:{}".format(self.namespace, self.key_namespace, self.project, set_key)
+
+    @property
+    def offsets_key(self):
+        return "{}:{}-offsets:{}".format(self.namespace, self.key_namespace, self.project)
+
+    def offset(self, value, create=False):
+        """Bit offset of value (None if value is unknown and create is False)"""
+        if create:
+            if self._get_or_create_offset is None:
+                self._get_or_create_offset = self._r.register_script(self.GET_OR_CREATE_OFFSET_SCRIPT)
+            return self._get_or_create_offset(keys=[self.offsets_key], args=[value])
+        offset = self._r.hget(self.offsets_key, value)
+        if offset is None:
+            return None
+        return int(offset)
+
+    def add(self, set_key, value):
+        self._r.setbit(self.key(set_key), self.offset(value, create=True), 1)
+
+    def is_member(self, set_key, value):
+        offset = self.offset(value)
+        if offset is None:
+            return False
+        return self._r.getbit(self.key(set_key), offset) == 1
+
+    def script_member(self, value, create=False):
+        """Representation of value in Lua scripts operating on the bitmaps (bit offset)"""
+        return self.offset(value, create=create)
+
+    def remove(self, set_key):
+        self._r.delete(self.key(set_key))
+
+    def num_members(self, set_key):
+        return self._r.bitcount(self.key(set_key))
+
+    def print_members(self, set_key):
+        key = self.key(set_key)
+        if not self._r.exists(key):
+            print('Key {} is empty.'.format(key))
+            return
+        output = 'Members of key {}:\n'.format(key)
+        count = 1
+        for value, offset in self._r.hscan_iter(self.offsets_key):
+            if self._r.getbit(key, int(offset)) == 1:
+                output += "{:02d}) {}\n".format(count, value.decode())
+                count += 1
+        print(output)
+
+    def self_remove_all(self):
+        for k in self._r.scan_iter(self.key('*')):
+            self._r.delete(k)
+        self._r.delete(self.offsets_key)
@@ -2,16 +2,25 @@ from app.settings import Config
 from app.stream.redis_s3_queue import RedisS3Queue
 from app.stream.s3_handler import S3Handler
 from app.utils.redis import Redis
+from app.utils.media_cache import MediaCache
 from helpers import report_error
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import io
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import requests
 import pytz
-import urllib
 import logging
 import os
 
+logger = logging.getLogger(__name__)
+
 class ProcessMedia():
-    """Process media (such as images) and store on S3"""
+    """Collect media (such as images) of a tweet. Media to be stored on S3 is returned as descriptors which are
+    downloaded separately by the MediaDownloader (see handle_media task). Media which is already stored is returned as
+    a reference descriptor (with the existing key under `ref`), for which only a small pointer object is stored."""
 
     def __init__(self, tweet, project, image_storage_mode='active'):
         self.tweet = tweet
@@ -19,51 +28,50 @@ class ProcessMedia():
         self.project_slug = project
         self.config = Config()
         self.namespace = self.config.REDIS_NAMESPACE
-        self.tmp_path = os.path.join(self.config.APP_DIR, 'tmp')
         self.image_storage_mode = image_storage_mode
         self.redis_s3_queue = RedisS3Queue()
-        self.s3 = S3Handler()
+        self.media_cache = MediaCache()
         self.logger = logging.getLogger(__name__)
         self.download_media_types = ['photo', 'animated_gif']
 
     def process(self):
+        """Update media counts and return a list of media descriptors (url, size, key, es_index_name and optionally ref) to be stored"""
         # Don't collect any information from retweets
         if 'retweeted_status' in self.tweet:
             self.logger.debug('Tweet is retweet.')
-            return
+            return []
         if self.is_possibly_sensitive and self.image_storage_mode == 'avoid_possibly_sensitive':
             self.logger.debug('Media is not collected for sensitive media in this project.')
-            return
+            return []
 
         # collect media info and update counts
         media_info = self.collect_media_info()
         if not media_info['has_media']:
             self.logger.debug('Tweet contains no media.')
-            return
+            return []
         for media_type, count in media_info['counts'].items():
             self.redis_s3_queue.update_counts(self.project_slug, media_type=media_type)
 
-        # download media and upload to S3
+        # collect media to be downloaded and uploaded to S3
+        media = []
         idx = 0
         for media_type, urls in media_info['media_urls'].items():
             if media_type in self.download_media_types:
                 for url, tweet_id, size_info in zip(urls, media_info['tweet_ids'][media_type], media_info['sizes'][media_type]):
                     f_name = self.get_f_name(url, media_type, tweet_id, idx, size_info)
-                    local_path = os.path.join(self.tmp_path, f_name)
-                    self.download_media(url, local_path, size_info['size'])
                     key = self.get_s3_key(f_name)
-                    self.s3.upload_file(local_path, key)
-                    if os.path.isfile(local_path):
-                        os.remove(local_path)
                     idx += 1
-
-    def download_media(self, url, f_name, size):
-        # set format
-        url = "{}:{}".format(url, size)
-        try:
-            urllib.request.urlretrieve(url, f_name)
-        except Exception as e:
-            report_error(self.logger, exception=True)
+                    descriptor = {'url': url, 'size': size_info['size'], 'key': key, 'es_index_name': self.es_index_name}
+                    cached = self.media_cache.lookup(self.es_index_name, url)
+                    if cached is not None:
+                        # media was already stored, only keep reference
+                        existing_key, num_bytes = cached
+                        self.logger.debug(f'Media {url} is already stored under key {existing_key}.')
+                        self.redis_s3_queue.update_counts(self.project_slug, media_type='media_deduplicated')
+                        self.redis_s3_queue.update_counts(self.project_slug, incr=num_bytes, media_type='media_bytes_saved')
+                        descriptor['ref'] = existing_key
+                    media.append(descriptor)
+        return media
 
     def get_f_name(self, url, media_type, tweet_id, idx, size_info):
         fmt = url.split('.')[-1]
@@ -131,3 +139,100 @@ class ProcessMedia():
             except KeyError:
                 return False
         return True
+
+
+class MediaDownloader():
+    """Downloads media concurrently through a pooled HTTP session (with timeouts and retries) and stores it on S3"""
+
+    CHUNK_SIZE = 64*1024
+    REF_SUFFIX = '.ref'  # suffix of pointer objects (containing the S3 key of the existing media) stored for repeated media
+
+    # HTTP session is shared by all downloaders of a process (created lazily, i.e. after forking of the worker)
+    _session = None
+
+    def __init__(self, concurrency=None, timeout=None, retries=None, max_buffer_size=None):
+        self.config = Config()
+        self.concurrency = self.config.MEDIA_DOWNLOAD_CONCURRENCY if concurrency is None else concurrency
+        self.timeout = self.config.MEDIA_DOWNLOAD_TIMEOUT if timeout is None else timeout
+        self.retries = self.config.MEDIA_DOWNLOAD_RETRIES if retries is None else retries
+        self.max_buffer_size = self.config.MEDIA_MAX_BUFFER_SIZE if max_buffer_size is None else max_buffer_size
+        self.tmp_path = os.path.join(self.config.APP_DIR, 'tmp')
+        self.s3 = S3Handler()
+        self.media_cache = MediaCache()
+
+    @property
+    def session(self):
+        if MediaDownloader._session is None:
+            retry = Retry(total=self.retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            MediaDownloader._session = session
+        return MediaDownloader._session
+
+    def download(self, media):
+        """Download and store a list of media descriptors. Returns number of successfully stored media."""
+        if len(media) == 0:
+            return 0
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(media))) as executor:
+            results = list(executor.map(self.download_media, media))
+        return sum(results)
+
+    def download_media(self, media):
+        """Stream media to S3. Media is buffered in memory and only spilled to a temporary file if it exceeds max_buffer_size."""
+        if 'ref' in media:
+            return self.store_reference(media)
+        # set format
+        url = "{}:{}".format(media['url'], media['size'])
+        local_path = os.path.join(self.tmp_path, os.path.basename(media['key']))
+        try:
+            with self.session.get(url, timeout=self.timeout, stream=True) as resp:
+                resp.raise_for_status()
+                content, num_bytes = self._read(resp, local_path)
+            if content is None:
+                success = self.s3.upload_file(local_path, media['key'])
+            else:
+                success = self.s3.upload_to_s3(content, media['key'])
+        except Exception as e:
+            report_error(logger, exception=True)
+            success = False
+        finally:
+            if os.path.isfile(local_path):
+                os.remove(local_path)
+        if success:
+            # repeated media only references media which is known to exist
+            self.media_cache.store(media['es_index_name'], media['url'], media['key'], num_bytes)
+        return success
+
+    def store_reference(self, media):
+        """Store a pointer object to the existing media next to where the media of this tweet would have been stored"""
+        try:
+            return self.s3.upload_to_s3(media['ref'].encode(), media['key'] + self.REF_SUFFIX)
+        except Exception as e:
+            report_error(logger, exception=True)
+            return False
+
+    # private methods
+
+    def _read(self, resp, local_path):
+        """Read response content. Returns tuple (content, num_bytes), content is None if it was written to local_path instead."""
+        buffer = io.BytesIO()
+        f = None
+        try:
+            for chunk in resp.iter_content(chunk_size=self.CHUNK_SIZE):
+                if f is None and buffer.tell() + len(chunk) > self.max_buffer_size:
+                    # overflow to disk
+                    f = open(local_path, 'wb')
+                    f.write(buffer.getvalue())
+                    buffer = None
+                if f is None:
+                    buffer.write(chunk)
+                else:
+                    f.write(chunk)
+        finally:
+            if f is not None:
+                f.close()
+        if f is None:
+            return buffer.getvalue(), buffer.tell()
+        return None, os.path.getsize(local_path)
@@ -1,11 +1,27 @@
 import redis
 import logging
 import os
+import threading
 from helpers import report_error
+from app.settings import Config
 import json
 
 logger = logging.getLogger(__name__)
 
+# Connection pools are shared by all Redis instances of a process. A blocking pool makes concurrent requests (threads or
+# greenlets of async workers) wait for a free connection instead of opening an unbounded number of connections.
+POOLS = {}
+LOCK = threading.Lock()
+
+def get_connection_pool(host, port):
+    key = (os.getpid(), host, port)
+    with LOCK:
+        if key not in POOLS:
+            config = Config()
+            POOLS[key] = redis.BlockingConnectionPool(host=host, port=port, max_connections=config.REDIS_MAX_CONNECTIONS,
+                    timeout=config.REDIS_POOL_TIMEOUT)
+        return POOLS[key]
+
 class Redis():
     def __init__(self, logger=None, connection=None, **kwargs):
         self.host = os.environ.get('REDIS_HOST', 'localhost')
@@ -16,7 +32,7 @@ class Redis():
     @property
     def _r(self):
         if self.connection is None:
-            self.connection = redis.StrictRedis(host=self.host, port=self.port)
+            self.connection = redis.StrictRedis(connection_pool=get_connection_pool(self.host, self.port))
         return self.connection
 
     def get_connection(self):
@@ -0,0 +1,58 @@
+from app.settings import Config
+from app.utils.redis import Redis
+from app.utils.json_response import dumps, loads
+from app.connections.elastic import resolve_date
+from datetime import datetime, timedelta
+import hashlib
+import logging
+import json
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache(Redis):
+    """
+    Caches results of (expensive) Elasticsearch aggregations, keyed by a hash of the query name, index and options.
+    Results of queries with an open or relative end date ('now*', a recent or a future date) expire depending on the aggregation
+    interval, results of closed (historical) date ranges are kept for a long time.
+    """
+
+    # TTLs (in seconds) of queries ending 'now' by interval
+    INTERVAL_TTLS = {'minute': 60, 'hour': 5*60, 'day': 15*60, 'week': 60*60, 'month': 60*60, 'quarter': 60*60, 'year': 60*60}
+    DEFAULT_TTL = 5*60
+    CLOSED_RANGE_TTL = 7*24*3600
+    CLOSED_RANGE_LAG = 24*3600  # date ranges ending less than this many seconds ago may still receive (late) data
+
+    def __init__(self, **args):
+        super().__init__(**args)
+        self.config = Config()
+        self.namespace = self.config.REDIS_NAMESPACE
+        self.key_namespace = 'result-cache'
+
+    def key(self, name, index_name, options):
+        options_hash = hashlib.sha1(json.dumps(options, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+        return "{}:{}:{}:{}:{}".format(self.namespace, self.key_namespace, name, index_name, options_hash)
+
+    def ttl(self, options):
+        end_date = options.get('end_date', 'now')
+        if end_date.startswith('now'):
+            # relative end dates slide with time (the key however stays the same)
+            return self.INTERVAL_TTLS.get(options.get('interval', 'month'), self.DEFAULT_TTL)
+        end_date = resolve_date(end_date)
+        if end_date is not None and end_date < datetime.utcnow() - timedelta(seconds=self.CLOSED_RANGE_LAG):
+            return self.CLOSED_RANGE_TTL
+        return self.INTERVAL_TTLS.get(options.get('interval', 'month'), self.DEFAULT_TTL)
+
+    def get(self, name, index_name, options, raw=False):
+        """Returns cached result (serialized JSON if raw) or None"""
+        res = self._r.get(self.key(name, index_name, options))
+        if res is None or raw:
+            return res
+        return loads(res)
+
+    def set(self, name, index_name, options, result):
+        self._r.set(self.key(name, index_name, options), dumps(result), ex=self.ttl(options))
+
+    def self_remove(self):
+        for key in self._r.scan_iter("{}:{}:*".format(self.namespace, self.key_namespace)):
+            self._r.delete(key)
@@ -0,0 +1,60 @@
+from app.settings import Config
+from app.utils.redis import Redis
+from app.connections.elastic import rollup_hour
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RollupIds(Redis):
+    """
+    Predictions (tweet id, question tag and run name) already counted in the rollup index of a project, so that predictions
+    which are processed again (e.g. by a retried task) are not counted twice. Ids are stored in sets by hour of creation
+    of the tweet, which expire after `ttl` seconds.
+    """
+
+    def __init__(self, es_index_name, ttl=None, **args):
+        super().__init__(**args)
+        self.config = Config()
+        self.namespace = self.config.REDIS_NAMESPACE
+        self.key_namespace = 'rollup-ids'
+        if ttl is None:
+            ttl = self.config.ROLLUP_IDS_TTL
+        self.es_index_name = es_index_name
+        self.ttl = ttl
+
+    def key(self, hour):
+        return "{}:{}:{}:{}".format(self.namespace, self.key_namespace, self.es_index_name, hour)
+
+    def claim(self, predictions):
+        """Mark predictions as counted. Predictions are tuples of the arguments of add_to_rollup, preceded by the tweet id:
+        (tweet_id, created_at, is_retweet, question_tag, run_name, label, label_val). Returns predictions which were not counted before."""
+        if len(predictions) == 0:
+            return []
+        pipe = self._r.pipeline()
+        keys = set()
+        for prediction in predictions:
+            key = self.key(rollup_hour(prediction[1]))
+            pipe.sadd(key, self._member(prediction))
+            keys.add(key)
+        for key in keys:
+            pipe.expire(key, self.ttl)
+        res = pipe.execute()
+        return [prediction for prediction, is_new in zip(predictions, res) if is_new == 1]
+
+    def release(self, predictions):
+        """Unmark predictions (e.g. if the rollup update failed)"""
+        pipe = self._r.pipeline()
+        for prediction in predictions:
+            pipe.srem(self.key(rollup_hour(prediction[1])), self._member(prediction))
+        pipe.execute()
+
+    def self_remove(self):
+        for key in self._r.scan_iter(self.key('*')):
+            self._r.delete(key)
+
+    # private methods
+
+    def _member(self, prediction):
+        tweet_id, _, _, question_tag, run_name = prediction[:5]
+        return '|'.join([str(tweet_id), question_tag, run_name])
@@ -0,0 +1,65 @@
+from app.settings import Config
+from app.utils.redis import Redis
+import logging
+import random
+import json
+
+logger = logging.getLogger(__name__)
+
+
+class SamplePool(Redis):
+    """
+    Keeps a fixed-size uniform random sample of a project's tweets (reservoir sampling during ingestion).
+    Used as a fallback when the tweet ID queue is empty, instead of running a random_score query on Elasticsearch.
+    """
+
+    # KEYS[1]: pool set, KEYS[2]: counter of seen items, ARGV[1]: item, ARGV[2]: pool size, ARGV[3]: random number in [0, 1)
+    ADD_SCRIPT = """
+    local num_seen = redis.call('INCR', KEYS[2])
+    local pool_size = tonumber(ARGV[2])
+    if redis.call('SCARD', KEYS[1]) < pool_size then
+        return redis.call('SADD', KEYS[1], ARGV[1])
+    end
+    if tonumber(ARGV[3]) < pool_size / num_seen then
+        redis.call('SPOP', KEYS[1])
+        return redis.call('SADD', KEYS[1], ARGV[1])
+    end
+    return 0
+    """
+
+    def __init__(self, project, pool_size=1000, **args):
+        super().__init__(**args)
+        self.config = Config()
+        self.namespace = self.config.REDIS_NAMESPACE
+        self.key_namespace = 'sample-pool'
+        self.project = project
+        self.pool_size = pool_size
+        self._add_script = None
+
+    @property
+    def key(self):
+        return "{}:{}:{}".format(self.namespace, self.key_namespace, self.project)
+
+    @property
+    def counter_key(self):
+        return "{}:{}:{}:{}".format(self.namespace, self.key_namespace, self.project, 'num-seen')
+
+    def __len__(self):
+        return self._r.scard(self.key)
+
+    def add(self, tweet):
+        """Offer tweet to the sample pool. Returns True if tweet was added."""
+        if self._add_script is None:
+            self._add_script = self._r.register_script(self.ADD_SCRIPT)
+        obj = json.dumps(tweet, separators=(',', ':')).encode()
+        return self._add_script(keys=[self.key, self.counter_key], args=[obj, self.pool_size, random.random()]) == 1
+
+    def get(self):
+        """Get a random tweet from the pool (without removing it)"""
+        tweet = self._r.srandmember(self.key)
+        if tweet is None:
+            return None
+        return json.loads(tweet.decode())
+
+    def self_remove(self):
+        self._r.delete(self.key, self.counter_key)
@@ -0,0 +1,172 @@
+from app.settings import Config
+from app.utils.redis import Redis
+from app.utils.json_response import dumps, loads
+from app.connections.elastic import resolve_date
+from datetime import datetime, timezone
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SmoothedSeries(Redis):
+    """
+    LOESS-smoothed average sentiment series of an index (per interval and retweet setting), cached in Redis. The series only
+    contains closed buckets and is updated by a beat task: Once a new bucket closes, only the last buckets (whose smoothing
+    window may contain new data) are fetched from Elasticsearch and re-smoothed.
+    """
+
+    INTERVALS = ['hour', 'day', 'week', 'month']
+    SMOOTHERS = ['statsmodels', 'numpy']
+
+    def __init__(self, index_name, interval='month', include_retweets=False, span=None, smoother=None, **args):
+        super().__init__(**args)
+        self.config = Config()
+        self.namespace = self.config.REDIS_NAMESPACE
+        self.key_namespace = 'smoothed-series'
+        if interval not in self.INTERVALS:
+            raise ValueError(f'Interval {interval} is not supported (supported intervals: {", ".join(self.INTERVALS)})')
+        if span is None:
+            span = self.config.SENTIMENT_LOESS_SPAN
+        if smoother is None:
+            smoother = self.config.SENTIMENT_SMOOTHER
+        if smoother not in self.SMOOTHERS:
+            raise ValueError(f'Unknown smoother {smoother}')
+        self.index_name = index_name
+        self.interval = interval
+        self.include_retweets = include_retweets
+        self.span = span
+        self.smoother = smoother
+
+    @property
+    def key(self):
+        return "{}:{}:{}:{}:{}".format(self.namespace, self.key_namespace, self.index_name, self.interval, int(self.include_retweets))
+
+    def get(self, start_date=None, end_date=None):
+        """Cached buckets between start_date and end_date ('now-*' or '%Y-%m-%d %H:%M:%S'). Returns None if nothing was cached yet."""
+        cached = self._load()
+        if cached is None:
+            return None
+        buckets = cached['buckets']
+        start_date = resolve_date(start_date)
+        end_date = resolve_date(end_date)
+        if start_date is not None:
+            buckets = [b for b in buckets if b['key'] >= to_ms(start_date)]
+        if end_date is not None:
+            buckets = [b for b in buckets if b['key'] <= to_ms(end_date)]
+        return buckets
+
+    def update(self, es, now=None):
+        """Update series with buckets closed since the last update. Returns True if the series was updated."""
+        current_bucket_start = to_ms(interval_start(now or datetime.utcnow(), self.interval))
+        cached = self._load()
+        if cached is not None and cached['current_bucket_start'] == current_bucket_start:
+            # no new bucket closed
+            return False
+        buckets = [] if cached is None else cached['buckets']
+        # refetch the last `span` buckets (data may still have been added to them)
+        first_refetched = max(len(buckets) - self.span, 0)
+        start_date = 'now-20y' if first_refetched == 0 else buckets[first_refetched]['key_as_string']
+        new_buckets = es.get_avg_label_val(self.index_name, 'sentiment', with_moving_average=False, interval=self.interval,
+                start_date=start_date, end_date='now', include_retweets=self.include_retweets)
+        new_buckets = [{'key': b['key'], 'key_as_string': b['key_as_string'], 'doc_count': b['doc_count'],
+            'avg_sentiment': {'value': b['mean_label_val']['value'], 'value_smoothed': None}}
+            for b in new_buckets if b['key'] < current_bucket_start]
+        if len(new_buckets) > 0:
+            buckets = [b for b in buckets if b['key'] < new_buckets[0]['key']]
+            first_changed = len(buckets)
+            buckets.extend(new_buckets)
+            self.smooth(buckets, first_changed=first_changed)
+        self._r.set(self.key, dumps({'current_bucket_start': current_bucket_start, 'buckets': buckets}))
+        logger.info(f'Updated smoothed series {self.key} ({len(new_buckets):,} buckets fetched, {len(buckets):,} in total)')
+        return True
+
+    def smooth(self, buckets, first_changed=0):
+        """Smooth buckets in-place. Only smoothed values whose window contains buckets from position `first_changed` onward are recomputed."""
+        positions = [i for i, b in enumerate(buckets) if b['avg_sentiment']['value'] is not None]
+        if len(positions) == 0:
+            return
+        x = np.array([buckets[i]['key'] for i in positions], dtype=float)
+        y = np.array([buckets[i]['avg_sentiment']['value'] for i in positions], dtype=float)
+        first_changed_valid = int(np.searchsorted(positions, first_changed))
+        recompute_from = max(first_changed_valid - self.span, 0)
+        window_from = max(first_changed_valid - 2*self.span, 0)
+        smoothed = smooth(x[window_from:], y[window_from:], self.span, smoother=self.smoother)
+        for i, value in zip(positions[recompute_from:], smoothed[recompute_from-window_from:]):
+            buckets[i]['avg_sentiment']['value_smoothed'] = None if np.isnan(value) else float(value)
+
+    def self_remove(self):
+        self._r.delete(self.key)
+
+    # private methods
+
+    def _load(self):
+        cached = self._r.get(self.key)
+        if cached is None:
+            return None
+        return loads(cached)
+
+
+def smooth(x, y, span, smoother='statsmodels'):
+    """LOESS over the `span` nearest points of each point (x has to be sorted)"""
+    if len(x) < 2:
+        return np.array(y, dtype=float)
+    if smoother == 'numpy':
+        return loess_numpy(x, y, span)
+    from statsmodels.nonparametric.smoothers_lowess import lowess
+    # no robustifying iterations: their weights depend on the residuals of the whole series, incremental updates would differ from a full pass
+    return lowess(y, x, frac=min(span/len(x), 1), it=0, is_sorted=True, return_sorted=False)
+
+def loess_numpy(x, y, span):
+    """Vectorized local linear regression with tricube weights over the `span` nearest points (same as statsmodels lowess
+    with it=0, but much faster for long series)"""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    k = min(max(span, 2), n)
+    idx = nearest_windows(x, k)[:, None] + np.arange(k)[None, :]
+    # local coordinates (scaled by the window radius)
+    dx = x[idx] - x[:, None]
+    radius = np.abs(dx).max(axis=1, keepdims=True)
+    radius[radius == 0] = 1
+    u = dx/radius
+    w = (1 - np.abs(u)**3)**3
+    yw = y[idx]
+    s = w.sum(axis=1)
+    sx = (w*u).sum(axis=1)
+    sxx = (w*u*u).sum(axis=1)
+    sy = (w*yw).sum(axis=1)
+    sxy = (w*u*yw).sum(axis=1)
+    det = s*sxx - sx**2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # value of the local linear fit at u=0 (fall back to weighted mean for degenerate windows)
+        fit = np.where(np.abs(det) > 1e-12, (sxx*sy - sx*sxy)/det, sy/s)
+    return fit
+
+def nearest_windows(x, k):
+    """Start positions of the windows of k nearest neighbors of each point in sorted x"""
+    n = len(x)
+    positions = np.arange(n)
+    starts = np.clip(positions - k + 1, 0, n - k)
+    for _ in range(k):
+        next_pos = np.minimum(starts + k, n - 1)
+        move = (starts + k < n) & (x[next_pos] - x < x - x[starts])
+        if not move.any():
+            break
+        starts = starts + move
+    return starts
+
+def interval_start(date, interval):
+    """Start of the (UTC) date histogram bucket containing date"""
+    date = date.replace(minute=0, second=0, microsecond=0)
+    if interval == 'hour':
+        return date
+    date = date.replace(hour=0)
+    if interval == 'day':
+        return date
+    if interval == 'week':
+        return date.fromordinal(date.toordinal() - date.weekday())
+    return date.replace(day=1)
+
+def to_ms(date):
+    return int(date.replace(tzinfo=timezone.utc).timestamp()*1000)
@@ -43,6 +43,14 @@ celery.conf.beat_schedule = {
             'task': 'cleanup',
             'schedule': 5*60  # runs every 5min
             },
+        'es-partitions': {
+            'task': 'es-partitions',
+            'schedule': crontab(hour=0, minute=30) # runs every day at 0:30am (creates next partitions ahead of time)
+            },
+        'sentiment-series-update': {
+            'task': 'sentiment-series-update',
+            'schedule': 10*60  # runs every 10min (series are only updated once a new bucket closed)
+            },
         'trending-topics-update': {
             'task': 'trending-topics-update',
             'schedule': crontab(minute=0) # runs every hour
@@ -58,12 +66,19 @@ celery.conf.beat_schedule = {
         'public-data-dump-ids': {
             'task': 'public-data-dump-ids',
             'schedule': crontab(hour='*/6', minute=0) # runs every 6 hours
+            },
+        'public-data-dump-ids-compaction': {
+            'task': 'public-data-dump-ids-compaction',
+            'schedule': crontab(day_of_week=0, hour=3, minute=0) # runs at 3am on Sundays
             }
         }
 
 config = Config()
 celery.conf.timezone = config.TIMEZONE
 
+# Media downloads run on a separate queue (see celery-media service) so that slow downloads don't block tweet handling
+celery.conf.task_routes = {'app.stream.tasks.handle_media': {'queue': 'media'}}
+
 # Broker transport options
 # These options try to avoid rare cases of duplicate task execution when using Redis as a backend
 celery.conf.broker_transport_options = {'fanout_prefix': True, 'fanout_patterns': True, 'visibility_timeout': 43200}
@@ -1,3 +1,5 @@
+import os
+
 # --------------------------------------------------------------
 # Server socket
 #
@@ -47,6 +49,13 @@ backlog = 2048
 #
 #       A positive integer generally set to around 1000.
 #
+#       Most endpoints wait on Elasticsearch, Redis, SageMaker or
+#       Docker. Setting GUNICORN_WORKER_CLASS=gevent serves
+#       requests in greenlets, so that slow aggregation queries
+#       don't block annotation requests. Redis and Elasticsearch
+#       clients use per-process connection pools which are safe
+#       in both modes.
+#
 #   timeout - If a worker does not notify the master process in this
 #       number of seconds it is killed and a new worker is spawned
 #       to replace it.
@@ -68,10 +77,10 @@ backlog = 2048
 #
 #       True or False
 #
-workers = 2
-worker_class = 'sync'
-worker_connections = 1000
-timeout = 30
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
 keepalive = 2
 spew = False
 
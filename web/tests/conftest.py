@@ -2,7 +2,7 @@ import pytest
 import sys, os
 import json
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
-from app.utils.priority_queue import PriorityQueue, TweetIdQueue, RedisSet, TweetStore
+from app.utils.priority_queue import PriorityQueue, TweetIdQueue, RedisSet, RedisBitmapSet, TweetStore
 from app.stream.redis_s3_queue import RedisS3Queue
 from app.stream.es_queue import ESQueue
 from app.utils.process_media import ProcessMedia
@@ -13,6 +13,12 @@ from app.utils.redis import Redis
 from app.utils.predict_queue import PredictQueue
 from app.utils.predict import Predict
 from app.utils.data_dump_ids import DataDumpIds
+from app.utils.sample_pool import SamplePool
+from app.utils.media_cache import MediaCache
+from app.utils.rollup_ids import RollupIds
+from app.utils.result_cache import ResultCache
+from app.utils.metrics import Metrics
+from app.utils.smoothed_series import SmoothedSeries
 
 
 # session fixtures
@@ -28,18 +34,36 @@ def data_dump_ids():
     yield data_dump_ids
     data_dump_ids.self_remove()
 
+@pytest.fixture(scope='function')
+def data_dump_ids_packed():
+    data_dump_ids = DataDumpIds('test_project', encoding='packed')
+    yield data_dump_ids
+    data_dump_ids.self_remove()
+
 @pytest.fixture(scope='session')
 def rs():
     rs = RedisSet('test_project', namespace='test')
     yield rs
     rs.self_remove_all()
 
+@pytest.fixture(scope='session')
+def rs_bitmap():
+    rs = RedisBitmapSet('test_project', namespace='test')
+    yield rs
+    rs.self_remove_all()
+
 @pytest.fixture(scope='function')
 def tid_q():
     tid_q = TweetIdQueue('test_project', namespace='test', priority_threshold=5, max_queue_length=10)
     yield tid_q
     tid_q.flush()
 
+@pytest.fixture(scope='function')
+def tid_q_bitmap():
+    tid_q = TweetIdQueue('test_project', namespace='test', priority_threshold=5, max_queue_length=10, rset_backend='bitmap')
+    yield tid_q
+    tid_q.flush()
+
 @pytest.fixture(scope='session')
 def s3_q():
     redis_s3_queue = RedisS3Queue()
@@ -48,7 +72,7 @@ def s3_q():
 
 @pytest.fixture(scope='session')
 def tweet_store():
-    tweet_store = TweetStore(namespace='test')
+    tweet_store = TweetStore('test_project', namespace='test')
     yield tweet_store
     tweet_store.remove_all()
 
@@ -76,6 +100,46 @@ def trending_topics():
     yield tt
     tt.self_remove()
 
+@pytest.fixture(scope='function')
+def sample_pool():
+    sample_pool = SamplePool('project_test', pool_size=10)
+    yield sample_pool
+    sample_pool.self_remove()
+
+@pytest.fixture(scope='function')
+def media_cache():
+    media_cache = MediaCache()
+    media_cache.self_remove()
+    yield media_cache
+    media_cache.self_remove()
+
+@pytest.fixture(scope='function')
+def result_cache():
+    result_cache = ResultCache()
+    yield result_cache
+    result_cache.self_remove()
+
+@pytest.fixture(scope='function')
+def metrics():
+    metrics = Metrics(flush_interval=3600)
+    metrics.self_remove()
+    yield metrics
+    metrics.self_remove()
+
+@pytest.fixture(scope='function')
+def smoothed_series():
+    smoothed_series = SmoothedSeries('project_test', interval='day', span=5, smoother='numpy')
+    smoothed_series.self_remove()
+    yield smoothed_series
+    smoothed_series.self_remove()
+
+@pytest.fixture(scope='function')
+def rollup_ids():
+    rollup_ids = RollupIds('project_test')
+    rollup_ids.self_remove()
+    yield rollup_ids
+    rollup_ids.self_remove()
+
 @pytest.fixture(scope='function')
 def r():
     yield Redis()
@@ -0,0 +1,198 @@
+import pytest
+import sys; sys.path.append('../..')
+from unittest.mock import patch
+from datetime import datetime
+from app.connections.elastic import Elastic, add_to_rollup, add_months, resolve_date
+import elasticsearch
+import elasticsearch.helpers
+
+class TestElastic:
+    def test_client_is_shared(self):
+        local_config = {'ELASTICSEARCH_HOST': 'localhost', 'ELASTICSEARCH_PORT': 9200}
+        client = Elastic(local_config=local_config).es
+        assert Elastic(local_config=local_config).es is client
+        assert Elastic(local_config={'ELASTICSEARCH_HOST': 'localhost', 'ELASTICSEARCH_PORT': 9201}).es is not client
+        # forked processes create their own client
+        with patch('app.connections.elastic.os.getpid', return_value=-1):
+            assert Elastic(local_config=local_config).es is not client
+
+    def test_only_searches_retry_on_timeout(self):
+        es = Elastic(local_config={'ELASTICSEARCH_HOST': 'localhost', 'ELASTICSEARCH_PORT': 9200})
+        assert not es.es.transport.retry_on_timeout
+        with patch.object(Elastic, 'es') as client:
+            client.search.side_effect = [elasticsearch.exceptions.ConnectionTimeout('TIMEOUT', 'timed out', None), {'hits': {'hits': []}}]
+            assert es.search(index='project_test', body={}) == {'hits': {'hits': []}}
+        assert client.search.call_count == 2
+
+    def test_bulk_actions_in_batches_reports_not_applied(self):
+        es = Elastic()
+        actions = [{'_index': 'project_test', '_id': _id} for _id in 'abcdef']
+        error = elasticsearch.helpers.BulkIndexError('1 document(s) failed to index.', [{'update': {'_index': 'project_test', '_id': 'd', 'status': 500}}])
+        not_applied = []
+        with patch.object(Elastic, 'bulk_action', side_effect=[None, error]):
+            assert not es.bulk_actions_in_batches(actions, batch_size=2, not_applied=not_applied)
+        assert [a['_id'] for a in not_applied] == ['d', 'e', 'f']
+        # state of a batch which failed as a whole is unknown
+        not_applied = []
+        timeout = elasticsearch.exceptions.ConnectionTimeout('TIMEOUT', 'timed out', None)
+        with patch.object(Elastic, 'bulk_action', side_effect=[None, timeout]):
+            assert not es.bulk_actions_in_batches(actions, batch_size=2, not_applied=not_applied)
+        assert [a['_id'] for a in not_applied] == ['e', 'f']
+
+    def test_get_predictions_single_query(self):
+        es = Elastic()
+        resp = {'aggregations': {'prediction_agg': {'buckets': [
+            {'key_as_string': '2020-01-01 00:00:00', 'key': 1, 'doc_count': 3, 'answers': {'buckets': {'positive': {'doc_count': 3}, 'negative': {'doc_count': 0}, 'neutral': {'doc_count': 0}}}},
+            {'key_as_string': '2020-02-01 00:00:00', 'key': 2, 'doc_count': 1, 'answers': {'buckets': {'positive': {'doc_count': 0}, 'negative': {'doc_count': 1}, 'neutral': {'doc_count': 0}}}},
+            {'key_as_string': '2020-03-01 00:00:00', 'key': 3, 'doc_count': 0, 'answers': {'buckets': {'positive': {'doc_count': 0}, 'negative': {'doc_count': 0}, 'neutral': {'doc_count': 0}}}}
+            ]}}}
+        with patch.object(Elastic, 'es') as client:
+            client.search.return_value = resp
+            predictions = es.get_predictions('project_test', 'sentiment', ['positive', 'negative', 'neutral'])
+        assert client.search.call_count == 1
+        assert predictions['positive'] == [{'key_as_string': '2020-01-01 00:00:00', 'key': 1, 'doc_count': 3}]
+        assert predictions['negative'] == [{'key_as_string': '2020-02-01 00:00:00', 'key': 2, 'doc_count': 1}]
+        assert predictions['neutral'] == []
+
+    def test_add_to_rollup(self):
+        rollup_docs = {}
+        add_to_rollup(rollup_docs, 'Wed Oct 10 20:19:24 +0200 2018', False, 'sentiment', '', 'positive', label_val=1)
+        add_to_rollup(rollup_docs, 'Wed Oct 10 18:59:24 +0000 2018', False, 'sentiment', '', 'positive', label_val=1)
+        add_to_rollup(rollup_docs, 'Wed Oct 10 18:59:24 +0000 2018', True, 'sentiment', '', 'positive')
+        assert len(rollup_docs) == 2
+        doc = rollup_docs['sentiment||positive|2018-10-10 18:00:00|0']
+        assert doc['count'] == 2
+        assert doc['label_val_sum'] == 2
+        assert doc['label_val_count'] == 2
+        assert rollup_docs['sentiment||positive|2018-10-10 18:00:00|1']['label_val_count'] == 0
+
+    @patch.dict('app.connections.elastic.INDICES_CACHE', clear=True)
+    def test_get_avg_label_val_from_rollup(self):
+        es = Elastic()
+        resp = {'aggregations': {'hist_agg': {'buckets': [
+            {'key_as_string': '2020-01-01 00:00:00', 'key': 1, 'doc_count': 2, 'count': {'value': 30.0},
+                'label_val_sum': {'value': 3.0}, 'label_val_count': {'value': 30.0}, 'mean_label_val': {'value': 0.1}},
+            {'key_as_string': '2020-02-01 00:00:00', 'key': 2, 'doc_count': 1, 'count': {'value': 5.0},
+                'label_val_sum': {'value': 0.0}, 'label_val_count': {'value': 0.0}}
+            ]}}}
+        with patch.object(Elastic, 'es') as client:
+            client.indices.exists.return_value = True
+            client.search.return_value = resp
+            res = es.get_avg_label_val('project_test', 'sentiment', with_moving_average=False, interval='month', use_rollup=True)
+        assert client.search.call_args[1]['index'] == 'rollup_project_test'
+        assert res == [
+                {'key_as_string': '2020-01-01 00:00:00', 'key': 1, 'doc_count': 30, 'mean_label_val': {'value': 0.1}},
+                {'key_as_string': '2020-02-01 00:00:00', 'key': 2, 'doc_count': 5, 'mean_label_val': {'value': None}}]
+
+    @patch.dict('app.connections.elastic.INDICES_CACHE', clear=True)
+    def test_rollup_not_used_for_short_intervals(self):
+        es = Elastic()
+        with patch.object(Elastic, 'es') as client:
+            client.indices.exists.return_value = True
+            assert es.use_rollup('project_test', interval='day', use_rollup=True)
+            assert es.use_rollup('project_test', interval='week', use_rollup=True)
+            assert not es.use_rollup('project_test', interval='minute', use_rollup=True)
+            assert not es.use_rollup('project_test', interval='day', use_rollup=False)
+        # existence of rollup index is cached
+        assert client.indices.exists.call_count == 1
+
+    @patch.dict('app.connections.elastic.INDICES_CACHE', clear=True)
+    def test_update_rollup_installs_template(self):
+        es = Elastic()
+        with patch.object(Elastic, 'es') as client, patch.object(Elastic, 'bulk_actions_in_batches', return_value=True):
+            client.indices.exists_template.return_value = False
+            es.update_rollup('project_test', {})
+            es.update_rollup('project_test', {})
+        assert client.indices.put_template.call_count == 1
+        assert client.indices.put_template.call_args[0][0] == 'rollup'
+
+    def test_get_geo_sentiment_grid(self):
+        es = Elastic()
+        resp = {'aggregations': {'grid': {'buckets': [
+            {'key': 'u0m', 'doc_count': 12, 'mean_label_val': {'value': 0.25}, 'centroid': {'location': {'lat': 47.1, 'lon': 8.5}, 'count': 12}}
+            ]}}}
+        with patch.object(Elastic, 'es') as client:
+            client.search.return_value = resp
+            cells = es.get_geo_sentiment_grid('project_test', precision=3)
+        assert client.search.call_args[1]['body']['aggs']['grid']['geohash_grid']['precision'] == 3
+        assert cells == [{'geohash': 'u0m', 'count': 12, 'mean_label_val': 0.25, 'location': [8.5, 47.1]}]
+
+    @patch.dict('app.connections.elastic.INDICES_CACHE', clear=True)
+    def test_write_index_by_created_at(self):
+        es = Elastic()
+        assert es.write_index('project_test', created_at='Wed Oct 10 20:19:24 +0000 2018') == 'project_test'
+        current_partition = 'project_test_' + datetime.utcnow().strftime('%Y_%m')
+        indices = ['project_test_2018_11', current_partition]
+        with patch.object(Elastic, 'partitioned', True), patch.object(Elastic, 'list_indices', return_value=indices), \
+                patch.object(Elastic, 'create_partition') as create_partition:
+            assert es.write_index('project_test', created_at='Wed Oct 31 23:19:24 -0200 2018') == 'project_test_2018_11'
+            assert es.write_index('project_test') == current_partition
+            assert create_partition.call_count == 0
+            # missing partitions are created on demand
+            assert es.write_index('project_test', created_at='Mon Dec 10 20:19:24 +0000 2018') == 'project_test_2018_12'
+            create_partition.assert_called_once_with('project_test', 'project_test_2018_12')
+
+    @patch.dict('app.connections.elastic.INDICES_CACHE', clear=True)
+    def test_read_indices_by_date_range(self):
+        es = Elastic()
+        indices = ['project_test', 'project_test_2018_10', 'project_test_2018_11', 'project_test_2018_12', 'project_other_2018_11']
+        cutover = datetime(2018, 11, 5, 12)
+        with patch.object(Elastic, 'partitioned', True), patch.object(Elastic, 'list_indices', return_value=indices), \
+                patch.object(Elastic, 'partitioning_cutover', return_value=cutover):
+            assert es.read_indices('project_test', '2018-11-06 00:00:00', '2018-12-01 00:00:00') == ['project_test_2018_11', 'project_test_2018_12']
+            # legacy index is searched for dates before partitioning was enabled (including dates of the first partitions)
+            assert es.read_indices('project_test', '2018-11-02 00:00:00', '2018-11-03 00:00:00') == ['project_test_2018_11', 'project_test']
+            assert es.read_indices('project_test', '2018-09-01 00:00:00', '2018-10-03 00:00:00') == ['project_test_2018_10', 'project_test']
+            assert es.read_indices('project_test') == ['project_test_2018_10', 'project_test_2018_11', 'project_test_2018_12', 'project_test']
+            # never search an empty list of indices
+            assert es.read_indices('project_test', '2019-01-01 00:00:00') == 'project_test_2018_12'
+            assert es.read_indices('project_unpartitioned', 'now-1d') == 'project_unpartitioned'
+        with patch.object(Elastic, 'partitioned', True), patch.object(Elastic, 'list_indices', return_value=indices), \
+                patch.object(Elastic, 'partitioning_cutover', return_value=None):
+            # without a recorded cutover the legacy index is always searched
+            assert es.read_indices('project_test', '2018-12-02 00:00:00') == ['project_test_2018_12', 'project_test']
+
+    @patch.dict('app.connections.elastic.INDICES_CACHE', clear=True)
+    def test_create_partition_records_cutover(self):
+        es = Elastic()
+        with patch.object(Elastic, 'es') as client, patch.object(Elastic, 'list_indices', return_value=['project_test']), \
+                patch.object(Elastic, 'create_index') as create_index:
+            client.indices.get_mapping.return_value = {'project_test': {'mappings': {'tweet': {}}}}
+            es.create_partition('project_test', 'project_test_2018_11')
+            create_index.assert_called_once_with('project_test_2018_11')
+            assert 'partitioned_since' in client.indices.put_mapping.call_args[1]['body']['_meta']
+            client.indices.get_mapping.return_value = {'project_test': {'mappings': {'tweet': {'_meta': {'partitioned_since': '2018-11-05 12:00:00'}}}}}
+            es.create_partition('project_test', 'project_test_2018_12')
+            assert client.indices.put_mapping.call_count == 1
+            assert es.partitioning_cutover('project_test') == datetime(2018, 11, 5, 12)
+
+    def test_manage_partitions_keeps_grace_period(self):
+        es = Elastic()
+        now = datetime.utcnow()
+        partitions = ['project_test_' + add_months(now, -i).strftime('%Y_%m') for i in range(4, -1, -1)]
+        with patch.object(Elastic, 'es'), patch.object(Elastic, 'create_partition'), patch.object(Elastic, 'list_indices', return_value=partitions), \
+                patch.object(Elastic, 'optimize_partition') as optimize_partition:
+            es.manage_partitions('project_test')
+        assert [c[0][0] for c in optimize_partition.call_args_list] == partitions[:3]
+
+    def test_resolve_date(self):
+        class FixedDatetime(datetime):
+            @classmethod
+            def utcnow(cls):
+                return datetime(2019, 3, 31, 12, 30)
+        with patch('app.connections.elastic.datetime', FixedDatetime):
+            # calendar months and years
+            assert resolve_date('now-1M') == datetime(2019, 2, 28, 12, 30)
+            assert resolve_date('now-1y') == datetime(2018, 3, 31, 12, 30)
+            assert resolve_date('now-2d') == datetime(2019, 3, 29, 12, 30)
+            # rounding
+            assert resolve_date('now-1M/M') == datetime(2019, 2, 1)
+            assert resolve_date('now/w') == datetime(2019, 3, 25)
+            assert resolve_date('now-1d/d') == datetime(2019, 3, 30)
+            assert resolve_date('2019-01-01 00:00:00') == datetime(2019, 1, 1)
+            assert resolve_date('invalid') is None
+
+    def test_add_months(self):
+        assert add_months(datetime(2019, 1, 31), 1) == datetime(2019, 2, 28)
+        assert add_months(datetime(2019, 1, 15), -2) == datetime(2018, 11, 15)
+        assert add_months(datetime(2019, 12, 1), 1) == datetime(2020, 1, 1)
@@ -17,6 +17,22 @@ class TestRedisS3Queue:
         s3_q.update_counts(project)
         assert s3_q.get_counts(project, day) == 1
 
+    def test_counts_bulk(self, s3_q):
+        s3_q.clear_all_counts()
+        s3_q.update_counts('project_a', day='2020-01-01', hour='05')
+        s3_q.update_counts('project_a', day='2020-01-01', hour='05')
+        s3_q.update_counts('project_a', day='2020-01-02', hour='23', media_type='photo')
+        s3_q.update_counts('project_b', day='2020-01-01', hour='06')
+        start = datetime(2020, 1, 1, 5)
+        end = datetime(2020, 1, 1, 7)
+        counts = s3_q.get_counts_bulk(['project_a', 'project_b'], start, end, hourly=True)
+        assert counts['project_a']['tweets'] == {'2020-01-01:05': 2, '2020-01-01:06': 0}
+        assert counts['project_b']['tweets'] == {'2020-01-01:05': 0, '2020-01-01:06': 1}
+        counts = s3_q.get_counts_bulk(['project_a'], datetime(2020, 1, 1), datetime(2020, 1, 3), media_types=['tweets', 'photo'])
+        assert counts['project_a']['tweets'] == {'2020-01-01': 2, '2020-01-02': 0}
+        assert counts['project_a']['photo'] == {'2020-01-01': 0, '2020-01-02': 1}
+        s3_q.clear_all_counts()
+
     def test_clear(self, s3_q):
         now = datetime.now()
         day = now.strftime("%Y-%m-%d")
@@ -0,0 +1,40 @@
+import pytest
+import sys; sys.path.append('../..')
+from unittest.mock import patch, MagicMock
+from app.stream.s3_handler import S3Handler
+from app.connections.aws import get_client
+
+class TestS3Handler:
+    def test_client_is_cached(self):
+        client = get_client('s3')
+        assert get_client('s3') is client
+        # forked processes create their own client
+        with patch('app.connections.aws.os.getpid', return_value=-1):
+            assert get_client('s3') is not client
+
+    def test_iter_items_paginates(self):
+        s3_handler = S3Handler(bucket='public')
+        pages = [{'Contents': [{'Key': str(i)} for i in range(1000)]}, {'Contents': [{'Key': '1000'}]}, {}]
+        client = MagicMock()
+        client.get_paginator.return_value.paginate.return_value = pages
+        with patch('app.stream.s3_handler.get_client', return_value=client):
+            keys = [item['Key'] for item in s3_handler.iter_items(prefix='data_dump')]
+        assert len(keys) == 1001
+        client.get_paginator.assert_called_once_with('list_objects_v2')
+
+    def test_append_copies_in_ranges(self):
+        s3_handler = S3Handler(bucket='public')
+        gb = 1024**3
+        assert s3_handler.copy_ranges(10*1024**2) == [(0, 10*1024**2 - 1)]
+        assert s3_handler.copy_ranges(2*gb + 1024) == [(0, gb - 1), (gb, 2*gb + 1023)]
+        assert s3_handler.copy_ranges(2*gb + 6*1024**2) == [(0, gb - 1), (gb, 2*gb - 1), (2*gb, 2*gb + 6*1024**2 - 1)]
+        client = MagicMock()
+        client.head_object.return_value = {'ContentLength': 12*gb}
+        client.upload_part_copy.return_value = {'CopyPartResult': {'ETag': 'copy'}}
+        client.upload_part.return_value = {'ETag': 'new'}
+        with patch('app.stream.s3_handler.get_client', return_value=client), patch('builtins.open'):
+            assert s3_handler.append_to_file('local_path', 'key')
+        assert client.upload_part_copy.call_count == 12
+        assert client.upload_part_copy.call_args[1]['CopySourceRange'] == f'bytes={11*gb}-{12*gb - 1}'
+        parts = client.complete_multipart_upload.call_args[1]['MultipartUpload']['Parts']
+        assert [p['PartNumber'] for p in parts] == list(range(1, 14))
@@ -58,6 +58,22 @@ class TestTrendingTweets:
             tt.process(retweet)
         assert tt.pq.pop() == '1'
 
+    def test_query_index(self, retweet, tt):
+        retweet['retweeted_status']['id_str'] = '0'
+        tt.process(retweet)
+        assert tt.get_trending_tweets(10, query='Test') == ['0']
+        assert tt.get_trending_tweets(10, query='unknown') == []
+
+    def test_query_index_removal(self, retweet, tt):
+        for retweet_id in range(6):
+            retweet['retweeted_status']['id_str'] = str(retweet_id)
+            tt.process(retweet)
+        # max queue length is 5, evicted tweet is also removed from index
+        assert len(tt.get_trending_tweets(10, query='tweet')) == 5
+        tt.remove_from_index('5')
+        assert '5' not in tt.get_trending_tweets(10, query='tweet')
+        assert not tt._r.exists(tt.tweet_tokens_key('5'))
+
 if __name__ == "__main__":
     # if running outside of docker, make sure redis is running on localhost
     pytest.main(['-s', '-m', 'focus'])
@@ -1,6 +1,8 @@
 import pytest
 import sys; sys.path.append('../..')
 import time
+import gzip
+from unittest.mock import patch
 
 class TestDataDumpIds:
     @pytest.mark.focus
@@ -27,6 +29,89 @@ class TestDataDumpIds:
             assert len(chunk) == 10
         assert num_chunks == 10
 
+    def test_deduplication(self, data_dump_ids):
+        assert data_dump_ids.add('1')
+        assert data_dump_ids.add('2')
+        assert not data_dump_ids.add('1')
+        assert len(data_dump_ids) == 2
+        assert data_dump_ids.pop_num_duplicates() == 1
+        assert data_dump_ids.pop_num_duplicates() == 0
+
+    def test_packed_encoding(self, data_dump_ids_packed):
+        ids = ['1', '1184453545834651648', str(2**64 - 1)]
+        for _id in ids:
+            data_dump_ids_packed.add(_id)
+        assert len(data_dump_ids_packed) == 3
+        assert data_dump_ids_packed.pop_all() == ids
+        assert len(data_dump_ids_packed) == 0
+
+    def test_packed_pop_all_iter(self, data_dump_ids_packed):
+        for i in range(95):
+            data_dump_ids_packed.add(str(i))
+        chunks = []
+        for chunk in data_dump_ids_packed.pop_all_iter(chunk_size=10):
+            chunks.append(chunk)
+            # ids added while draining are kept for the next sync
+            data_dump_ids_packed.add(str(1000 + len(chunks)))
+        assert len(chunks) == 10
+        assert sum(chunks, []) == [str(i) for i in range(95)]
+        assert len(data_dump_ids_packed) == 10
+
+    def test_packed_interrupted_drain(self, data_dump_ids_packed):
+        for i in range(25):
+            data_dump_ids_packed.add(str(i))
+        # drain interrupted after the first chunk
+        next(data_dump_ids_packed.pop_all_iter(chunk_size=10))
+        data_dump_ids_packed.add('100')
+        assert len(data_dump_ids_packed) == 26
+        assert data_dump_ids_packed.pop_all() == [str(i) for i in range(25)] + ['100']
+        assert len(data_dump_ids_packed) == 0
+        # resumed drain also consumes ids collected since the interruption
+        for i in range(200, 225):
+            data_dump_ids_packed.add(str(i))
+        next(data_dump_ids_packed.pop_all_iter(chunk_size=10))
+        data_dump_ids_packed.add('300')
+        assert sum(data_dump_ids_packed.pop_all_iter(chunk_size=10), []) == [str(i) for i in range(200, 225)] + ['300']
+
+    def test_change_of_encoding(self, data_dump_ids, data_dump_ids_packed):
+        data_dump_ids.add('1')
+        data_dump_ids.add('2')
+        data_dump_ids_packed.add('3')
+        # ids queued under the previous encoding are still synced
+        assert len(data_dump_ids_packed) == 3
+        assert sum(data_dump_ids_packed.pop_all_iter(chunk_size=10), []) == ['1', '2', '3']
+        assert len(data_dump_ids) == 0
+
+    def test_sort_unique(self, data_dump_ids, tmp_path):
+        input_file = str(tmp_path / 'ids')
+        output_file = str(tmp_path / 'ids_unique')
+        with open(input_file, 'w') as f:
+            f.write('\n'.join(['3', '10', '2', '3', '10', '1', '2']) + '\n')
+        num_ids, num_unique = data_dump_ids.sort_unique(input_file, output_file, chunk_size=3)
+        with open(output_file, 'r') as f:
+            assert f.read().split() == ['1', '2', '3', '10']
+        assert num_ids == 7
+        assert num_unique == 4
+
+    def test_sync_appends_gzip_member(self, data_dump_ids):
+        uploaded = {}
+        def download_file(local_path, key):
+            with gzip.open(local_path, 'wt') as f:
+                f.write('1\n2\n')
+            return True
+        def upload_file(local_path, key, make_public=False):
+            with gzip.open(local_path, 'rt') as f:
+                uploaded['ids'] = f.read().split()
+            return True
+        data_dump_ids.add('3')
+        a = patch.object(data_dump_ids.s3_handler, 'file_size', return_value=100)
+        b = patch.object(data_dump_ids.s3_handler, 'download_file', side_effect=download_file)
+        c = patch.object(data_dump_ids.s3_handler, 'upload_file', side_effect=upload_file)
+        with a, b, c:
+            data_dump_ids.sync()
+        assert uploaded['ids'] == ['1', '2', '3']
+        assert len(data_dump_ids) == 0
+
 if __name__ == "__main__":
     # if running outside of docker, make sure redis is running on localhost
     pytest.main(['-s', '-m', 'focus'])
@@ -0,0 +1,44 @@
+import pytest
+import sys; sys.path.append('../../../web/')
+from flask import Flask
+from datetime import datetime
+import numpy as np
+import gzip
+import json
+from app.utils.json_response import json_response, dumps, buffer_chunks
+
+app = Flask(__name__)
+
+def get_body(resp):
+    return b''.join(resp.response)
+
+class TestJsonResponse:
+    def test_dumps_numpy_and_datetime(self):
+        obj = {'value': np.float64(0.5), 'count': np.int64(3), 'values': np.array([1, 2]), 'date': datetime(2020, 1, 1), 'nan': float('nan')}
+        assert json.loads(dumps(obj)) == {'value': 0.5, 'count': 3, 'values': [1, 2], 'date': '2020-01-01T00:00:00+00:00', 'nan': None}
+
+    def test_streams_generator(self):
+        hits = ({'_source': {'id': i}} for i in range(1000))
+        with app.test_request_context():
+            resp = json_response(hits, headers={'X-Cache': 'MISS'})
+            assert resp.is_streamed
+            assert resp.headers['X-Cache'] == 'MISS'
+            assert 'Content-Encoding' not in resp.headers
+            assert json.loads(get_body(resp)) == [{'_source': {'id': i}} for i in range(1000)]
+
+    def test_gzip(self):
+        obj = {'positive': [{'key': i, 'doc_count': i} for i in range(100)], 'negative': []}
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip, deflate'}):
+            resp = json_response(obj)
+            assert resp.headers['Content-Encoding'] == 'gzip'
+            assert json.loads(gzip.decompress(get_body(resp))) == obj
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip;q=0'}):
+            assert 'Content-Encoding' not in json_response(obj).headers
+
+    def test_serialized_json(self):
+        with app.test_request_context():
+            assert get_body(json_response(b'[1,2,3]')) == b'[1,2,3]'
+
+    def test_buffer_chunks(self):
+        chunks = list(buffer_chunks([b'a'*10]*25, chunk_size=100))
+        assert [len(c) for c in chunks] == [100, 100, 50]
@@ -0,0 +1,45 @@
+import pytest
+import sys; sys.path.append('../../../web/')
+from app.utils.metrics import Metrics
+
+class TestMetrics:
+    def test_counters(self, metrics):
+        metrics.inc('tweets_received_total')
+        metrics.inc('tweets_matched_total', project='project_a')
+        metrics.inc('tweets_matched_total', 2, project='project_a')
+        # nothing is written before flushing
+        assert 'tweets_received_total' not in metrics.render()
+        metrics.flush()
+        # observations of other processes are aggregated
+        other_process = Metrics(flush_interval=3600)
+        other_process.inc('tweets_received_total')
+        other_process.flush()
+        output = metrics.render()
+        assert '# TYPE tweets_received_total counter\ntweets_received_total 2\n' in output
+        assert 'tweets_matched_total{project="project_a"} 3\n' in output
+
+    def test_histograms(self, metrics):
+        for value in [0.003, 0.02, 0.02, 100]:
+            metrics.observe('handle_tweet_stage_duration_seconds', value, stage='process')
+        metrics.flush()
+        lines = metrics.render().split('\n')
+        assert '# TYPE handle_tweet_stage_duration_seconds histogram' in lines
+        assert 'handle_tweet_stage_duration_seconds_bucket{stage="process",le="0.005"} 1' in lines
+        assert 'handle_tweet_stage_duration_seconds_bucket{stage="process",le="0.025"} 3' in lines
+        assert 'handle_tweet_stage_duration_seconds_bucket{stage="process",le="60"} 3' in lines
+        assert 'handle_tweet_stage_duration_seconds_bucket{stage="process",le="+Inf"} 4' in lines
+        assert 'handle_tweet_stage_duration_seconds_sum{stage="process"} 100.043' in lines
+        assert 'handle_tweet_stage_duration_seconds_count{stage="process"} 4' in lines
+
+    def test_gauges(self, metrics):
+        output = metrics.render(gauges=[('queue_depth', {'queue': 'es', 'project': 'project_a'}, 12)])
+        assert 'queue_depth{project="project_a",queue="es"} 12\n' in output
+
+    def test_unknown_metric(self, metrics):
+        with pytest.raises(ValueError):
+            metrics.inc('unknown_total')
+
+if __name__ == "__main__":
+    # if running outside of docker, make sure redis is running on localhost
+    import os; os.environ["REDIS_HOST"] = "localhost"
+    pytest.main()
@@ -17,6 +17,17 @@ class TestPriorityQueue:
             pq.add(t)
         assert len(pq) == pq.MAX_QUEUE_LENGTH
 
+    def test_add_returns_removed(self, pq):
+        pq.add('a', priority=0)
+        for i in range(pq.MAX_QUEUE_LENGTH - 1):
+            pq.add(str(i), priority=1)
+        removed = pq.add('b', priority=1)
+        assert removed == [(b'a', 0)]
+        assert len(pq) == pq.MAX_QUEUE_LENGTH
+        # updating an existing element does not remove anything
+        assert pq.add('b', priority=2) == []
+        assert pq.get_score('b') == 2
+
     def test_priority_order(self, pq):
         pq.add('a', priority=0)
         pq.add('b', priority=1)
@@ -5,20 +5,84 @@ import os
 import requests
 from unittest.mock import patch
 sys.path.append('../../')
-from app.utils.process_media import ProcessMedia
-import urllib
+from app.utils.process_media import ProcessMedia, MediaDownloader
 
 class TestProcessMedia:
-    def test_process_iamges(self, tweet_with_images, s3_q):
+    def test_process_iamges(self, tweet_with_images, s3_q, media_cache):
         pm = ProcessMedia(tweet_with_images, 'test_project')
-        a = patch('app.utils.process_media.urllib')
-        b = patch('app.stream.s3_handler.S3Handler.upload_file', return_value=True)
         s3_q.clear_all_counts()
-        with a, b:
-            pm.process()
+        media = pm.process()
         assert s3_q.get_counts(pm.project_slug, media_type='photo') == 1
+        assert len(media) == 1
+        assert media[0]['url'] == 'http://pbs.twimg.com/media/D3TvCsmWwAEGWAF.jpg'
+        assert media[0]['key'].startswith('media/')
         s3_q.clear_all_counts()
 
+    def test_download_media(self, tweet_with_images, media_cache):
+        media = ProcessMedia(tweet_with_images, 'test_project').process()
+        media_downloader = MediaDownloader()
+        a = patch.object(MediaDownloader, 'session')
+        b = patch('app.stream.s3_handler.S3Handler.upload_to_s3', return_value=True)
+        with a as session, b as upload_to_s3:
+            session.get.return_value = self._response(b'image')
+            assert media_downloader.download(media) == 1
+        session.get.assert_called_once_with(media[0]['url'] + ':large', timeout=media_downloader.timeout, stream=True)
+        upload_to_s3.assert_called_once_with(b'image', media[0]['key'])
+        assert media_cache.get(media[0]['es_index_name'], media[0]['url'])['bytes'] == '5'
+
+    def test_download_large_media(self, tweet_with_images, media_cache):
+        media = ProcessMedia(tweet_with_images, 'test_project').process()
+        media_downloader = MediaDownloader(max_buffer_size=4)
+        media_downloader.CHUNK_SIZE = 2
+        uploaded = {}
+        def upload_file(local_path, key):
+            with open(local_path, 'rb') as f:
+                uploaded[key] = f.read()
+            return True
+        a = patch.object(MediaDownloader, 'session')
+        b = patch('app.stream.s3_handler.S3Handler.upload_file', side_effect=upload_file)
+        with a as session, b:
+            session.get.return_value = self._response(b'large image')
+            assert media_downloader.download(media) == 1
+        assert uploaded == {media[0]['key']: b'large image'}
+        assert not os.path.isfile(os.path.join(media_downloader.tmp_path, os.path.basename(media[0]['key'])))
+        assert media_cache.get(media[0]['es_index_name'], media[0]['url'])['bytes'] == '11'
+
+    def test_process_repeated_media(self, tweet_with_images, s3_q, media_cache):
+        s3_q.clear_all_counts()
+        pm = ProcessMedia(tweet_with_images, 'test_project')
+        media = pm.process()
+        assert len(media) == 1
+        # media is only referenced once it was successfully stored
+        assert pm.process() == media
+        with patch.object(MediaDownloader, 'session') as session, patch('app.stream.s3_handler.S3Handler.upload_to_s3', return_value=False):
+            session.get.return_value = self._response(b'image')
+            assert MediaDownloader().download(media) == 0
+        assert pm.process() == media
+        media_cache.store(media[0]['es_index_name'], media[0]['url'], media[0]['key'], 100)
+        # same media in another tweet is only referenced
+        ref_media = pm.process()
+        assert ref_media == [dict(media[0], ref=media[0]['key'])]
+        assert s3_q.get_counts(pm.project_slug, media_type='photo') == 4
+        assert s3_q.get_counts(pm.project_slug, media_type='media_deduplicated') == 1
+        assert s3_q.get_counts(pm.project_slug, media_type='media_bytes_saved') == 100
+        assert media_cache.get(media[0]['es_index_name'], media[0]['url'])['num_references'] == '1'
+        assert media_cache._r.ttl(media_cache.key(media[0]['es_index_name'], media[0]['url'])) > 0
+        # media is not deduplicated across projects
+        assert media_cache.lookup('project_other', media[0]['url']) is None
+        # reference is stored as pointer object
+        with patch('app.stream.s3_handler.S3Handler.upload_to_s3', return_value=True) as upload_to_s3:
+            assert MediaDownloader().download(ref_media) == 1
+        upload_to_s3.assert_called_once_with(media[0]['key'].encode(), media[0]['key'] + MediaDownloader.REF_SUFFIX)
+        s3_q.clear_all_counts()
+
+    def _response(self, content):
+        resp = requests.Response()
+        resp.status_code = 200
+        resp._content = content
+        resp._content_consumed = True
+        return resp
+
 if __name__ == "__main__":
     # if running outside of docker, make sure redis is running on localhost
     import os; os.environ["REDIS_HOST"] = "localhost"
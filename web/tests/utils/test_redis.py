@@ -1,5 +1,7 @@
 import pytest
 import sys;sys.path.append('../../../web/')
+from unittest.mock import patch
+from app.utils.redis import get_connection_pool
 
 
 class TestRedis:
@@ -10,6 +12,14 @@ class TestRedis:
         retrieved = r.get_cached(key)
         assert retrieved == some_data
 
+    def test_connection_pool_is_shared(self):
+        pool = get_connection_pool('localhost', 6379)
+        assert get_connection_pool('localhost', 6379) is pool
+        assert pool.max_connections == 50
+        # forked processes create their own pool
+        with patch('app.utils.redis.os.getpid', return_value=-1):
+            assert get_connection_pool('localhost', 6379) is not pool
+
 if __name__ == "__main__":
     # if running outside of docker, make sure redis is running on localhost
     import os; os.environ["REDIS_HOST"] = "localhost"
@@ -25,6 +25,45 @@ class TestRedisSet:
         assert rs.is_member('b', 'user_a')
         rs.self_remove_all()
 
+class TestRedisBitmapSet:
+    def test_add(self, rs_bitmap):
+        assert not rs_bitmap.is_member('a', 'user')
+        rs_bitmap.add('a', 'user')
+        assert rs_bitmap.is_member('a', 'user')
+        rs_bitmap.self_remove_all()
+
+    def test_remove(self, rs_bitmap):
+        assert rs_bitmap.num_members('a') == 0
+        rs_bitmap.add('a', 'user_a')
+        rs_bitmap.add('a', 'user_b')
+        assert rs_bitmap.num_members('a') == 2
+        rs_bitmap.remove('a')
+        rs_bitmap.remove('a')
+        assert not rs_bitmap.is_member('a', 'user_a')
+        assert rs_bitmap.num_members('a') == 0
+        rs_bitmap.self_remove_all()
+
+    def test_offsets(self, rs_bitmap):
+        rs_bitmap.add('b', 'user_a')
+        rs_bitmap.add('c', 'user_b')
+        rs_bitmap.add('c', 'user_a')
+        assert rs_bitmap.offset('user_a') == 0
+        assert rs_bitmap.offset('user_b') == 1
+        assert rs_bitmap.offset('user_c') is None
+        assert rs_bitmap.num_members('b') == 1
+        assert rs_bitmap.num_members('c') == 2
+        rs_bitmap.self_remove_all()
+
+    def test_tweet_id_queue(self, tid_q_bitmap):
+        tid_q_bitmap.pq.add('321', priority=1)
+        tid_q_bitmap.pq.add('123', priority=0)
+        tid_q_bitmap.update('321', 'user_a')
+        assert tid_q_bitmap.get(user_id='user_a') == '123'
+        assert tid_q_bitmap.get(user_id='user_b') == '321'
+        tid_q_bitmap.multi_update([('123', 'user_a'), ('123', 'user_b')])
+        assert tid_q_bitmap.get(user_id='user_a') is None
+        assert tid_q_bitmap.rset.num_members('123') == 2
+
 if __name__ == "__main__":
     # if running outside of docker, make sure redis is running on localhost
     import os; os.environ["REDIS_HOST"] = "localhost"
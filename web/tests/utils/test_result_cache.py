@@ -0,0 +1,29 @@
+import pytest
+from datetime import datetime, timedelta
+
+class TestResultCache:
+    def test_get_set(self, result_cache):
+        options = {'interval': 'day', 'start_date': 'now-1y', 'end_date': 'now'}
+        assert result_cache.get('all', 'project_test', options) is None
+        result_cache.set('all', 'project_test', options, [{'key': 1, 'doc_count': 2}])
+        # key does not depend on order of options
+        options_reordered = {'end_date': 'now', 'start_date': 'now-1y', 'interval': 'day'}
+        assert result_cache.get('all', 'project_test', options_reordered) == [{'key': 1, 'doc_count': 2}]
+        assert result_cache.get('all', 'project_test', {**options, 'interval': 'month'}) is None
+        assert result_cache.get('predictions', 'project_test', options) is None
+        assert result_cache.get('all', 'project_test', options, raw=True) == b'[{"key":1,"doc_count":2}]'
+
+    def test_ttl(self, result_cache):
+        assert result_cache.ttl({'interval': 'hour', 'end_date': 'now'}) < result_cache.ttl({'interval': 'month', 'end_date': 'now'})
+        assert result_cache.ttl({'interval': 'hour', 'end_date': '2019-01-01 00:00:00'}) == result_cache.CLOSED_RANGE_TTL
+        # relative end dates slide with time, ranges ending recently or in the future are still open
+        assert result_cache.ttl({'interval': 'hour', 'end_date': 'now-1w'}) == result_cache.INTERVAL_TTLS['hour']
+        recent = (datetime.utcnow() - timedelta(hours=2)).strftime('%Y-%m-%d %H:%M:%S')
+        assert result_cache.ttl({'interval': 'hour', 'end_date': recent}) == result_cache.INTERVAL_TTLS['hour']
+        assert result_cache.ttl({'interval': 'hour', 'end_date': 'now-1h'}) == result_cache.INTERVAL_TTLS['hour']
+        assert result_cache.ttl({'interval': 'day', 'end_date': '2100-01-01 00:00:00'}) == result_cache.INTERVAL_TTLS['day']
+
+if __name__ == "__main__":
+    # if running outside of docker, make sure redis is running on localhost
+    import os; os.environ["REDIS_HOST"] = "localhost"
+    pytest.main()
@@ -0,0 +1,15 @@
+import pytest
+import sys; sys.path.append('../..')
+
+class TestRollupIds:
+    def test_claim(self, rollup_ids):
+        created_at = 'Wed Oct 10 20:19:24 +0000 2018'
+        predictions = [('1', created_at, False, 'sentiment', 'run_1', 'positive', 1), ('1', created_at, False, 'sentiment', '', 'positive', 1)]
+        assert rollup_ids.claim(predictions) == predictions
+        # predictions processed again are not counted twice
+        new_prediction = ('2', created_at, True, 'sentiment', 'run_1', 'negative', -1)
+        assert rollup_ids.claim(predictions + [new_prediction]) == [new_prediction]
+        assert rollup_ids._r.ttl(rollup_ids.key('2018-10-10 20:00:00')) > 0
+        # released predictions can be claimed again
+        rollup_ids.release([new_prediction])
+        assert rollup_ids.claim([new_prediction]) == [new_prediction]
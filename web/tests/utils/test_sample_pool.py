@@ -0,0 +1,20 @@
+import pytest
+
+class TestSamplePool:
+    def test_add(self, sample_pool):
+        assert sample_pool.get() is None
+        assert sample_pool.add({'id': '123', 'text': 'some text'})
+        assert len(sample_pool) == 1
+        assert sample_pool.get() == {'id': '123', 'text': 'some text'}
+        # get does not remove tweet from pool
+        assert len(sample_pool) == 1
+
+    def test_pool_size(self, sample_pool):
+        for i in range(100):
+            sample_pool.add({'id': str(i), 'text': 'some text'})
+        assert len(sample_pool) == sample_pool.pool_size
+
+if __name__ == "__main__":
+    # if running outside of docker, make sure redis is running on localhost
+    import os; os.environ["REDIS_HOST"] = "localhost"
+    pytest.main(['-s', '-m', 'focus'])
@@ -0,0 +1,80 @@
+import pytest
+import sys; sys.path.append('../../../web/')
+from unittest.mock import MagicMock
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from app.utils.smoothed_series import loess_numpy, interval_start, to_ms
+from app.utils.json_response import dumps
+from app.connections.elastic import add_months
+
+def day_buckets(start, values):
+    buckets = []
+    for i, value in enumerate(values):
+        date = start + timedelta(days=i)
+        buckets.append({'key': int(date.replace(tzinfo=timezone.utc).timestamp()*1000), 'key_as_string': date.strftime('%Y-%m-%d %H:%M:%S'),
+            'doc_count': 0 if value is None else 10, 'mean_label_val': {'value': value}})
+    return buckets
+
+def mock_es(buckets):
+    es = MagicMock()
+    def get_avg_label_val(index_name, question_tag, **options):
+        start = datetime.strptime(options['start_date'], '%Y-%m-%d %H:%M:%S') if options['start_date'] != 'now-20y' else datetime(1970, 1, 1)
+        return [b for b in buckets if b['key_as_string'] >= start.strftime('%Y-%m-%d %H:%M:%S')]
+    es.get_avg_label_val.side_effect = get_avg_label_val
+    return es
+
+class TestSmoothedSeries:
+    def test_loess_numpy(self):
+        x = np.arange(50, dtype=float)*3600*1000
+        # local linear fits reproduce linear series exactly
+        assert np.allclose(loess_numpy(x, 2*np.arange(50) + 1, 7), 2*np.arange(50) + 1)
+        # constant within windows of identical x
+        assert np.allclose(loess_numpy(np.zeros(5), np.ones(5), 3), np.ones(5))
+
+    def test_loess_numpy_matches_statsmodels(self):
+        smoothers_lowess = pytest.importorskip('statsmodels.nonparametric.smoothers_lowess')
+        x = np.arange(50, dtype=float)*3600*1000
+        y = np.sin(np.arange(50)/5) + np.random.RandomState(0).normal(0, 0.1, 50)
+        assert np.allclose(loess_numpy(x, y, 10), smoothers_lowess.lowess(y, x, frac=10/50, it=0, is_sorted=True, return_sorted=False), atol=0.05)
+
+    def test_incremental_update(self, smoothed_series):
+        values = list(np.random.RandomState(0).uniform(-1, 1, 40))
+        values[10] = None
+        buckets = day_buckets(datetime(2020, 1, 1), values)
+        es = mock_es(buckets[:30])
+        assert smoothed_series.update(es, now=datetime(2020, 1, 30, 12))
+        # last bucket is still open
+        assert len(smoothed_series.get()) == 29
+        # nothing to do until the next bucket closes
+        assert not smoothed_series.update(es, now=datetime(2020, 1, 30, 18))
+        es = mock_es(buckets)
+        assert smoothed_series.update(es, now=datetime(2020, 2, 9, 12))
+        assert es.get_avg_label_val.call_args[1]['start_date'] == '2020-01-25 00:00:00'
+        series = smoothed_series.get()
+        assert len(series) == 39
+        assert series[10]['avg_sentiment']['value_smoothed'] is None
+        # same as smoothing the whole series at once
+        valid = [b for b in series if b['avg_sentiment']['value'] is not None]
+        expected = loess_numpy([b['key'] for b in valid], [b['avg_sentiment']['value'] for b in valid], 5)
+        assert np.allclose([b['avg_sentiment']['value_smoothed'] for b in valid], expected)
+        assert len(smoothed_series.get(start_date='2020-02-01 00:00:00')) == 8
+
+    def test_get_uses_calendar_months(self, smoothed_series):
+        now = datetime.utcnow()
+        month_ago = add_months(now, -1)
+        buckets = [{'key': to_ms(date), 'key_as_string': '', 'doc_count': 1, 'avg_sentiment': {'value': 0, 'value_smoothed': 0}}
+                for date in [month_ago - timedelta(hours=1), month_ago + timedelta(hours=1)]]
+        smoothed_series._r.set(smoothed_series.key, dumps({'current_bucket_start': 0, 'buckets': buckets}))
+        assert smoothed_series.get(start_date='now-1M') == buckets[1:]
+
+    def test_interval_start(self):
+        now = datetime(2020, 3, 12, 15, 42, 11)
+        assert interval_start(now, 'hour') == datetime(2020, 3, 12, 15)
+        assert interval_start(now, 'day') == datetime(2020, 3, 12)
+        assert interval_start(now, 'week') == datetime(2020, 3, 9)
+        assert interval_start(now, 'month') == datetime(2020, 3, 1)
+
+if __name__ == "__main__":
+    # if running outside of docker, make sure redis is running on localhost
+    import os; os.environ["REDIS_HOST"] = "localhost"
+    pytest.main()
@@ -21,6 +21,42 @@ class TestPriorityQueue:
         tweet['id'] = str(tweet['id'])
         assert r_tweet == tweet
 
+    def test_get_tweet_for_user(self, tid_q, tweet):
+        tid_q.add_tweet(tweet['id_str'], tweet, priority=1)
+        tid_q.pq.add('123456', priority=0)  # not present in tweet store
+        tid_q.update(tweet['id_str'], 'user_a')
+        assert tid_q.get_tweet(user_id='user_a') == {'id': '123456'}
+        r_tweet = tid_q.get_tweet(user_id='user_b')
+        assert r_tweet['id'] == tweet['id_str']
+        assert r_tweet['text'] == tweet['text']
+        tid_q.update('123456', 'user_a')
+        assert tid_q.get_tweet(user_id='user_a') is None
+
+    def test_get_tweets_for_user(self, tid_q, tweet):
+        tid_q.add_tweet(tweet['id_str'], tweet, priority=2)
+        for i in range(3):
+            tid_q.pq.add(str(i), priority=i)
+        tid_q.update('2', 'user_a')
+        tweets = tid_q.get_tweets(3, user_id='user_a')
+        assert [t['id'] for t in tweets] == [tweet['id_str'], '1', '0']
+        assert tweets[0]['text'] == tweet['text']
+        assert len(tid_q.get_tweets(10, user_id='user_b')) == 4
+        assert [t['id'] for t in tid_q.get_tweets(2)] == ['2', tweet['id_str']]
+
+    def test_multi_update(self, tid_q):
+        tid_q.pq.add('321', priority=1)
+        tid_q.pq.add('123', priority=0)
+        num_updated = tid_q.multi_update([('321', 'user_a'), ('123', 'user_a'), ('123', 'user_b'), ('unknown', 'user_a')])
+        assert num_updated == 3
+        assert tid_q.pq.get_score('321') == 2
+        assert tid_q.pq.get_score('123') == 2
+        assert tid_q.rset.is_member('123', 'user_b')
+        assert tid_q.get(user_id='user_a') is None
+        # reaching threshold
+        tid_q.multi_update([('321', 'user_' + str(i)) for i in range(tid_q.priority_threshold - 2)])
+        assert not tid_q.pq.exists('321')
+        assert tid_q.rset.num_members('321') == 0
+
     def test_increase_over_threshold(self, tid_q):
         tweet_id = '123456'
         tid_q.pq.add(tweet_id)
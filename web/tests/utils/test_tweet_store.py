@@ -9,7 +9,7 @@ class TestTweetStore:
         tweet_store.add(tweet['id'], tweet)
         assert len(tweet_store) == 1
         # tweet was never added to pq, therefore should be removed by cleanup
-        tweet_store.cleanup(['test_project'])
+        tweet_store.cleanup()
         assert len(tweet_store) == 0
 
     def test_cleanup_non_stale(self, tweet_store, pq, tweet):
@@ -18,7 +18,7 @@ class TestTweetStore:
         assert len(tweet_store) == 1
         assert len(pq) == 1
         # tweet was added to pq, do not remove from tweet store
-        tweet_store.cleanup(['test_project'])
+        tweet_store.cleanup()
         assert len(tweet_store) == 1
 
 if __name__ == "__main__":